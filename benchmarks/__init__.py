@@ -0,0 +1,15 @@
+import sys
+
+from atexit import register
+from os import environ
+from pathlib import Path
+from shutil import rmtree
+from tempfile import mkdtemp
+
+
+sys.path.append(str(Path(__file__).parent.parent.joinpath("src").absolute()))
+
+# keep the caches written by benchmark runs out of the user's cache directory
+if "VELOCITY_CACHE_DIR" not in environ:
+    environ["VELOCITY_CACHE_DIR"] = mkdtemp(prefix="velocity-bench-")
+    register(rmtree, environ["VELOCITY_CACHE_DIR"], True)
@@ -0,0 +1,61 @@
+"""Benchmark dependency edge construction in ImageRepo on synthetic repositories of increasing size.
+
+Run with ``python -m benchmarks.bench_edges``. The indexed lookup should scale close to linearly with the number of
+image versions while the naive scan over every pair of images grows quadratically.
+"""
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from timeit import default_timer as timer
+
+from velocity._graph import Image, ImageRepo
+
+from benchmarks.synthetic import generate_specs, write_repo
+
+
+def load_images(path: str) -> set[Image]:
+    """Import a repository and apply its dependency constraints."""
+    repo = ImageRepo()
+    repo.import_from_dir(path)
+    by_name: dict[str, list[Image]] = dict()
+    for image in repo.images:
+        by_name.setdefault(image.name, list()).append(image)
+    for constraint in repo.constraints:
+        for image in by_name[constraint[0]]:
+            image.apply_constraint("{} {}".format(constraint[0], constraint[1]), constraint[2], constraint[3])
+    return repo.images
+
+
+def naive_edges(images: set[Image]) -> list:
+    """Find dependency edges by testing every pair of images."""
+    edges = list()
+    for image in images:
+        for dep in image.dependencies:
+            for di in images:
+                if di.satisfies(dep):
+                    edges.append((image, di))
+    return edges
+
+
+def main() -> None:
+    print("{:>8} {:>8} {:>12} {:>12}".format("images", "edges", "naive", "indexed"))
+    for names, versions, naive in ((10, 10, True), (20, 20, True), (40, 25, True), (80, 25, False), (160, 25, False)):
+        with TemporaryDirectory() as tmp:
+            write_repo(Path(tmp), generate_specs(names, versions))
+            images = load_images(tmp)
+
+            naive_time = "-"
+            if naive:
+                start = timer()
+                naive_edges(images)
+                naive_time = "{:.3f}s".format(timer() - start)
+
+            start = timer()
+            ig = ImageRepo._create_graph(images)
+            indexed_time = timer() - start
+
+        print("{:>8} {:>8} {:>12} {:>11.3f}s".format(len(images), ig.number_of_edges(), naive_time, indexed_time))
+
+
+if __name__ == "__main__":
+    main()
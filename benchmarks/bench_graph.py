@@ -0,0 +1,54 @@
+"""Benchmark ImageGraph construction on synthetic graphs of increasing size.
+
+Run with ``python -m benchmarks.bench_graph``. The time per edge should stay flat as the graph grows.
+"""
+
+from random import Random
+from timeit import default_timer as timer
+
+from velocity._graph import Image, ImageGraph
+
+from benchmarks.synthetic import image_name, image_version
+
+
+def generate_edges(names: int, versions: int, fan_out: int = 3, seed: int = 0) -> tuple[list, list]:
+    """Generate images and dependency edges. Edges point from lower to higher name index so there are no cycles."""
+    rng = Random(seed)
+    images = [[Image(image_name(i), image_version(v), "", "", "", "") for v in range(versions)] for i in range(names)]
+    edges = list()
+    for i in range(names - 1):
+        for j in rng.sample(range(i + 1, names), min(fan_out, names - i - 1)):
+            for image in images[i]:
+                for dep in rng.sample(images[j], 2):
+                    edges.append((image, dep))
+    rng.shuffle(edges)
+    return [image for group in images for image in group], edges
+
+
+def main() -> None:
+    print("{:>6} {:>7} {:>12} {:>12} {:>12}".format("nodes", "edges", "add_edge", "edges_from", "us/edge"))
+    for names in (50, 100, 200, 400):
+        nodes, edges = generate_edges(names, 10)
+
+        ig = ImageGraph()
+        ig.add_nodes_from(nodes)
+        start = timer()
+        for u, v in edges:
+            ig.add_edge(u, v)
+        incremental = timer() - start
+
+        ig = ImageGraph()
+        ig.add_nodes_from(nodes)
+        start = timer()
+        ig.add_edges_from(edges)
+        bulk = timer() - start
+
+        print(
+            "{:>6} {:>7} {:>11.3f}s {:>11.3f}s {:>12.1f}".format(
+                len(nodes), len(edges), incremental, bulk, incremental / len(edges) * 1e6
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
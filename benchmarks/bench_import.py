@@ -0,0 +1,38 @@
+"""Benchmark ImageRepo.import_from_dir with a cold and a warm repository cache.
+
+Run with ``python -m benchmarks.bench_import [names] [versions]``.
+"""
+
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from timeit import default_timer as timer
+
+from velocity._config import config
+from velocity._graph import ImageRepo
+
+from benchmarks.synthetic import generate_specs, write_repo
+
+
+def time_import(path: str) -> float:
+    """Time importing a repository into a new ImageRepo."""
+    start = timer()
+    ImageRepo().import_from_dir(path)
+    return timer() - start
+
+
+def main(names: int = 200, versions: int = 20) -> None:
+    with TemporaryDirectory() as tmp, TemporaryDirectory() as cache:
+        write_repo(Path(tmp), generate_specs(names, versions))
+        # an empty cache of its own so the cold import is cold and the user's cache is left alone
+        config.set("velocity:cache_dir", cache)
+        cold = time_import(tmp)
+        warm = min(time_import(tmp) for _ in range(5))
+
+    print("repo: {} names, {} versions each".format(names, versions))
+    print("cold import: {:.3f}s".format(cold))
+    print("warm import: {:.3f}s".format(warm))
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:3]))
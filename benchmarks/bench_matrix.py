@@ -0,0 +1,50 @@
+"""Benchmark resolving a matrix of target sets one by one against resolving them together.
+
+Run with ``python -m benchmarks.bench_matrix [names] [versions]``.
+"""
+
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from timeit import default_timer as timer
+
+from velocity._graph import ImageRepo
+from velocity._matrix import expand_target_set
+
+from benchmarks.synthetic import generate_specs, image_name, image_version, write_repo
+
+
+def main(names: int = 60, versions: int = 10) -> None:
+    with TemporaryDirectory() as tmp:
+        write_repo(Path(tmp), generate_specs(names, versions, variables=5))
+        repo = ImageRepo()
+        repo.import_from_dir(tmp)
+
+        # every version of the first few images (combinations of targets that cannot be built together can take the
+        # solver a long time to rule out, which would hide the cost this measures)
+        target_sets = expand_target_set(
+            "img{{{}}}@{{{}}}".format(
+                ",".join(image_name(i)[3:] for i in range(8)), ",".join(image_version(v) for v in range(versions))
+            )
+        )
+
+        start = timer()
+        for targets in target_sets:
+            try:
+                repo.create_build_recipe(targets)
+            except Exception:
+                pass
+        separate = timer() - start
+
+        start = timer()
+        repo.create_build_recipes(target_sets)
+        together = timer() - start
+
+    print("repo: {} images, {} constraints".format(len(repo.images), len(repo.constraints)))
+    print("cells: {}".format(len(target_sets)))
+    print("one by one: {:.3f}s".format(separate))
+    print("together:   {:.3f}s".format(together))
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:3]))
@@ -0,0 +1,40 @@
+"""Benchmark ImageGraph.is_above against a breadth first search per query.
+
+Run with ``python -m benchmarks.bench_reach [queries]``.
+"""
+
+import sys
+from random import Random
+from timeit import default_timer as timer
+
+from networkx import has_path as nx_has_path
+
+from velocity._graph import ImageGraph
+
+from benchmarks.bench_graph import generate_edges
+
+
+def main(queries: int = 20000) -> None:
+    print("{:>6} {:>7} {:>12} {:>12}".format("nodes", "edges", "has_path", "is_above"))
+    for names in (50, 100, 200, 400):
+        nodes, edges = generate_edges(names, 10)
+        ig = ImageGraph()
+        ig.add_nodes_from(nodes)
+        ig.add_edges_from(edges)
+        rng = Random(0)
+        pairs = [(rng.choice(nodes), rng.choice(nodes)) for _ in range(queries)]
+
+        start = timer()
+        expected = [nx_has_path(ig, u, v) for u, v in pairs]
+        searched = timer() - start
+
+        start = timer()
+        found = [ig.is_above(u, v) for u, v in pairs]
+        closure = timer() - start
+
+        assert found == expected
+        print("{:>6} {:>7} {:>11.3f}s {:>11.3f}s".format(len(nodes), len(edges), searched, closure))
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:2]))
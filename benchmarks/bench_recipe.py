@@ -0,0 +1,43 @@
+"""Benchmark ImageRepo.create_build_recipe, including constraint application, on a synthetic repository.
+
+Run with ``python -m benchmarks.bench_recipe [names] [versions] [variables]``.
+"""
+
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from timeit import default_timer as timer
+
+from velocity._config import config
+from velocity._graph import ImageRepo
+
+from benchmarks.synthetic import generate_specs, image_name, write_repo
+
+
+def main(names: int = 100, versions: int = 10, variables: int = 5) -> None:
+    with TemporaryDirectory() as tmp:
+        write_repo(Path(tmp), generate_specs(names, versions, variables=variables))
+        repo = ImageRepo()
+        repo.import_from_dir(tmp)
+
+        times = list()
+        for _ in range(3):
+            # recipes are cached so resolve with an empty cache every time
+            with TemporaryDirectory() as cache:
+                config.set("velocity:cache_dir", cache)
+                start = timer()
+                recipe, _ = repo.create_build_recipe([image_name(0)])
+                times.append(timer() - start)
+
+                start = timer()
+                repo.get_build_recipe([image_name(0)])
+                cached = timer() - start
+
+    print("repo: {} images, {} constraints".format(len(repo.images), len(repo.constraints)))
+    print("recipe: {} images".format(len(recipe)))
+    print("create_build_recipe: {:.3f}s".format(min(times)))
+    print("get_build_recipe (cached): {:.4f}s".format(cached))
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:4]))
@@ -0,0 +1,45 @@
+"""Benchmark ImageGraph.create_build_recipe on a synthetic repository.
+
+Run with ``python -m benchmarks.bench_solver [names] [versions]``.
+"""
+
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from timeit import default_timer as timer
+
+from velocity._graph import DepOp, Image, ImageGraph, ImageRepo, Target
+
+from benchmarks.synthetic import generate_specs, image_name, write_repo
+
+
+def build_graph(repo: ImageRepo) -> ImageGraph:
+    """Apply the dependency constraints of a repo and build its graph."""
+    by_name: dict[str, list[Image]] = dict()
+    for image in repo.images:
+        by_name.setdefault(image.name, list()).append(image)
+    for constraint in repo.constraints:
+        for image in by_name[constraint[0]]:
+            image.apply_constraint("{} {}".format(constraint[0], constraint[1]), constraint[2], constraint[3])
+    return ImageRepo._create_graph(repo.images)
+
+
+def main(names: int = 50, versions: int = 20) -> None:
+    with TemporaryDirectory() as tmp:
+        write_repo(Path(tmp), generate_specs(names, versions))
+        repo = ImageRepo()
+        repo.import_from_dir(tmp)
+        ig = build_graph(repo)
+
+        target = Image(image_name(0), "", "", "", "", "")
+        start = timer()
+        recipe = ig.create_build_recipe([Target(target, DepOp.UN)])
+        end = timer()
+
+        print("graph: {} nodes, {} edges".format(ig.number_of_nodes(), ig.number_of_edges()))
+        print("recipe: {} images".format(len(recipe)))
+        print("create_build_recipe: {:.3f}s".format(end - start))
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:3]))
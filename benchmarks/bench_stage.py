@@ -0,0 +1,54 @@
+"""Benchmark staging an image's files into its build directory.
+
+Run with ``python -m benchmarks.bench_stage [files] [kilobytes per file]``.
+"""
+
+import sys
+from os import urandom
+from pathlib import Path
+from shutil import copytree, rmtree
+from tempfile import TemporaryDirectory
+from timeit import default_timer as timer
+from unittest.mock import patch
+
+from velocity._stage import stage_files
+
+
+def main(files: int = 2000, size: int = 100) -> None:
+    with TemporaryDirectory() as tmp:
+        src = Path(tmp, "files", "tree")
+        for i in range(files):
+            path = src.joinpath("d{:02d}".format(i % 50), "f{:05d}".format(i))
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(urandom(size * 1024))
+        dest = Path(tmp, "build", "tree")
+
+        start = timer()
+        copytree(src, dest)
+        tree = timer() - start
+        rmtree(dest)
+
+        # force copies as if the build directory was on another filesystem
+        with patch("velocity._stage.reflink", return_value=False), patch("velocity._stage.link", side_effect=OSError):
+            start = timer()
+            stage_files([(src, dest)])
+            copied = timer() - start
+
+            start = timer()
+            stage_files([(src, dest)])
+            unchanged = timer() - start
+        rmtree(dest)
+
+        start = timer()
+        staged = stage_files([(src, dest)])
+        linked = timer() - start
+
+    print("files: {} x {} KB".format(files, size))
+    print("copytree:            {:.3f}s".format(tree))
+    print("stage (copy):        {:.3f}s".format(copied))
+    print("stage (unchanged):   {:.3f}s".format(unchanged))
+    print("stage (same fs):     {:.3f}s ({} linked)".format(linked, staged["linked"]))
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:3]))
@@ -0,0 +1,62 @@
+"""Benchmark CLI startup time and check it against a regression threshold.
+
+Run with ``python -m benchmarks.bench_startup [threshold_ms]``. Each command is run in a fresh interpreter against an
+empty image path and the best of several runs is reported. The exit status is non-zero if any command is slower than
+the threshold (300ms by default) or imports a module it should not need.
+"""
+
+import sys
+from os import environ
+from pathlib import Path
+from subprocess import run
+from tempfile import TemporaryDirectory
+from timeit import default_timer as timer
+
+SRC = Path(__file__).parent.parent.joinpath("src").absolute()
+
+# modules that no command below should import
+HEAVY_MODULES = ("networkx", "velocity._dag", "velocity._build", "velocity._backends")
+
+COMMANDS = (["--help"], ["avail"], ["avail", "gcc"])
+
+
+def imported_modules(args: list[str], env: dict) -> set[str]:
+    """Get the modules imported by a velocity command."""
+    result = run([sys.executable, "-X", "importtime", "-m", "velocity", *args], env=env, capture_output=True, text=True)
+    return {line.split("|")[-1].strip() for line in result.stderr.splitlines() if line.startswith("import time:")}
+
+
+def time_command(command: list[str], env: dict, runs: int = 5) -> float:
+    """Get the best wall time of a command."""
+    best = float("inf")
+    for _ in range(runs):
+        start = timer()
+        run(command, env=env, capture_output=True)
+        best = min(best, timer() - start)
+    return best
+
+
+def main(threshold_ms: float = 300) -> int:
+    failed = False
+    with TemporaryDirectory() as tmp:
+        env = dict(environ)
+        env.update({"PYTHONPATH": str(SRC), "VELOCITY_CONFIG_DIR": tmp, "VELOCITY_IMAGE_PATH": tmp})
+        interpreter = time_command([sys.executable, "-c", "pass"], env)
+        print("{:<16} {:>10}".format("(interpreter)", "{:.0f}ms".format(interpreter * 1000)))
+        for args in COMMANDS:
+            elapsed = time_command([sys.executable, "-m", "velocity", *args], env)
+            heavy = sorted(m for m in imported_modules(args, env) if m in HEAVY_MODULES)
+            slow = elapsed * 1000 > threshold_ms
+            failed = failed or slow or len(heavy) > 0
+            print(
+                "{:<16} {:>10} {}".format(
+                    " ".join(args),
+                    "{:.0f}ms".format(elapsed * 1000),
+                    ("SLOW " if slow else "") + ("imports {}".format(", ".join(heavy)) if heavy else ""),
+                )
+            )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*(float(a) for a in sys.argv[1:2])))
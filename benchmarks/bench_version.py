@@ -0,0 +1,38 @@
+"""Micro-benchmark Version parsing, comparison and sorting.
+
+Run with ``python -m benchmarks.bench_version``.
+"""
+
+from random import Random
+from timeit import timeit
+
+from velocity._graph import Version
+
+
+def main(count: int = 10000) -> None:
+    rng = Random(0)
+    specs = list()
+    for _ in range(count):
+        parts = [str(rng.randrange(20)) for _ in range(rng.randint(1, 3))]
+        specs.append(".".join(parts) + ("-rc{}".format(rng.randrange(5)) if rng.random() < 0.2 else ""))
+    versions = [Version(s) for s in specs]
+    pairs = list(zip(versions, reversed(versions)))
+
+    def compare():
+        for a, b in pairs:
+            a == b
+            a < b
+            a >= b
+
+    results = {
+        "parse": timeit(lambda: [Version(s) for s in specs], number=5) / 5,
+        "compare (x3)": timeit(compare, number=5) / 5,
+        "sort": timeit(lambda: sorted(versions), number=5) / 5,
+        "preferred": timeit(lambda: [a.preferred(b) for a, b in pairs], number=5) / 5,
+    }
+    for name, seconds in results.items():
+        print("{:<14} {:>10.1f} ns/op".format(name, seconds / count * 1e9))
+
+
+if __name__ == "__main__":
+    main()
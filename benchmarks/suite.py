@@ -0,0 +1,161 @@
+"""Benchmark suite for the resolver on synthetic repositories.
+
+Every case times importing the repository (with a cold and a warm cache), resolving a build recipe and generating the
+build scripts of the recipe separately, and measures the peak memory of each phase in a second, untimed run. Nothing is
+built so no container runtime is needed.
+
+Run with ``python -m benchmarks.suite [--output results.json] [--baseline results.json]``. The results are written as
+json. With a baseline the run fails if any time regressed by more than the tolerance.
+"""
+
+import sys
+from argparse import ArgumentParser
+from json import dump as json_dump, load as json_load
+from pathlib import Path
+from platform import platform, python_version
+from tempfile import TemporaryDirectory
+from timeit import default_timer as timer
+from tracemalloc import get_traced_memory, start as tm_start, stop as tm_stop
+
+from velocity._backends import Apptainer
+from velocity._config import config
+from velocity._graph import Image, ImageRepo
+
+from benchmarks.synthetic import generate_specs, image_name, write_repo
+
+
+# name, names, versions, fan_out, depth, variables (conditional variables and build scoped arguments per image)
+CASES: tuple[tuple[str, int, int, int, int | None, int], ...] = (
+    ("small", 20, 5, 2, None, 2),
+    ("wide", 200, 5, 3, 4, 2),
+    ("deep", 100, 10, 3, None, 5),
+    ("versions", 50, 25, 3, None, 5),
+)
+
+PHASES: tuple[str, ...] = ("import_cold", "import_warm", "create_build_recipe", "generate_scripts")
+
+
+def generate_scripts(recipe: tuple[Image]) -> int:
+    """Generate the build script of every image in recipe like a dry run build would. Returns the number of lines."""
+    backend = Apptainer()
+    lines = 0
+    base = "docker.io/ubuntu:latest"
+    for image in recipe:
+        variables: dict[str, str] = {
+            "__image_id__": image.id,
+            "__name__": image.name,
+            "__version__": str(image.version),
+            "__base__": base,
+        }
+        variables.update(image.variables)
+        lines += len(backend.generate_script(image, variables))
+        base = "{}-{}.sif".format(image.name, image.id)
+    return lines
+
+
+def run_case(path: str, targets: list[str], traced: bool = False) -> dict[str, float]:
+    """Run every phase once against the repository at path.
+
+    Returns the time of every phase or, if traced, the peak memory of every phase in bytes.
+    """
+    measurements: dict[str, float] = dict()
+    repo: ImageRepo = None
+    recipe: tuple[Image] = tuple()
+
+    def import_repo():
+        nonlocal repo
+        repo = ImageRepo()
+        repo.import_from_dir(path)
+
+    def create_recipe():
+        nonlocal recipe
+        recipe = repo.create_build_recipe(targets)[0]
+
+    with TemporaryDirectory() as cache:
+        config.set("velocity:cache_dir", cache)
+        for phase, function in zip(PHASES, (import_repo, import_repo, create_recipe, lambda: generate_scripts(recipe))):
+            if traced:
+                tm_start()
+                function()
+                measurements[phase] = get_traced_memory()[1]
+                tm_stop()
+            else:
+                start = timer()
+                function()
+                measurements[phase] = timer() - start
+    return measurements
+
+
+def run_suite(repeat: int = 3, cases: list[str] = None) -> dict:
+    """Run the benchmark cases (all of them by default) and collect the results in a json serializable document."""
+    results: list[dict] = list()
+    for name, names, versions, fan_out, depth, variables in CASES:
+        if cases is not None and name not in cases:
+            continue
+        with TemporaryDirectory() as tmp:
+            write_repo(Path(tmp), generate_specs(names, versions, fan_out=fan_out, variables=variables, depth=depth))
+            targets = [image_name(0)]
+            # the first run loads the lazily imported modules and warms the file system cache
+            times = [run_case(tmp, targets) for _ in range(repeat + 1)][1:]
+            peaks = run_case(tmp, targets, traced=True)
+        results.append(
+            {
+                "case": name,
+                "names": names,
+                "versions": versions,
+                "fan_out": fan_out,
+                "depth": depth,
+                "variables": variables,
+                # the fastest run is the one least disturbed by the rest of the machine
+                "seconds": {phase: min(t[phase] for t in times) for phase in PHASES},
+                "peak_bytes": peaks,
+            }
+        )
+    return {"python": python_version(), "platform": platform(), "repeat": repeat, "results": results}
+
+
+def compare(results: dict, baseline: dict, tolerance: float, noise: float = 0.01) -> list[str]:
+    """Find the phases that got slower than baseline by more than tolerance (a fraction).
+
+    Slowdowns below noise seconds are ignored since the shortest phases only take a millisecond.
+    """
+    regressions: list[str] = list()
+    previous: dict[str, dict] = {r["case"]: r for r in baseline["results"]}
+    for result in results["results"]:
+        if result["case"] not in previous:
+            continue
+        for phase, seconds in result["seconds"].items():
+            before = previous[result["case"]]["seconds"].get(phase)
+            if before is not None and seconds - before > max(before * tolerance, noise):
+                regressions.append("{} {}: {:.4f}s -> {:.4f}s".format(result["case"], phase, before, seconds))
+    return regressions
+
+
+def main() -> int:
+    parser = ArgumentParser(prog="python -m benchmarks.suite", description=__doc__.splitlines()[0])
+    parser.add_argument("-o", "--output", help="write the results to this file instead of stdout")
+    parser.add_argument("-b", "--baseline", help="compare against the results of an earlier run")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.25, help="allowed slowdown (default 0.25)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="runs per case (default 3)")
+    parser.add_argument("-c", "--case", action="append", choices=[c[0] for c in CASES], help="only run these cases")
+    args = parser.parse_args()
+
+    results = run_suite(args.repeat, args.case)
+    if args.output is not None:
+        with open(args.output, "w") as fo:
+            json_dump(results, fo, indent=2)
+    else:
+        json_dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as fi:
+            regressions = compare(results, json_load(fi), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression), file=sys.stderr)
+        return 1 if len(regressions) > 0 else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""Generate synthetic image repositories for benchmarking."""
+
+from pathlib import Path
+from random import Random
+
+from yaml import safe_dump as yaml_safe_dump
+
+
+def image_name(idx: int) -> str:
+    """Name of the synthetic image with index idx."""
+    return "img{:03d}".format(idx)
+
+
+def image_version(idx: int) -> str:
+    """Version of the synthetic image version with index idx."""
+    return "{}.{}.0".format(idx // 5 + 1, idx % 5)
+
+
+def generate_specs(
+    names: int, versions: int, fan_out: int = 3, seed: int = 0, variables: int = 0, depth: int = None
+) -> dict[str, dict]:
+    """Generate the specs.yaml contents for a synthetic repository.
+
+    Image i only depends on images with a higher index so the repository is always a DAG. Every version of an image
+    picks an upper bound for each of its dependencies so that the highest versions do not always fit together. With
+    variables > 0 every image also gets that many conditional variables and a build scope argument. With a depth the
+    images are split into that many layers and only depend on the next layer so no dependency chain is longer.
+    """
+    rng = Random(seed)
+    specs: dict[str, dict] = dict()
+    for i in range(names):
+        spec: dict = {"versions": [{"spec": [image_version(v) for v in range(versions)]}]}
+        if depth is None:
+            children = list(range(i + 1, names))
+        else:
+            children = [j for j in range(i + 1, names) if j * depth // names == i * depth // names + 1]
+        dependencies: list[dict] = list()
+        for j in rng.sample(children, min(fan_out, len(children))):
+            for v in range(versions):
+                bound = image_version(rng.randrange(versions // 2, versions))
+                dependencies.append(
+                    {
+                        "spec": "{}@:{}".format(image_name(j), bound),
+                        "when": "{}@{}".format(image_name(i), image_version(v)),
+                    }
+                )
+        if len(dependencies) > 0:
+            spec["dependencies"] = dependencies
+        for k in range(variables):
+            spec.setdefault("variables", list()).append(
+                {
+                    "name": "VAR{}".format(k),
+                    "value": str(k),
+                    "when": "{}@{}:".format(image_name(i), image_version(rng.randrange(versions))),
+                }
+            )
+        if variables > 0 and len(children) > 0:
+            spec["arguments"] = [
+                {"value": "--arg-{}".format(i), "when": "^{}".format(image_name(children[-1])), "scope": "build"}
+            ]
+        specs[image_name(i)] = spec
+    return specs
+
+
+def write_repo(path: Path, specs: dict[str, dict]) -> None:
+    """Write a synthetic repository to path."""
+    for name, spec in specs.items():
+        image_dir = path.joinpath(name)
+        image_dir.joinpath("templates").mkdir(parents=True, exist_ok=True)
+        with open(image_dir.joinpath("specs.yaml"), "w") as fo:
+            yaml_safe_dump(spec, fo)
+        with open(image_dir.joinpath("templates", "default.vtmp"), "w") as fo:
+            fo.write("@from\n    {{ __base__ }}\n\n@run\n    echo '{{ __name__ }} {{ __version__ }}'\n")
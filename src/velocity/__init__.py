@@ -1,13 +1,9 @@
-from colorama import Fore, Style
 from loguru import logger
 from sys import stdout
 
 logger.disable("velocity")  # noqa: E702 # disable logging at the module level
 
 from velocity._config import config  # noqa: E402
-from velocity._graph import ImageRepo  # noqa: E402
-from velocity._build import ImageBuilder  # noqa: E402
-from velocity._print import TextBlock, header_print, indent_print  # noqa: E402
 
 
 # config functions
@@ -96,9 +92,10 @@ def build(
     Parameters
     ----------
     targets: str
-        A string of build targets e.g. '`gcc@12.4 rocm@5`'.
+        A string of build targets e.g. '`gcc@12.4 rocm@5`'. Brace alternatives build several images at once and the
+        images they share are only built once e.g. '`gcc@12.4 {rocm@5,cuda@12}`'.
     name: str
-        Name of complete image.
+        Name of complete image (only for a single image).
     dry_run: bool
         Dry run build system.
     leave_tags: bool
@@ -109,32 +106,77 @@ def build(
         Remove cached files in the build directory.
     """
 
+    # the image graph, builder and backends are only imported once they are needed
+    from colorama import Fore, Style
+    from velocity._build import ImageBuilder
+    from velocity._graph import ImageRepo
+    from velocity._matrix import expand_target_set
+    from velocity._print import TextBlock, header_print, indent_print
+
+    target_sets = expand_target_set(targets)
+    if name is not None and len(target_sets) > 1:
+        raise ValueError("A name can only be given when building a single image.")
+
+    _setup_logging()
     imageRepo = ImageRepo()
-    for p in config.get("velocity:image_path").strip(":").split(":"):
-        imageRepo.import_from_dir(p)
+    imageRepo.import_from_dirs(config.get("velocity:image_path").strip(":").split(":"))
 
-    # get recipe
-    recipe = imageRepo.create_build_recipe(targets.split())[0]
+    # get recipes (brace alternatives give one per combination)
+    recipes = [imageRepo.get_build_recipe(t) for t in target_sets]
 
     # print build specs
-    header_print([TextBlock("Build Order:")])
-    for r in recipe:
-        indent_print([TextBlock(f"{r.name}@{r.version}-{r.id}", fore=Fore.MAGENTA, style=Style.BRIGHT)])
-    print()  # newline
+    for recipe in recipes:
+        header_print([TextBlock("Build Order:")])
+        for r in recipe:
+            indent_print([TextBlock(f"{r.name}@{r.version}-{r.id}", fore=Fore.MAGENTA, style=Style.BRIGHT)])
+        print()  # newline
 
     # prep builder
     builder = ImageBuilder(
-        recipe, build_name=name, dry_run=dry_run, remove_tags=not leave_tags, verbose=verbose, clean_build_dir=clean
+        recipes,
+        build_name=[name] * len(recipes),
+        dry_run=dry_run,
+        remove_tags=not leave_tags,
+        verbose=verbose,
+        clean_build_dir=clean,
     )
 
     # build
     builder.build()
 
 
-# set up logging
-logger.configure(handlers=[{"sink": stdout, "level": config.get("velocity:logging:level")}])
-logger.enable("velocity")
-logger.debug(config.get(""))
+def matrix(target_sets: list[str]) -> dict:
+    """Resolve many sets of targets against one image repository.
+
+    Parameters
+    ----------
+    target_sets: list[str]
+        Strings of build targets like in build. Brace alternatives are expanded into the cartesian product of the
+        targets e.g. '`gcc@{12,13} cuda@{11.8,12.2}`' is four target sets.
+
+    Returns
+    -------
+    dict
+        A json serializable document with the recipe (or the error) of every target set.
+    """
+
+    from velocity._graph import ImageRepo
+    from velocity._matrix import resolve_matrix
+
+    _setup_logging()
+    imageRepo = ImageRepo()
+    imageRepo.import_from_dirs(config.get("velocity:image_path").strip(":").split(":"))
+
+    return resolve_matrix(imageRepo, target_sets)
+
+
+def _setup_logging() -> None:
+    """Log to stdout at the configured level. This is not done at import time so that importing velocity does not
+    load the configuration."""
+    logger.configure(handlers=[{"sink": stdout, "level": config.get("velocity:logging:level")}])
+    logger.enable("velocity")
+    logger.debug(config.get(""))
+
 
 # visible attributes
-__all__ = ["get_system", "set_system", "get_backend", "set_backend", "get_distro", "set_distro", "build"]
+__all__ = ["get_system", "set_system", "get_backend", "set_backend", "get_distro", "set_distro", "build", "matrix"]
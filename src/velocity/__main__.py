@@ -1,18 +1,27 @@
 """Run velocity as a script."""
 
 import argparse
-from colorama import Fore, Style
-from importlib.metadata import version
 from loguru import logger
-from re import fullmatch as re_fullmatch
+from re import fullmatch as re_fullmatch, match as re_match
 import sys
 
-from velocity._build import ImageBuilder
 from velocity._config import config
-from velocity._graph import Image, ImageRepo
-from velocity._print import TextBlock, bare_print, header_print, indent_print
 from velocity._exceptions import InvalidCLIArgumentFormat
 
+
+class VersionAction(argparse.Action):
+    """Print the program version. Package metadata is only loaded when the version is asked for."""
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS, help=None):
+        super().__init__(option_strings=option_strings, dest=dest, default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from importlib.metadata import version
+
+        print(f"{parser.prog} {version('olcf-velocity')}")
+        parser.exit()
+
+
 ############################################################
 # Parse Args
 ############################################################
@@ -21,9 +30,7 @@ parser = argparse.ArgumentParser(
     description="build tool for OLCF containers",
     epilog="See https://github.com/olcf/velocity",
 )
-parser.add_argument(
-    "-v", "--version", action="version", version=f"%(prog)s {version('olcf-velocity')}", help="program version"
-)
+parser.add_argument("-v", "--version", action=VersionAction, help="program version")
 parser.add_argument(
     "-L",
     "--logging-level",
@@ -40,8 +47,13 @@ sub_parsers = parser.add_subparsers(dest="subcommand")
 # create build_parser
 build_parser = sub_parsers.add_parser("build", help="build specified container image")
 build_parser.add_argument("-d", "--dry-run", action="store_true", help="dry run build system")
-build_parser.add_argument("targets", type=str, nargs="+", help="build targets")
-build_parser.add_argument("-n", "--name", action="store", help="name of complete image")
+build_parser.add_argument(
+    "targets",
+    type=str,
+    nargs="+",
+    help='build targets, brace alternatives build several images that share a prefix (e.g. "gcc cuda {python,pytorch}")',
+)
+build_parser.add_argument("-n", "--name", action="store", help="name of complete image (only for a single image)")
 build_parser.add_argument(
     "-l",
     "--leave-tags",
@@ -75,6 +87,25 @@ avail_parser.add_argument("targets", type=str, nargs="*", help="build targets")
 spec_parser = sub_parsers.add_parser("spec", help="lookup image dependencies")
 spec_parser.add_argument("targets", type=str, nargs="+", help="spec targets")
 
+# create matrix_parser
+matrix_parser = sub_parsers.add_parser("matrix", help="resolve many sets of targets to json")
+matrix_parser.add_argument(
+    "target_sets",
+    type=str,
+    nargs="+",
+    help='sets of build targets, brace alternatives are expanded (e.g. "gcc@{12,13} cuda@{11.8,12.2}")',
+)
+matrix_parser.add_argument("-o", "--output", action="store", help="write the json to a file instead of stdout")
+
+# create cache_parser
+cache_parser = sub_parsers.add_parser("cache", help="inspect or prune the layer cache")
+cache_parser.add_argument(
+    "action", nargs="?", choices=["list", "prune"], default="list", help="list layers (default) or prune the cache"
+)
+cache_parser.add_argument(
+    "-s", "--size", action="store", help="prune down to this size instead of the quota (e.g. 50G)"
+)
+
 # parse args
 args = parser.parse_args()
 
@@ -134,8 +165,15 @@ if args.backend is not None:
 if args.distro is not None:
     config.set("velocity:distro", args.distro)
 
-# setup logging and log startup
-logger.configure(handlers=[{"sink": sys.stdout, "level": config.get("velocity:logging:level")}])
+# setup logging and log startup (matrix writes json to stdout so it logs to stderr)
+logger.configure(
+    handlers=[
+        {
+            "sink": sys.stderr if args.subcommand == "matrix" else sys.stdout,
+            "level": config.get("velocity:logging:level"),
+        }
+    ]
+)
 logger.enable("velocity")
 logger.debug("Starting velocity.")
 logger.debug(config.get(""))
@@ -143,27 +181,49 @@ logger.debug(config.get(""))
 ############################################################
 # Load images
 ############################################################
-imageRepo = ImageRepo()
-for p in config.get("velocity:image_path").strip(":").split(":"):
-    imageRepo.import_from_dir(p)
+# imported here so that --help and --version do not pay for them
+from colorama import Fore, Style  # noqa: E402
+from velocity._graph import Image, ImageRepo  # noqa: E402
+from velocity._print import TextBlock, bare_print, header_print, indent_print  # noqa: E402
+
+# the layer cache does not need the images
+if args.subcommand != "cache":
+    imageRepo = ImageRepo()
+    imageRepo.import_from_dirs(config.get("velocity:image_path").strip(":").split(":"))
 
 ############################################################
 # Handle User Commands
 ############################################################
 if args.subcommand == "build":
-    # get recipe
-    recipe = imageRepo.create_build_recipe(args.targets)[0]
+    # the builder pulls in the backends
+    from velocity._build import ImageBuilder
+    from velocity._matrix import expand_target_set
+
+    # get recipes (brace alternatives give one per combination)
+    target_sets = expand_target_set(" ".join(args.targets))
+    if args.name is not None and len(target_sets) > 1:
+        build_parser.error("--name can only be used when building a single image")
+    # unquoted braces are expanded by the shell into several targets for the same image
+    for targets in target_sets:
+        names = [re_match(r"[a-zA-Z0-9-]*", t).group() for t in targets]
+        for duplicate in sorted({n for n in names if names.count(n) > 1}):
+            logger.warning(
+                "'{}' is targeted more than once in '{}'. Quote brace alternatives (e.g. \"{{a,b}}\") to build "
+                "several images.".format(duplicate, " ".join(targets))
+            )
+    recipes = [imageRepo.get_build_recipe(targets) for targets in target_sets]
 
     # print build specs
-    header_print([TextBlock("Build Order:")])
-    for r in recipe:
-        indent_print([TextBlock(f"{r.name}@{r.version}-{r.id}", fore=Fore.MAGENTA, style=Style.BRIGHT)])
-    print()  # newline
+    for recipe in recipes:
+        header_print([TextBlock("Build Order:")])
+        for r in recipe:
+            indent_print([TextBlock(f"{r.name}@{r.version}-{r.id}", fore=Fore.MAGENTA, style=Style.BRIGHT)])
+        print()  # newline
 
     # prep builder
     builder = ImageBuilder(
-        recipe,
-        build_name=args.name,
+        recipes,
+        build_name=[args.name] * len(recipes),
         dry_run=args.dry_run,
         remove_tags=not args.leave_tags,
         verbose=args.verbose,
@@ -246,6 +306,51 @@ elif args.subcommand == "spec":
     for tl in top_level_entries:
         spec_print(tl.name, 0, flat_dep_tree, recipe)
     print()  # add newline
+
+elif args.subcommand == "matrix":
+    from json import dumps as json_dumps
+    from velocity._matrix import resolve_matrix
+
+    document = json_dumps(resolve_matrix(imageRepo, args.target_sets), indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as fo:
+            fo.write(document + "\n")
+    else:
+        print(document)
+
+elif args.subcommand == "cache":
+    from datetime import datetime
+    from velocity._layers import LayerStore, format_size, parse_size
+
+    store = LayerStore.from_config()
+    if store is None:
+        print("The layer cache is disabled (set velocity:layer_cache:path to enable it).")
+    elif args.action == "prune":
+        for key in store.prune(None if args.size is None else parse_size(args.size)):
+            indent_print([TextBlock("EVICTED: ", fore=Fore.YELLOW, style=Style.BRIGHT), TextBlock(key)])
+        print()  # add newline
+    else:
+        layers = store.entries()
+        header_print(
+            [
+                TextBlock(str(store.path), fore=Fore.MAGENTA, style=Style.BRIGHT),
+                TextBlock(
+                    " ({} of {} in {} layers)".format(
+                        format_size(sum(layer["size"] for layer in layers)), format_size(store.quota), len(layers)
+                    )
+                ),
+            ]
+        )
+        for layer in layers:
+            indent_print(
+                [
+                    TextBlock(layer["key"][:12], fore=Fore.RED, style=Style.BRIGHT),
+                    TextBlock(" {} ".format(format_size(layer["size"]).rjust(7))),
+                    TextBlock(layer["name"], fore=Fore.MAGENTA, style=Style.BRIGHT),
+                    TextBlock(" (last used {:%Y-%m-%d %H:%M})".format(datetime.fromtimestamp(layer["used"]))),
+                ]
+            )
+        print()  # add newline
 else:
     parser.print_help()
     print()  # add newline
@@ -52,6 +52,8 @@ class Backend(metaclass=OurABCMeta):
 
     name: str = "backend"
     executable: str = "true"
+    # images are single files that can be kept in the layer cache
+    file_layers: bool = False
 
     @classmethod
     @trace_function
@@ -269,6 +271,7 @@ class Apptainer(Backend):
 
     name = "apptainer"
     executable = "apptainer"
+    file_layers = True
 
     def _from(self, contents: list[str]) -> list[str]:
         ret: list[str] = list()
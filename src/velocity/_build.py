@@ -1,13 +1,20 @@
 """Build velocity images."""
 
 from datetime import datetime, timedelta
-from os import chdir, cpu_count
+from hashlib import sha256
+from codecs import getincrementaldecoder
+from collections import deque
+from contextlib import nullcontext
+from gzip import GzipFile
+from typing import BinaryIO
+from io import IncrementalNewlineDecoder
+from os import chdir, cpu_count, read as os_read
 from pathlib import Path
 from platform import processor as arch
-from shutil import copy as shutil_copy, copytree, rmtree
-from threading import Thread
+from shutil import rmtree
+from time import monotonic
 from timeit import default_timer as timer
-from queue import SimpleQueue
+from selectors import EVENT_READ, DefaultSelector
 from subprocess import PIPE, Popen
 
 from colorama import Fore, Style
@@ -17,89 +24,188 @@ from velocity._config import config
 from velocity._graph import Image
 from velocity._print import TextBlock, header_print, indent_print
 from velocity._backends import Backend, get_backend
+from velocity._layers import LayerStore
+from velocity._stage import stage_files
 from velocity._tools import OurMeta, trace_function
 
 
-@trace_function
-def read_pipe(pipe: PIPE, topic: SimpleQueue, prefix: str, log: SimpleQueue) -> None:
-    """Read a subprocess PIPE and place lines on topic queue and log queue."""
-    while True:
-        ln = pipe.readline()
-        if ln == "":
-            break
-        else:
-            topic.put(ln.strip("\n"))
-            log.put("{} {}".format(prefix, ln.strip("\n")))
+def _zstd_writer(path: Path) -> BinaryIO:
+    """Open a streaming zstd writer with the standard library (python 3.14+) or the optional zstandard package."""
+    try:
+        from compression.zstd import ZstdFile
+
+        return ZstdFile(path, "w")
+    except ImportError:
+        from zstandard import ZstdCompressor
+
+        return ZstdCompressor().stream_writer(open(path, "wb"))
+
+
+class BuildLog(metaclass=OurMeta):
+    """Build log file. Lines are buffered until buffer_size bytes are pending or the oldest pending line is
+    flush_interval seconds old. The log can be compressed with gzip or zstd, which adds .gz or .zst to the path."""
+
+    buffer_size: int = 1 << 20
+    flush_interval: float = 5.0
+
+    def __init__(self, path: Path, compression: str = None) -> None:
+        compression = "none" if compression is None else str(compression).lower()
+        if compression == "zstd":
+            try:
+                self._file: BinaryIO = _zstd_writer(Path("{}.zst".format(path)))
+                self.path: Path = Path("{}.zst".format(path))
+            except ImportError:
+                logger.warning("Install zstandard to compress logs with zstd. Using gzip instead.")
+                compression = "gzip"
+        if compression == "gzip":
+            self.path = Path("{}.gz".format(path))
+            self._file = GzipFile(self.path, "wb")
+        elif compression == "none":
+            self.path = Path(path)
+            self._file = open(self.path, "wb")
+        elif compression != "zstd":
+            raise ValueError("Unknown log compression '{}'!".format(compression))
+        self._pending: list[bytes] = list()
+        self._size: int = 0
+        self._oldest: float | None = None
+
+    def write(self, text: str) -> None:
+        """Add text to the log."""
+        data = text.encode()
+        self._pending.append(data)
+        self._size += len(data)
+        if self._oldest is None:
+            self._oldest = monotonic()
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def timeout(self) -> float | None:
+        """Seconds until the pending lines have to be written (None if nothing is pending)."""
+        return None if self._oldest is None else max(0.0, self._oldest + self.flush_interval - monotonic())
+
+    def flush_due(self) -> None:
+        """Write the pending lines if they are due."""
+        if self._oldest is not None and self.timeout() == 0:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the pending lines."""
+        if self._oldest is None:
+            return
+        self._file.write(b"".join(self._pending))
+        self._file.flush()
+        self._pending.clear()
+        self._size = 0
+        self._oldest = None
+
+    def close(self) -> None:
+        """Write the pending lines and close the log."""
+        self.flush()
+        self._file.close()
+
+    def __enter__(self) -> "BuildLog":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
 
 
 @trace_function
 def run(cmd: str, log_file: Path = None, verbose: bool = False) -> None:
-    """Run a system command logging all output to a file and print if verbose."""
-    # open log file (set to False if none is provided)
-    logger.debug("Running command: {}".format(cmd))
-    file = open(log_file, "w") if log_file is not None else False
-
-    log = SimpleQueue()
-    stdout = SimpleQueue()
-    stderr = SimpleQueue()
-
-    process = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, universal_newlines=True)
-
-    out = Thread(target=read_pipe, args=(process.stdout, stdout, "STDOUT:", log))
-    err = Thread(target=read_pipe, args=(process.stderr, stderr, "STDERR:", log))
+    """Run a system command logging all output to a file and print if verbose.
 
-    out.start()
-    err.start()
-
-    # loop for real time output
-    while process.poll() is None:
-        if verbose and not stdout.empty():
-            indent_print([TextBlock(stdout.get(), fore=Fore.GREEN, style=Style.DIM)])
-        if file and not log.empty():
-            file.write(log.get() + "\n")
-            file.flush()  # TODO is this needed?
-
-    out.join()
-    err.join()
-
-    # clear stdout & log
-    if verbose:
-        while not stdout.empty():
-            indent_print([TextBlock(stdout.get(), fore=Fore.GREEN, style=Style.DIM)])
-
-    if file:
-        while not log.empty():
-            file.write(log.get() + "\n")
-            file.flush()  # TODO is this needed?
-        file.close()
+    Stdout and stderr are multiplexed with a selector so waiting on a long build does not use any cpu or extra threads.
+    Only the last velocity:stderr_lines lines of stderr are kept (to print if the command fails), the full output is
+    only in the log.
+    """
+    # open log file (set to None if none is provided)
+    logger.debug("Running command: {}".format(cmd))
+    file = BuildLog(log_file, config.get("velocity:log_compression")) if log_file is not None else None
+    errors: deque[str] = deque(maxlen=max(0, int(config.get("velocity:stderr_lines"))))
+    error_count: int = 0
+
+    process = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+
+    # the log is closed (which writes whatever is still buffered) however the command ends
+    with file if file is not None else nullcontext(), DefaultSelector() as selector:
+        # decode like universal_newlines would
+        for pipe, prefix in ((process.stdout, "STDOUT:"), (process.stderr, "STDERR:")):
+            decoder = IncrementalNewlineDecoder(getincrementaldecoder("utf-8")("replace"), translate=True)
+            selector.register(pipe, EVENT_READ, [prefix, decoder, ""])
+        while len(selector.get_map()) > 0:
+            # wake up when buffered log lines are due even if the command is quiet
+            for key, _ in selector.select(file.timeout() if file is not None else None):
+                prefix, decoder, partial = key.data
+                data = os_read(key.fd, 65536)
+                lines = (partial + decoder.decode(data, final=len(data) == 0)).split("\n")
+                # keep the unfinished last line until the rest of it arrives or the pipe is closed
+                key.data[2] = lines.pop()
+                if len(data) == 0:
+                    selector.unregister(key.fileobj)
+                    if key.data[2] != "":
+                        lines.append(key.data[2])
+                for ln in lines:
+                    if prefix == "STDOUT:":
+                        if verbose:
+                            indent_print([TextBlock(ln, fore=Fore.GREEN, style=Style.DIM)])
+                    else:
+                        errors.append(ln)
+                        error_count += 1
+                if file is not None and len(lines) > 0:
+                    file.write("".join("{} {}\n".format(prefix, ln) for ln in lines))
+            if file is not None:
+                file.flush_due()
+
+    process.stdout.close()
+    process.stderr.close()
 
     # if an error was encountered exit with the subprocess exit code
-    if process.poll() != 0:
-        while stderr.qsize():
-            indent_print([TextBlock(stderr.get(), fore=Fore.RED, style=Style.DIM)])
-        exit(process.poll())
+    if process.wait() != 0:
+        if error_count > len(errors):
+            hidden = "... {} earlier lines of stderr".format(error_count - len(errors))
+            if file is not None:
+                hidden += " are in {}".format(file.path)
+            indent_print([TextBlock(hidden, fore=Fore.RED, style=Style.DIM)])
+        for ln in errors:
+            indent_print([TextBlock(ln, fore=Fore.RED, style=Style.DIM)])
+        exit(process.returncode)
 
 
 class ImageBuilder(metaclass=OurMeta):
-    """Image building class."""
+    """Image building class.
+
+    Several recipes can be built at once (pass a list of recipes and optionally a list of names). They are merged into
+    a prefix tree keyed by image id so the images they share are only built once and every recipe branches off the
+    last image it shares with the others.
+    """
 
     def __init__(
         self,
-        bt: tuple[Image],
-        build_name: str = None,
+        bt: tuple[Image] | list[tuple[Image]],
+        build_name: str | list[str] = None,
         dry_run: bool = False,
         remove_tags: bool = True,
         clean_build_dir: bool = False,
         verbose: bool = False,
     ) -> None:
-        self.build_units: tuple[Image] = bt
-        self.build_name: str = build_name
+        self.recipes: list[tuple[Image]] = (
+            [tuple(bt)] if not any(isinstance(u, (tuple, list)) for u in bt) else [tuple(r) for r in bt]
+        )
+        self.build_names: list[str] = (
+            list(build_name) if isinstance(build_name, list) else [build_name] * len(self.recipes)
+        )
+        if len(self.build_names) != len(self.recipes):
+            raise ValueError("Got {} names for {} recipes!".format(len(self.build_names), len(self.recipes)))
         self.dry_run: bool = dry_run
         self.remove_tags: bool = remove_tags
         self.clean_build_dir: bool = clean_build_dir
         self.verbose: bool = verbose
 
         self.backend_engine: Backend = get_backend()
+        # layers built by anyone sharing the store are reused instead of being rebuilt
+        self.layer_store: LayerStore | None = (
+            LayerStore.from_config() if self.backend_engine.file_layers and not self.dry_run else None
+        )
 
         # create build_dir if it does not exist
         self.build_dir = Path(config.get("velocity:build_dir"))
@@ -112,12 +218,79 @@ class ImageBuilder(metaclass=OurMeta):
             "__arch__": arch(),
             "__timestamp__": str(datetime.now()),
         }
-        for u in self.build_units:
-            self.variables["__{}__version__".format(u.name)] = str(u.version)
-            self.variables["__{}__version_major__".format(u.name)] = str(u.version.major)
-            self.variables["__{}__version_minor__".format(u.name)] = str(u.version.minor)
-            self.variables["__{}__version_patch__".format(u.name)] = str(u.version.patch)
-            self.variables["__{}__version_suffix__".format(u.name)] = str(u.version.suffix)
+
+    @staticmethod
+    def _recipe_variables(recipe: tuple[Image]) -> dict[str, str]:
+        """Get the version variables of every image in a recipe."""
+        variables: dict[str, str] = dict()
+        for u in recipe:
+            variables["__{}__version__".format(u.name)] = str(u.version)
+            variables["__{}__version_major__".format(u.name)] = str(u.version.major)
+            variables["__{}__version_minor__".format(u.name)] = str(u.version.minor)
+            variables["__{}__version_patch__".format(u.name)] = str(u.version.patch)
+            variables["__{}__version_suffix__".format(u.name)] = str(u.version.suffix)
+        return variables
+
+    @staticmethod
+    def _referenced(unit: Image, names: set[str]) -> list[str]:
+        """Get the variables in names that the template or prolog of an image mention."""
+        template = Path(unit.path).joinpath("templates", "{}.vtmp".format(unit.template))
+        text = (template.read_text() if template.is_file() else "") + (unit.prolog or "")
+        return sorted(n for n in names if n in text)
+
+    def _prefix_tree(self) -> dict:
+        """Merge the recipes into a prefix tree keyed by image id.
+
+        Every node is a dict with its image, layer (the image id, made unique by the path to it if the image is built
+        on top of different prefixes), variables (those of the first recipe through the node, so every layer sees the
+        same variables as in a single recipe build), the indexes of the recipes that end at the node and its children.
+        Recipes only share a node if they agree on every variable its template or prolog mentions.
+        """
+        recipe_variables = [self._recipe_variables(recipe) for recipe in self.recipes]
+        names: set[str] = set().union(*recipe_variables)
+        referenced: dict[str, list[str]] = dict()
+
+        root: dict = {"image": None, "layer": None, "recipes": list(), "final": list(), "children": dict()}
+        paths: dict[str, set[tuple]] = dict()
+        for idx, recipe in enumerate(self.recipes):
+            node = root
+            path: tuple = tuple()
+            for u in recipe:
+                if u.id not in referenced:
+                    referenced[u.id] = self._referenced(u, names)
+                child = (u.id, tuple((n, recipe_variables[idx].get(n)) for n in referenced[u.id]))
+                path += (child,)
+                if child not in node["children"]:
+                    node["children"][child] = {
+                        "image": u,
+                        "path": path,
+                        "recipes": list(),
+                        "final": list(),
+                        "children": dict(),
+                    }
+                    paths.setdefault(u.id, set()).add(path)
+                node = node["children"][child]
+                node["recipes"].append(idx)
+            node["final"].append(idx)
+
+        stack: list[dict] = list(root["children"].values())
+        while len(stack) > 0:
+            node = stack.pop()
+            image = node["image"]
+            path = node.pop("path")
+            node["layer"] = (
+                image.id
+                if len(paths[image.id]) == 1
+                else "{}-{}".format(
+                    image.id,
+                    sha256(
+                        "/".join(i + "".join(",{}={}".format(n, v) for n, v in sig) for i, sig in path).encode()
+                    ).hexdigest()[:7],
+                )
+            )
+            node["variables"] = recipe_variables[node["recipes"][0]]
+            stack.extend(node["children"].values())
+        return root
 
     def build(self) -> None:
         """Launch image builds."""
@@ -132,21 +305,42 @@ class ImageBuilder(metaclass=OurMeta):
                 else:
                     entry.unlink()
 
-        last = str()  # last image that was built
+        root = self._prefix_tree()
         build_names: list[str] = list()
-        for u in self.build_units:
+        for idx in root["final"]:
+            self._build_final(idx, str(), pwd)
+        # depth first so every recipe is done as soon as possible and each branch starts from its shared prefix
+        stack: list[tuple[dict, str, str | None]] = [
+            (child, str(), None) for child in reversed(root["children"].values())
+        ]
+        while len(stack) > 0:
+            node, last, parent_key = stack.pop()
+            u = node["image"]
             name = self.backend_engine.format_image_name(
-                Path.joinpath(self.build_dir, "{}-{}-{}".format(u.name, u.version, u.id)), u.id
+                Path.joinpath(self.build_dir, "{}-{}-{}".format(u.name, u.version, node["layer"])), node["layer"]
             )
-            self._build_image(u, last, name)
-            last = name
+            # the key covers every image below this one so a layer is only reused on top of the same layers
+            key = LayerStore.key(parent_key, u, self.backend_engine.name)
+            self._build_image(u, last, name, node["layer"], node["variables"], key)
             build_names.append(name)
+            for idx in node["final"]:
+                self._build_final(idx, name, pwd)
+            stack.extend((child, name, key) for child in reversed(node["children"].values()))
 
+        if not self.dry_run and self.remove_tags:
+            for bn in build_names:
+                run(self.backend_engine.clean_up_old_image(bn))
+
+        # go back to the starting dir
+        chdir(pwd)
+
+    def _build_final(self, idx: int, last: str, pwd: Path) -> None:
+        """Create the final image of a recipe from the last image that was built for it."""
         tag = str(
-            self.build_name
-            if self.build_name is not None
+            self.build_names[idx]
+            if self.build_names[idx] is not None
             else "{}_{}-{}".format(
-                "_".join(f"{bu.name}-{bu.version}" for bu in reversed(self.build_units)),
+                "_".join(f"{bu.name}-{bu.version}" for bu in reversed(self.recipes[idx])),
                 config.get("velocity:system"),
                 config.get("velocity:distro"),
             )
@@ -157,14 +351,9 @@ class ImageBuilder(metaclass=OurMeta):
             run(self.backend_engine.generate_final_image_cmd(last, final_name))
         header_print([TextBlock("BUILT: "), TextBlock(final_name, fore=Fore.MAGENTA, style=Style.BRIGHT)])
 
-        if not self.dry_run and self.remove_tags:
-            for bn in build_names:
-                run(self.backend_engine.clean_up_old_image(bn))
-
-        # go back to the starting dir
-        chdir(pwd)
-
-    def _build_image(self, unit: Image, src_image: str, name: str):
+    def _build_image(
+        self, unit: Image, src_image: str, name: str, layer: str, variables: dict[str, str], key: str = None
+    ):
         """Build an individual image."""
         # print start of build
         header_print(
@@ -179,7 +368,7 @@ class ImageBuilder(metaclass=OurMeta):
         start = timer()
 
         # create build dir and go to it
-        build_sub_dir = Path.joinpath(self.build_dir, "{}-{}-{}".format(unit.name, unit.version, unit.id))
+        build_sub_dir = Path.joinpath(self.build_dir, "{}-{}-{}".format(unit.name, unit.version, layer))
         build_sub_dir.mkdir(mode=0o744, exist_ok=True)
         chdir(build_sub_dir)
 
@@ -201,10 +390,22 @@ class ImageBuilder(metaclass=OurMeta):
                             TextBlock(str(Path.joinpath(build_sub_dir, entry).absolute()), fore=Fore.GREEN),
                         ]
                     )
-                if Path.joinpath(unit.path, "files", entry).is_dir():
-                    copytree(Path.joinpath(unit.path, "files", entry), Path.joinpath(build_sub_dir, entry))
-                else:
-                    shutil_copy(Path.joinpath(unit.path, "files", entry), Path.joinpath(build_sub_dir, entry))
+            # only what changed since the last build is copied (or linked)
+            staging_start = timer()
+            staged = stage_files(
+                [
+                    (Path.joinpath(unit.path, "files", entry), Path.joinpath(build_sub_dir, entry))
+                    for entry in unit.files
+                ]
+            )
+            summary = "{copied} copied, {linked} linked, {unchanged} unchanged, {removed} removed".format(**staged)
+            header_print(
+                [
+                    TextBlock(unit.id, fore=Fore.RED, style=Style.BRIGHT),
+                    TextBlock(": FILES STAGED ({}, {:.1f} MB) ".format(summary, staged["bytes"] / 1e6)),
+                    TextBlock("[{:.1f}s]".format(timer() - staging_start), fore=Fore.MAGENTA, style=Style.BRIGHT),
+                ]
+            )
 
         # parse template and create script...
         header_print([TextBlock(unit.id, fore=Fore.RED, style=Style.BRIGHT), TextBlock(": GENERATING SCRIPT ...")])
@@ -229,6 +430,7 @@ class ImageBuilder(metaclass=OurMeta):
         if src_image is not None:
             script_variables.update({"__base__": src_image})
         script_variables.update(self.variables)
+        script_variables.update(variables)
         # curate velocity variables
         self.backend_engine.curate_variables(script_variables)
         # apply user variables
@@ -283,13 +485,24 @@ class ImageBuilder(metaclass=OurMeta):
         build_file_path.chmod(0o744)
 
         if not self.dry_run:
-            if self.backend_engine.build_exists(name):
-                if self.verbose:
-                    indent_print(
-                        [TextBlock("Using cached image {} ...".format(name), fore=Fore.GREEN, style=Style.DIM)]
+            # hold the layer while building it so concurrent builds of the same layer wait for the first one
+            with self.layer_store.lock(key) if self.layer_store is not None and key is not None else nullcontext():
+                if self.layer_store is not None and not self.backend_engine.build_exists(name):
+                    if self.layer_store.fetch(key, Path(name)):
+                        self.backend_engine.existing_builds_cache.pop(name, None)
+                if self.backend_engine.build_exists(name):
+                    if self.verbose:
+                        indent_print(
+                            [TextBlock("Using cached image {} ...".format(name), fore=Fore.GREEN, style=Style.DIM)]
+                        )
+                else:
+                    run(
+                        str(build_file_path.absolute()),
+                        log_file=Path.joinpath(build_sub_dir, "log"),
+                        verbose=self.verbose,
                     )
-            else:
-                run(str(build_file_path.absolute()), log_file=Path.joinpath(build_sub_dir, "log"), verbose=self.verbose)
+                    if self.layer_store is not None and key is not None:
+                        self.layer_store.publish(key, Path(name), "{}@{}".format(unit.name, unit.version))
 
         end = timer()
 
@@ -0,0 +1,57 @@
+"""On-disk caches. Cache files are json written atomically. A missing, stale or unreadable cache is never an error."""
+
+from loguru import logger
+from hashlib import sha256
+from json import dumps as json_dumps, load as json_load
+from os import replace, stat
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+from ._config import config
+from ._tools import trace_function
+
+# bump whenever the layout of cached data (or the identity of images) changes
+CACHE_FORMAT: int = 2
+
+
+@trace_function
+def cache_path(kind: str, *key: str) -> Path:
+    """Get the path of the cache file of a given kind for a key."""
+    digest = sha256("\0".join(str(k) for k in key).encode()).hexdigest()[:16]
+    return Path(config.get("velocity:cache_dir")).joinpath(kind, "{}.json".format(digest))
+
+
+@trace_function
+def file_stamp(path: Path) -> list[int] | None:
+    """Get the modification time and size of a file or None if it cannot be read."""
+    try:
+        st = stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+@trace_function
+def read_cache(path: Path) -> dict | list | None:
+    """Read a cache file. Return None if it does not exist or is invalid."""
+    try:
+        with open(path, "r") as fi:
+            content = json_load(fi)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(content, dict) or content.get("format") != CACHE_FORMAT:
+        return None
+    return content.get("data")
+
+
+@trace_function
+def write_cache(path: Path, data: dict | list) -> None:
+    """Atomically write a cache file. Failures are logged and otherwise ignored."""
+    try:
+        content = json_dumps({"format": CACHE_FORMAT, "data": data})
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with NamedTemporaryFile("w", dir=path.parent, prefix=".", suffix=".tmp", delete=False) as fo:
+            fo.write(content)
+        replace(fo.name, path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.debug("Could not write cache file '{}': {}".format(path, e))
@@ -5,7 +5,7 @@ from loguru import logger
 from os import getenv
 from platform import processor as arch
 from pathlib import Path
-from yaml import safe_load as yaml_safe_load
+from typing import Callable
 
 from velocity._exceptions import InvalidConfigIdentifier
 from velocity._tools import OurMeta
@@ -14,11 +14,20 @@ from velocity._tools import OurMeta
 class Config(metaclass=OurMeta):
     """Configuration class. Stores configuration as a dictionary."""
 
-    def __init__(self) -> None:
+    def __init__(self, defaults: Callable[["Config"], None] | None = None) -> None:
         self._config = dict()
+        # called with this config right before it is first used
+        self._defaults = defaults
+
+    def _load_defaults(self) -> None:
+        """Run the defaults hook if it has not run yet."""
+        if self._defaults is not None:
+            defaults, self._defaults = self._defaults, None
+            defaults(self)
 
     def set(self, item: str, value: int | bool | str | list | dict | None) -> None:
         """Set configuration property."""
+        self._load_defaults()
         try:
             # do not let user set the root node
             if item != "":
@@ -42,6 +51,7 @@ class Config(metaclass=OurMeta):
 
     def get(self, item: str, warn_on_miss=True) -> int | bool | str | list | dict | None:
         """Get configuration property. Return None if not found"""
+        self._load_defaults()
         try:
             if item != "":
                 parts: list[str] = item.split(":")
@@ -67,6 +77,8 @@ class Config(metaclass=OurMeta):
         """Load configuration."""
         if self.get("velocity:config_dir") is None:
             self.set("velocity:config_dir", Path.home().joinpath(".velocity").__str__())
+        from yaml import safe_load as yaml_safe_load  # only needed once there is a config file to read
+
         config_dir = Path(self.get("velocity:config_dir"))
         try:
             with open(config_dir.joinpath("config.yaml"), "r") as fi:
@@ -77,54 +89,86 @@ class Config(metaclass=OurMeta):
             logger.warning("Could not load configuration file from '{}'!".format(config_dir.joinpath("config.yaml")))
 
     def __str__(self) -> str:
+        self._load_defaults()
         return str(self._config)
 
 
-# default configuration & singleton
-_config = Config()
-if getenv("VELOCITY_CONFIG_DIR") is not None:
-    _config.set("velocity:config_dir", getenv("VELOCITY_CONFIG_DIR"))
-_config.load()
+def _default_config(c: Config) -> None:
+    """Load the configuration file, environment variables and defaults into c."""
+    if getenv("VELOCITY_CONFIG_DIR") is not None:
+        c.set("velocity:config_dir", getenv("VELOCITY_CONFIG_DIR"))
+    c.load()
+
+    # get config from environment variables
+    if getenv("VELOCITY_SYSTEM") is not None:
+        c.set("velocity:system", getenv("VELOCITY_SYSTEM"))
+
+    if getenv("VELOCITY_BACKEND") is not None:
+        c.set("velocity:backend", getenv("VELOCITY_BACKEND"))
+
+    if getenv("VELOCITY_DISTRO") is not None:
+        c.set("velocity:distro", getenv("VELOCITY_DISTRO"))
+
+    if getenv("VELOCITY_IMAGE_PATH") is not None:
+        c.set("velocity:image_path", getenv("VELOCITY_IMAGE_PATH"))
+
+    if getenv("VELOCITY_BUILD_DIR") is not None:
+        c.set("velocity:build_dir", getenv("VELOCITY_BUILD_DIR"))
+
+    if getenv("VELOCITY_CACHE_DIR") is not None:
+        c.set("velocity:cache_dir", getenv("VELOCITY_CACHE_DIR"))
+
+    if getenv("VELOCITY_LOG_COMPRESSION") is not None:
+        c.set("velocity:log_compression", getenv("VELOCITY_LOG_COMPRESSION"))
+
+    if getenv("VELOCITY_STDERR_LINES") is not None:
+        c.set("velocity:stderr_lines", getenv("VELOCITY_STDERR_LINES"))
+
+    if getenv("VELOCITY_LAYER_CACHE") is not None:
+        c.set("velocity:layer_cache:path", getenv("VELOCITY_LAYER_CACHE"))
+
+    if getenv("VELOCITY_LAYER_CACHE_SIZE") is not None:
+        c.set("velocity:layer_cache:size", getenv("VELOCITY_LAYER_CACHE_SIZE"))
+
+    if getenv("VELOCITY_LOGGING_LEVEL") is not None:
+        c.set("velocity:logging:level", getenv("VELOCITY_LOGGING_LEVEL"))
 
-# get config from environment variables
-if getenv("VELOCITY_SYSTEM") is not None:
-    _config.set("velocity:system", getenv("VELOCITY_SYSTEM"))
+    # set defaults for un-configured items
+    if c.get("velocity:system", warn_on_miss=False) is None:
+        c.set("velocity:system", arch())
 
-if getenv("VELOCITY_BACKEND") is not None:
-    _config.set("velocity:backend", getenv("VELOCITY_BACKEND"))
+    if c.get("velocity:backend", warn_on_miss=False) is None:
+        c.set("velocity:backend", "apptainer")
 
-if getenv("VELOCITY_DISTRO") is not None:
-    _config.set("velocity:distro", getenv("VELOCITY_DISTRO"))
+    if c.get("velocity:distro", warn_on_miss=False) is None:
+        c.set("velocity:distro", "ubuntu")
 
-if getenv("VELOCITY_IMAGE_PATH") is not None:
-    _config.set("velocity:image_path", getenv("VELOCITY_IMAGE_PATH"))
+    if c.get("velocity:logging:level", warn_on_miss=False) is None:
+        c.set("velocity:logging:level", "WARNING")
 
-if getenv("VELOCITY_BUILD_DIR") is not None:
-    _config.set("velocity:build_dir", getenv("VELOCITY_BUILD_DIR"))
+    if c.get("velocity:image_path", warn_on_miss=False) is None:
+        image_dir = Path.home().joinpath(".velocity", "images")
+        image_dir.mkdir(parents=True, exist_ok=True)
+        c.set("velocity:image_path", image_dir.__str__())
 
-if getenv("VELOCITY_LOGGING_LEVEL") is not None:
-    _config.set("velocity:logging:level", getenv("VELOCITY_LOGGING_LEVEL"))
+    if c.get("velocity:build_dir", warn_on_miss=False) is None:
+        c.set("velocity:build_dir", Path("/tmp").joinpath(getuser(), "velocity").__str__())
 
-# set defaults for un-configured items
-if _config.get("velocity:system", warn_on_miss=False) is None:
-    _config.set("velocity:system", arch())
+    if c.get("velocity:cache_dir", warn_on_miss=False) is None:
+        c.set("velocity:cache_dir", Path(c.get("velocity:config_dir")).joinpath("cache").__str__())
 
-if _config.get("velocity:backend", warn_on_miss=False) is None:
-    _config.set("velocity:backend", "apptainer")
+    if c.get("velocity:log_compression", warn_on_miss=False) is None:
+        c.set("velocity:log_compression", "none")
 
-if _config.get("velocity:distro", warn_on_miss=False) is None:
-    _config.set("velocity:distro", "ubuntu")
+    if c.get("velocity:stderr_lines", warn_on_miss=False) is None:
+        c.set("velocity:stderr_lines", 100)
 
-if _config.get("velocity:logging:level", warn_on_miss=False) is None:
-    _config.set("velocity:logging:level", "WARNING")
+    if c.get("velocity:layer_cache:size", warn_on_miss=False) is None:
+        c.set("velocity:layer_cache:size", "100G")
 
-if _config.get("velocity:image_path", warn_on_miss=False) is None:
-    image_dir = Path.home().joinpath(".velocity", "images")
-    image_dir.mkdir(parents=True, exist_ok=True)
-    _config.set("velocity:image_path", image_dir.__str__())
 
-if _config.get("velocity:build_dir", warn_on_miss=False) is None:
-    _config.set("velocity:build_dir", Path("/tmp").joinpath(getuser(), "velocity").__str__())
+# default configuration & singleton (loaded on first use so importing velocity has no side effects)
+_config = Config(_default_config)
 
 # export
 config = _config
@@ -0,0 +1,460 @@
+"""Image dependency graph. Kept apart from _graph so that networkx is only imported once a graph is needed."""
+
+from networkx import (
+    DiGraph as nx_DiGraph,
+    topological_sort as nx_topological_sort,
+    NetworkXUnfeasible,
+    find_cycle as nx_find_cycle,
+)
+from ._exceptions import CannotFindDependency, EdgeViolatesDAG, NoAvailableBuild
+from ._graph import DepOp, Image, Target
+from ._tools import OurMeta
+
+
+class ImageGraph(nx_DiGraph, metaclass=OurMeta):
+    """Image dependency graph."""
+
+    def __init__(self, **kwargs) -> None:
+        # indexes (must exist before networkx adds any incoming graph data)
+        self._canonical: dict[Image, Image] = dict()  # the node object stored in the graph for each image
+        self._by_name: dict[str, set[Image]] = dict()  # nodes grouped by image name
+        self._dependency_groups: dict[Image, dict[str, set[Image]]] = dict()  # dependencies grouped by image name
+        self._order: dict[Image, int] = dict()  # topological order, u comes before v for every edge u -> v
+        self._next_order: int = 0
+        self._reach: dict[Image, int] | None = None  # transitive closure (see _reachable)
+        super().__init__(**kwargs)
+
+    def _index_node(self, node: Image) -> None:
+        """Add a node to the indexes."""
+        if node not in self._canonical:
+            self._reach = None
+            self._canonical[node] = node
+            self._by_name.setdefault(node.name, set()).add(node)
+            self._dependency_groups[node] = dict()
+            self._order[node] = self._next_order
+            self._next_order += 1
+
+    def _index_edge(self, u_of_edge: Image, v_of_edge: Image) -> None:
+        """Add an edge to the indexes."""
+        self._reach = None
+        v_node = self._canonical[v_of_edge]
+        self._dependency_groups[u_of_edge].setdefault(v_node.name, set()).add(v_node)
+
+    def add_node(self, node_for_adding: Image, **attr) -> None:
+        super().add_node(node_for_adding, **attr)
+        self._index_node(node_for_adding)
+
+    def add_nodes_from(self, nodes_for_adding, **attr) -> None:
+        nodes_for_adding = list(nodes_for_adding)
+        super().add_nodes_from(nodes_for_adding, **attr)
+        for n in nodes_for_adding:
+            self._index_node(n[0] if isinstance(n, tuple) else n)
+
+    def _update_order(self, u_of_edge: Image, v_of_edge: Image) -> list[tuple[Image, Image]] | None:
+        """Update the topological order after adding the edge u -> v (Pearce-Kelly). Only the nodes ordered between v
+        and u are visited. Return the cycle if the edge violates the DAG requirement."""
+        lower: int = self._order[v_of_edge]
+        upper: int = self._order[u_of_edge]
+        if lower > upper:
+            return None
+        if u_of_edge == v_of_edge:
+            return [(u_of_edge, v_of_edge)]
+
+        # nodes below v that are not yet ordered after u
+        forward: list[Image] = list()
+        parents: dict[Image, Image | None] = {v_of_edge: None}
+        stack: list[Image] = [v_of_edge]
+        while len(stack) > 0:
+            node = stack.pop()
+            forward.append(node)
+            for s in self._succ[node]:
+                if s == u_of_edge:
+                    # v reaches u so the new edge closes a cycle
+                    path: list[Image] = [node]
+                    while parents[path[-1]] is not None:
+                        path.append(parents[path[-1]])
+                    path.reverse()
+                    cycle = [(u_of_edge, v_of_edge)]
+                    cycle.extend(zip(path, path[1:] + [u_of_edge]))
+                    return cycle
+                if s not in parents and self._order[s] < upper:
+                    parents[s] = node
+                    stack.append(s)
+
+        # nodes above u that are not yet ordered before v
+        backward: list[Image] = list()
+        visited: set[Image] = {u_of_edge}
+        stack = [u_of_edge]
+        while len(stack) > 0:
+            node = stack.pop()
+            backward.append(node)
+            for p in self._pred[node]:
+                if p not in visited and self._order[p] > lower:
+                    visited.add(p)
+                    stack.append(p)
+
+        # reuse the positions of the affected nodes placing everything above u before everything below v
+        backward.sort(key=lambda n: self._order[n])
+        forward.sort(key=lambda n: self._order[n])
+        positions = sorted(self._order[n] for n in backward + forward)
+        for node, position in zip(backward + forward, positions):
+            self._order[node] = position
+        return None
+
+    def add_edge(self, u_of_edge: Image, v_of_edge: Image, **kwargs) -> None:
+        # check that edge endpoints are in graph
+        if self.has_node(u_of_edge) and self.has_node(v_of_edge):
+            super().add_edge(u_of_edge, v_of_edge, **kwargs)
+            self._index_edge(u_of_edge, v_of_edge)
+        else:
+            raise CannotFindDependency("Cannot find dependency {} for {}".format(v_of_edge, u_of_edge))
+
+        # check that graph is still a DAG
+        cycle = self._update_order(u_of_edge, v_of_edge)
+        if cycle is not None:
+            raise EdgeViolatesDAG(u_of_edge, v_of_edge, cycle)
+
+    def add_edges_from(self, ebunch_to_add, **attr) -> None:
+        """Add many edges at once. The DAG requirement is checked once for the whole batch."""
+        ebunch_to_add = list(ebunch_to_add)
+        # check that edge endpoints are in graph
+        for e in ebunch_to_add:
+            if not (self.has_node(e[0]) and self.has_node(e[1])):
+                raise CannotFindDependency("Cannot find dependency {} for {}".format(e[1], e[0]))
+        super().add_edges_from(ebunch_to_add, **attr)
+        for e in ebunch_to_add:
+            self._index_edge(e[0], e[1])
+
+        # check that graph is still a DAG and rebuild the topological order
+        try:
+            for position, node in enumerate(nx_topological_sort(self)):
+                self._order[node] = position
+            self._next_order = len(self._order)
+        except NetworkXUnfeasible:
+            cycle = nx_find_cycle(self)
+            added = set((e[0], e[1]) for e in ebunch_to_add)
+            u_of_edge, v_of_edge = next((e for e in cycle if e in added), cycle[0])
+            raise EdgeViolatesDAG(u_of_edge, v_of_edge, cycle)
+
+    def get_similar_nodes(self, node: Image) -> set:
+        """Get all nodes with the same name."""
+        return set(self._by_name.get(node.name, set()))
+
+    def get_dependencies(self, node: Image) -> set[Image]:
+        """Get all dependencies for an image."""
+        # nx.neighbors can return an equal copy of a node instead of the node in the graph (dropping the attributes of
+        # some nodes e.g. cuda, python) so the dependencies are served from our own index
+        return set().union(*self._dependency_groups[node].values())
+
+    def get_dependency_groups(self, node: Image) -> dict[str, set[Image]]:
+        """Get the dependencies for an image grouped by image name."""
+        return self._dependency_groups[node]
+
+    def _reachable(self, node: Image) -> int:
+        """Get the nodes reachable from a node (including the node itself) as a bitmask where the bit of a node is its
+        position in the topological order. The masks of the node and of everything below it are computed together and
+        kept until the graph changes."""
+        if self._reach is None:
+            self._reach = dict()
+        reach = self._reach
+        if node not in reach:
+            # the nodes below node that have no mask yet
+            pending: list[Image] = [node]
+            stack: list[Image] = [node]
+            seen: set[Image] = {node}
+            while len(stack) > 0:
+                for s in self._succ[stack.pop()]:
+                    if s not in seen and s not in reach:
+                        seen.add(s)
+                        stack.append(s)
+                        pending.append(s)
+            # successors come after their predecessors so walking backwards has every successor done first
+            pending.sort(key=self._order.__getitem__, reverse=True)
+            for n in pending:
+                mask = 1 << self._order[n]
+                for s in self._succ[n]:
+                    mask |= reach[s]
+                reach[n] = mask
+        return reach[node]
+
+    def is_above(self, u_node: Image, v_node: Image) -> bool:
+        """Test if one node is above another in the dependency tree."""
+        return self._reachable(u_node) >> self._order[v_node] & 1 == 1
+
+    def topological_generations(self, nodes: set[Image] | None = None) -> list[list[Image]]:
+        """Group nodes (all nodes by default) into generations where every node only depends on nodes in earlier
+        generations (Kahn's algorithm). Dependencies outside of nodes are ignored. Nodes in the same generation do not
+        depend on each other."""
+        if nodes is None:
+            nodes = set(self.nodes)
+        # the number of dependencies of each node that are not in a generation yet
+        waiting: dict[Image, int] = dict.fromkeys(nodes, 0)
+        dependents: dict[Image, list[Image]] = {node: list() for node in nodes}
+        for node in nodes:
+            for dep in self.get_dependencies(node):
+                if dep in waiting:
+                    waiting[node] += 1
+                    dependents[dep].append(node)
+
+        generations: list[list[Image]] = list()
+        generation: list[Image] = [node for node in nodes if waiting[node] == 0]
+        while len(generation) > 0:
+            # lowest version first (as Image.__lt__ sorts) with ties broken by name so the order never depends on
+            # the iteration order of sets
+            generation.sort(key=lambda n: (n.version._key, n.name))
+            generations.append(generation)
+            following: list[Image] = list()
+            for node in generation:
+                for dependent in dependents[node]:
+                    waiting[dependent] -= 1
+                    if waiting[dependent] == 0:
+                        following.append(dependent)
+            generation = following
+        return generations
+
+    def _is_valid_build_tuple(self, bt: tuple[Image]) -> bool:
+        """Verify that all the dependencies of a build tuple can be met."""
+        valid = True
+
+        # check for similar images
+        for i0 in range(len(bt)):
+            for i2 in bt[i0 + 1 :]:
+                if bt[i0].satisfies(i2.name):
+                    valid = False
+
+        # check that all images exist
+        for node in bt:
+            if not self.has_node(node):
+                valid = False
+
+        # break prematurely if the first two checks fail
+        if not valid:
+            return valid
+
+        # check that deps in build tuple
+        for node in bt:
+            grouped = self.get_dependency_groups(node)
+
+            # check that the needed dependency exists
+            for g in grouped:
+                if grouped[g].isdisjoint(bt):
+                    valid = False
+
+        return valid
+
+    def _solve_build_tuple(
+        self,
+        targets: list[Target],
+        priority_list: list[str],
+        prioritized_list_group: list[list[Image]],
+    ) -> set[Image] | None:
+        """Find the first valid build tuple with a backtracking search.
+
+        Names are assigned in priority order and their candidates are tried from the most to the least preferred
+        version so build tuples are visited in the same order as an exhaustive search over every permutation. Only
+        the chosen targets and the images below them end up in the build. Each image that does narrows the candidates
+        of its dependencies and a branch is abandoned as soon as a dependency can no longer be met. Branches that
+        fail are remembered by everything their outcome depends on so the same dead end is never searched twice.
+        """
+        target_names: set[str] = set(t.node.name for t in targets)
+        candidates: dict[str, list[Image]] = dict(zip(priority_list, prioritized_list_group))
+        chosen: dict[str, Image] = dict()
+        # the images below chosen targets are tracked as a bitmask (see _reachable)
+        bit: dict[Image, int] = {c: 1 << self._order[c] for group in prioritized_list_group for c in group}
+
+        # the names assigned before each position that the candidates from that position on can depend on
+        referenced: list[tuple[str, ...]] = list()
+        later: set[str] = set()
+        for idx in range(len(priority_list) - 1, -1, -1):
+            for candidate in candidates[priority_list[idx]]:
+                later.update(self.get_dependency_groups(candidate))
+            referenced.append(tuple(n for n in priority_list[:idx] if n in later))
+        referenced.reverse()
+        failed: set[tuple] = set()
+
+        # the names with a candidate that depends on each name and the names each name can depend on
+        parents: dict[str, set[str]] = {name: set() for name in priority_list}
+        children: dict[str, set[str]] = {name: set() for name in priority_list}
+        for name in priority_list:
+            for candidate in candidates[name]:
+                for dep_name in self.get_dependency_groups(candidate):
+                    if dep_name in parents:
+                        parents[dep_name].add(name)
+                        children[name].add(dep_name)
+
+        def prune(
+            domains: dict[str, frozenset[Image]], reachable: int, changed: list[str]
+        ) -> dict[str, frozenset[Image]] | None:
+            """Drop the candidates that can no longer be part of a valid build tuple (arc consistency).
+
+            Only used once all the targets are chosen because from then on it is fixed which candidates are in the
+            build. Candidates outside the build constrain nothing. Returns None if a name is left without candidates.
+            """
+
+            def supported(name: str, candidate: Image) -> bool:
+                # every dependency of the candidate can still be met
+                if name in target_names or reachable & bit[candidate]:
+                    for dep_name, deps in self.get_dependency_groups(candidate).items():
+                        if domains.get(dep_name, frozenset()).isdisjoint(deps):
+                            return False
+                # every name that can depend on the candidate can still accept it
+                for parent in parents[name]:
+                    for other in domains[parent]:
+                        if not (parent in target_names or reachable & bit[other]):
+                            break
+                        deps = self.get_dependency_groups(other).get(name)
+                        if deps is None or candidate in deps:
+                            break
+                    else:
+                        return False
+                return True
+
+            queue: list[str] = list(set().union(*(parents[n] | children[n] for n in changed)))
+            queued: set[str] = set(queue)
+            while len(queue) > 0:
+                name = queue.pop()
+                queued.discard(name)
+                kept = frozenset(c for c in domains[name] if supported(name, c))
+                if len(kept) == 0:
+                    return None
+                if len(kept) < len(domains[name]):
+                    domains[name] = kept
+                    for other in parents[name] | children[name]:
+                        if other not in queued:
+                            queue.append(other)
+                            queued.add(other)
+            return domains
+
+        def assign(idx: int, domains: dict[str, frozenset[Image]], reachable: int) -> bool:
+            if idx == len(priority_list):
+                return True
+            key = (
+                idx,
+                reachable,
+                tuple(domains[n] for n in priority_list[idx:]),
+                tuple(chosen[n] for n in referenced[idx]),
+            )
+            if key in failed:
+                return False
+            name = priority_list[idx]
+            tried_absent = False
+            for candidate in candidates[name]:
+                if candidate not in domains[name]:
+                    continue
+                in_build = name in target_names or reachable & bit[candidate] != 0
+                if not in_build:
+                    # every candidate outside the build leads to the same result so only try the first one
+                    if tried_absent:
+                        continue
+                    tried_absent = True
+
+                # check the dependencies of the candidate against what has been chosen and what can still be chosen
+                narrowed_domains = dict(domains)
+                narrowed_domains[name] = frozenset((candidate,))
+                changed = [name]
+                valid = True
+                for dep_name, deps in self.get_dependency_groups(candidate).items() if in_build else ():
+                    if dep_name in chosen:
+                        if chosen[dep_name] not in deps:
+                            valid = False
+                            break
+                    else:
+                        narrowed = domains.get(dep_name, frozenset()) & deps
+                        if len(narrowed) == 0:
+                            valid = False
+                            break
+                        narrowed_domains[dep_name] = narrowed
+                        changed.append(dep_name)
+                if not valid:
+                    continue
+
+                chosen[name] = candidate
+                next_reachable = reachable | self._reachable(candidate) if name in target_names else reachable
+                if idx + 1 == len(target_names):
+                    # all the targets are chosen so every candidate can be checked
+                    narrowed_domains = prune(narrowed_domains, next_reachable, list(priority_list))
+                elif idx + 1 > len(target_names):
+                    narrowed_domains = prune(narrowed_domains, next_reachable, changed)
+                if narrowed_domains is not None and assign(idx + 1, narrowed_domains, next_reachable):
+                    return True
+            chosen.pop(name, None)
+            failed.add(key)
+            return False
+
+        if not assign(0, {name: frozenset(c) for name, c in candidates.items()}, 0):
+            return None
+
+        # the build only includes the targets and the images below them (the build order does not depend on the order
+        # they are added in, topological_generations breaks ties by name)
+        build: set[Image] = set()
+        for name in priority_list:
+            node = chosen[name]
+            if name in target_names:
+                build.add(node)
+                below = self._reachable(node) & ~bit[node]
+                build.update(set(c for c in chosen.values() if below & bit[c]))
+        return build
+
+    def create_build_recipe(self, targets: list[Target]) -> tuple:
+        """Create a build recipe."""
+        # check if all the targets exist
+        for node in targets:
+            if len(self.get_similar_nodes(node.node)) < 1:
+                raise NoAvailableBuild(f"The build target {node.node} does not exist!")
+
+        # init build set and priority list
+        build_set = set()
+        priority_list = list()
+
+        # add similar to build set
+        for target in targets:
+            build_set.update(self.get_similar_nodes(target.node))
+            # make sure to update priority
+            if target.node.name not in priority_list:
+                priority_list.append(target.node.name)
+
+        # add deps to build set
+        while True:
+            build_set_length = len(build_set)
+
+            for node in build_set.copy():
+                for dep_name, deps in self.get_dependency_groups(node).items():
+                    build_set.update(deps)
+                    if dep_name not in priority_list:
+                        priority_list.append(dep_name)
+
+            # loop until all dependencies are added
+            if build_set_length == len(build_set):
+                break
+
+        # apply constraints
+        for target in targets:
+            for node in build_set.copy():
+                if node.satisfies(target.node.name):
+                    if target.op == DepOp.EQ and node.version != target.node.version:
+                        build_set.remove(node)
+                    elif target.op == DepOp.GE and node.version < target.node.version:
+                        build_set.remove(node)
+                    elif target.op == DepOp.LE and node.version > target.node.version:
+                        build_set.remove(node)
+
+        # group deps
+        grouped = dict()
+        for node in build_set:
+            if node.name not in grouped:
+                grouped[node.name] = set()
+            grouped[node.name].add(node)
+        # sort deps so that the highest versions of images further up the dep tree will be chosen
+        prioritized_list_group = list()
+        for group in priority_list:
+            tmp = list(grouped.get(group, set()))
+            tmp.sort(reverse=True)
+            prioritized_list_group.append(tmp)
+
+        # find the first valid build tuple
+        clean_p = self._solve_build_tuple(targets, priority_list, prioritized_list_group)
+        if clean_p is None:
+            raise NoAvailableBuild("No Available build!")
+
+        # order build
+        return tuple(node for generation in self.topological_generations(clean_p) for node in generation)
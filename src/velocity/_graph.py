@@ -1,69 +1,103 @@
 """Graph library and tools for dependency graph"""
 
 from loguru import logger
-from re import split as re_split, fullmatch as re_fullmatch, Match as ReMatch
+from re import compile as re_compile, split as re_split, fullmatch as re_fullmatch, Match as ReMatch
 from pathlib import Path
+from functools import lru_cache
 from hashlib import sha256
+from stat import S_ISREG
+from sys import intern
+from typing import TYPE_CHECKING
 from typing_extensions import Self
-from yaml import safe_load as yaml_safe_load
-from copy import deepcopy
+from yaml import load as yaml_load
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 from enum import Enum
-from networkx import (
-    DiGraph as nx_DiGraph,
-    is_directed_acyclic_graph as nx_is_directed_acyclic_graph,
-    find_cycle as nx_find_cycle,
-    neighbors as nx_neighbors,
-    has_path as nx_has_path,
-)
+from ._cache import cache_path, file_stamp, read_cache, write_cache
 from ._config import config
 from ._exceptions import InvalidImageVersionError, CannotFindDependency, EdgeViolatesDAG, NoAvailableBuild
 from ._tools import OurMeta, trace_function
 
+if TYPE_CHECKING:
+    from ._dag import ImageGraph
+
+# use the libyaml parser when pyyaml was built with it
+try:
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
+
+
+# sha256 digests of template files keyed by (path, modification time)
+_template_digests: dict[tuple[str, int], str] = dict()
+
 
 @trace_function
-def get_permutations(idx: int, sets: list[list]):
+def template_digest(path: Path) -> str | None:
+    """Get the sha256 digest of a template file or None if it does not exist. Digests are cached until the file is
+    modified."""
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    if not S_ISREG(stat.st_mode):
+        return None
+    key = (str(path), stat.st_mtime_ns)
+    if key not in _template_digests:
+        _template_digests[key] = sha256(path.read_bytes()).hexdigest()
+    return _template_digests[key]
+
+
+class Version:
+    """Version class. Versions are parsed once into a comparison key. Versions are compared component by component
+    (major, minor, patch, suffix) where a missing number sorts before any number and a missing suffix sorts after any
+    suffix. Two versions are equal when the components that both of them specify are the same e.g. 12.3 == 12.3.0-rc1.
     """
-    Get all the possible permutations from a list of lists
-    :param idx: recursion level
-    :param sets: sets for permutation
-    :return: permutations
-    """
-    permutations = list()
-    if len(sets) == 0:
-        pass
-    elif idx == len(sets) - 1:
-        for i in sets[idx]:
-            permutations.append({i})
-    else:
-        for i in sets[idx]:
-            sub_permutations = get_permutations(idx + 1, sets)
-            for sub in sub_permutations:
-                permutations.append(sub.union({i}))
-    return permutations
-
-
-class Version(metaclass=OurMeta):
-    """Version class."""
+
+    __slots__ = ("vs", "major", "minor", "patch", "suffix", "_key", "_eq_key", "_precision")
+
+    version_regex = re_compile(
+        r"^(?P<major>[0-9]+)(?:\.(?P<minor>[0-9]+)(:?\.(?P<patch>[0-9]+))?)?(?:-(?P<suffix>[a-zA-Z0-9]+))?$"
+    )
 
     def __init__(self, version_specifier: str) -> None:
         self.vs = version_specifier
-        try:
-            version_dict: dict = re_fullmatch(
-                r"^(?P<major>[0-9]+)(?:\.(?P<minor>[0-9]+)(:?\.(?P<patch>[0-9]+))?)?(?:-(?P<suffix>[a-zA-Z0-9]+))?$",
-                version_specifier,
-            ).groupdict()
+        res: ReMatch | None = self.version_regex.fullmatch(version_specifier)
+        if res is not None:
+            version_dict: dict = res.groupdict()
             self.major: int | None = int(version_dict["major"]) if version_dict["major"] is not None else None
             self.minor: int | None = int(version_dict["minor"]) if version_dict["minor"] is not None else None
             self.patch: int | None = int(version_dict["patch"]) if version_dict["patch"] is not None else None
             self.suffix: str | None = str(version_dict["suffix"]) if version_dict["suffix"] is not None else None
-        except AttributeError:
+        else:
             self.major: int | None = None
             self.minor: int | None = None
             self.patch: int | None = None
             self.suffix: str | None = None
-        except ValueError:
-            logger.error("Could not parse version string: {}".format(version_specifier))
-            exit(1)
+
+        # comparison key, missing numbers sort first and a missing suffix sorts last
+        suffix: str = self.suffix.ljust(9, "~") if self.suffix is not None else "~" * 9
+        self._key: tuple[int, int, int, str] = (
+            self.major if self.major is not None else -1,
+            self.minor if self.minor is not None else -1,
+            self.patch if self.patch is not None else -1,
+            suffix,
+        )
+        # only the first nine characters of a suffix are significant for equality
+        self._eq_key: tuple[int, int, int, str] = self._key[:3] + (suffix[:9],)
+
+        # number of leading components that are specified
+        if self.major is None:
+            self._precision: int = 0
+        elif self.minor is None:
+            self._precision: int = 1
+        elif self.patch is None:
+            self._precision: int = 2
+        elif self.suffix is None:
+            self._precision: int = 3
+        else:
+            self._precision: int = 4
 
     @property
     def vcs(self) -> str:
@@ -77,197 +111,281 @@ class Version(metaclass=OurMeta):
 
     def preferred(self, other) -> bool:
         """Determine which version to prefer when two version are "equal" ex. 12.3 vs 12.3.0-rc1"""
-        return self.vcs > other.vcs
+        return self._key > other._key
 
-    @property
-    def _vcs_t(self) -> str:
-        """Version Comparison String Truncated"""
-        vl: int = 0
-        if self.major is None:
-            pass
-        elif self.minor is None:
-            vl = 9
-        elif self.patch is None:
-            vl = 19
-        elif self.suffix is None:
-            vl = 29
-        else:
-            vl = 39
-        return self.vcs[:vl]
-
-    @classmethod
-    def _cut_vcses_to_size(cls, one: Self, two: Self) -> tuple[str, str]:
-        """Cut vcses to the longest common length"""
-        length: int = min(len(one._vcs_t), len(two._vcs_t))
-        return one._vcs_t[:length], two._vcs_t[:length]
+    def _equals(self, other) -> bool:
+        """Compare the components that both versions specify."""
+        length: int = min(self._precision, other._precision)
+        return self._eq_key[:length] == other._eq_key[:length]
 
     def __eq__(self, other) -> bool:
         if not isinstance(other, Version):
             raise TypeError(
                 f"'>' not supported between instances of " f"'{type(self).__name__}' and '{type(other).__name__}'"
             )
-        s_vcs, o_vcs = self._cut_vcses_to_size(self, other)
-        return s_vcs == o_vcs
+        return self._equals(other)
 
     def __ne__(self, other) -> bool:
         if not isinstance(other, Version):
             raise TypeError(
                 f"'>' not supported between instances of " f"'{type(self).__name__}' and '{type(other).__name__}'"
             )
-        s_vcs, o_vcs = self._cut_vcses_to_size(self, other)
-        return s_vcs != o_vcs
+        return not self._equals(other)
 
     def __gt__(self, other) -> bool:
         if not isinstance(other, Version):
             raise TypeError(
                 f"'>' not supported between instances of " f"'{type(self).__name__}' and '{type(other).__name__}'"
             )
-        return self.vcs > other.vcs and not self.__eq__(other)
+        return self._key > other._key and not self._equals(other)
 
     def __ge__(self, other) -> bool:
         if not isinstance(other, Version):
             raise TypeError(
                 f"'>' not supported between instances of " f"'{type(self).__name__}' and '{type(other).__name__}'"
             )
-        return self.vcs > other.vcs or self.__eq__(other)
+        return self._key > other._key or self._equals(other)
 
     def __lt__(self, other) -> bool:
         if not isinstance(other, Version):
             raise TypeError(
                 f"'>' not supported between instances of " f"'{type(self).__name__}' and '{type(other).__name__}'"
             )
-        return self.vcs < other.vcs and not self.__eq__(other)
+        return self._key < other._key and not self._equals(other)
 
     def __le__(self, other) -> bool:
         if not isinstance(other, Version):
             raise TypeError(
                 f"'>' not supported between instances of " f"'{type(self).__name__}' and '{type(other).__name__}'"
             )
-        return self.vcs < other.vcs or self.__eq__(other)
+        return self._key < other._key or self._equals(other)
 
     def __str__(self) -> str:
         return self.vs
 
 
-class Image(metaclass=OurMeta):
-    """Velocity container image."""
+class Spec(metaclass=OurMeta):
+    """Compiled image spec (e.g. 'gcc@12.3: system=frontier ^ubuntu'). Use compile_spec to get cached instances."""
 
-    def __init__(self, name: str, version: str, system: str, backend: str, distro: str, path: str) -> None:
-        # foundational
-        self.name: str = name
-        self.version: Version = Version(str(version))
-        self.system: str = system
-        self.backend: str = backend
-        self.distro: str = distro
-        self.dependencies: set[str] = set()
+    name_version_regex: str = (
+        r"^(?P<name>[^@:\s]+)(?:(?:@(?P<left>[\d\.]+)(?!@))?(?:@?(?P<colen>:)(?P<right>[\d\.]+)?)?)?$"
+    )
+    attribute_regex: str = r"^(?P<attribute>system|backend|distro)=(?P<value>[a-zA-Z0-9]+)$"
+    dependency_regex: str = r"^\^(?P<name>[a-zA-Z0-9-]+)$"
 
-        # additional
-        self.variables: dict[str, str] = dict()
-        self.arguments: set[str] = set()
-        self.template: str = "default"
-        self.files: set[str] = set()
-        self.prolog: str | None = None
-        self.underlay: int | None = None  # sum of the ids this image will be built on
-
-        # metadata
-        self.path: Path = Path(path)
-
-    def satisfies(self, spec: str) -> bool:
-        """Test if this node satisfies the given spec."""
+    def __init__(self, spec: str) -> None:
+        self.spec: str = spec
+        # each part is ((name, op, left, right) | None, attribute | None, value | None). A part that names an image
+        # is only evaluated as a name/version when the name matches, otherwise it falls through to the attribute
+        self.parts: list[tuple[tuple | None, str | None, str | None]] = list()
 
-        # return true if spec has no condition
         if re_fullmatch(r"^\s*$", spec):
-            return True
+            return
 
-        # else evaluate conditional
-        name_version_regex: str = (
-            r"^(?P<name>{})(?:(?:@(?P<left>[\d\.]+)(?!@))?(?:@?(?P<colen>:)(?P<right>[\d\.]+)?)?)?$".format(self.name)
-        )
-        system_regex: str = r"^system=(?P<system>[a-zA-Z0-9]+)$"
-        backend_regex: str = r"^backend=(?P<backend>[a-zA-Z0-9]+)$"
-        distro_regex: str = r"^distro=(?P<distro>[a-zA-Z0-9]+)$"
-        dependency_regex: str = r"^\^(?P<name>[a-zA-Z0-9-]+)$"
-
-        ss: list[str] = re_split(r"\s+", spec.strip())
-
-        for part in ss:
-            # name and version
-            res: ReMatch | None = re_fullmatch(name_version_regex, part)
+        for part in re_split(r"\s+", spec.strip()):
+            name_version: tuple | None = None
+            res: ReMatch | None = re_fullmatch(self.name_version_regex, part)
             if res is not None:
                 gd: dict = res.groupdict()
-                if gd["left"] is not None and gd["right"] is None:  # n@v: or n@v
-                    if gd["colen"] is not None:
-                        if Version(gd["left"]) > self.version:
-                            return False
-                    else:
-                        if Version(gd["left"]) != self.version:
-                            return False
-                elif gd["left"] is None and gd["right"] is not None:  # n@:v
-                    if gd["colen"] is not None:
-                        if Version(gd["right"]) < self.version:
-                            return False
-                    else:
-                        return False
-                elif gd["left"] is None and gd["right"] is None:  # n
-                    if gd["colen"] is not None:
-                        return False
+                left = Version(gd["left"]) if gd["left"] is not None else None
+                right = Version(gd["right"]) if gd["right"] is not None else None
+                if left is not None and right is None:  # n@v: or n@v
+                    op = "ge" if gd["colen"] is not None else "eq"
+                elif left is None and right is not None:  # n@:v
+                    op = "le" if gd["colen"] is not None else "never"
+                elif left is None and right is None:  # n
+                    op = "never" if gd["colen"] is not None else "any"
                 else:  # n@v:v
-                    if Version(gd["left"]) > self.version or self.version > Version(gd["right"]):
-                        return False
-                continue  # part has been handled so continue
+                    op = "range"
+                name_version = (gd["name"], op, left, right)
 
-            # system
-            res = re_fullmatch(system_regex, part)
+            attribute: str | None = None
+            value: str | None = None
+            res = re_fullmatch(self.attribute_regex, part)
             if res is not None:
-                if res.group("system") != self.system:
-                    return False
-                continue  # part has been handled so continue
+                attribute, value = res.group("attribute"), res.group("value")
+            else:
+                res = re_fullmatch(self.dependency_regex, part)
+                if res is not None:
+                    attribute, value = "dependency", res.group("name")
 
-            # backend
-            res = re_fullmatch(backend_regex, part)
-            if res is not None:
-                if res.group("backend") != self.backend:
-                    return False
-                continue  # part has been handled so continue
+            self.parts.append((name_version, attribute, value))
 
-            # distro
-            res = re_fullmatch(distro_regex, part)
-            if res is not None:
-                if res.group("distro") != self.distro:
+    def matches(self, image: "Image") -> bool:
+        """Test if an image satisfies this spec."""
+        for name_version, attribute, value in self.parts:
+            # name and version
+            if name_version is not None and name_version[0] == image.name:
+                _, op, left, right = name_version
+                if op == "eq":
+                    if left != image.version:
+                        return False
+                elif op == "ge":
+                    if left > image.version:
+                        return False
+                elif op == "le":
+                    if right < image.version:
+                        return False
+                elif op == "range":
+                    if left > image.version or image.version > right:
+                        return False
+                elif op == "never":
                     return False
                 continue  # part has been handled so continue
 
-            # dependencies
-            res = re_fullmatch(dependency_regex, part)
-            if res is not None:
-                matched = False
-                for dep in self.dependencies:
-                    if res.group("name") == dep:
-                        matched = True
-                if matched:
-                    continue  # match is found so continue
-
-            # if we get here this part has not been handled
-            return False
+            # system, backend and distro
+            if attribute is None:
+                return False
+            elif attribute == "dependency":
+                if value not in image.dependencies:
+                    return False
+            elif getattr(image, attribute) != value:
+                return False
 
         # all parts were handled
         return True
 
-    def apply_constraint(self, conditional: str, _type: str, spec: str) -> bool:
+    def __str__(self) -> str:
+        return self.spec
+
+
+@lru_cache(maxsize=4096)
+@trace_function
+def compile_spec(spec: str) -> Spec:
+    """Compile a spec. Compiled specs are kept in a bounded LRU cache keyed by the spec text."""
+    return Spec(spec)
+
+
+@lru_cache(maxsize=4096)
+def image_path(path: str | Path) -> Path:
+    """Get the Path of an image definition directory. Images of the same definition share one Path object."""
+    return Path(path)
+
+
+class Image(metaclass=OurMeta):
+    """Velocity container image. Images use slots and share their strings and path with the other images of the same
+    definition since repositories can hold thousands of them (and resolving creates overlays of all of them)."""
+
+    __slots__ = (
+        "_hash",
+        "_hash_int",
+        "_shared",
+        "name",
+        "version",
+        "system",
+        "backend",
+        "distro",
+        "dependencies",
+        "variables",
+        "arguments",
+        "template",
+        "files",
+        "prolog",
+        "underlay",
+        "path",
+    )
+
+    # collections that an overlay shares with its base image (see overlay)
+    _collections: frozenset[str] = frozenset(("dependencies", "variables", "arguments", "files"))
+    _no_collections: frozenset[str] = frozenset()
+
+    def __init__(self, name: str, version: str, system: str, backend: str, distro: str, path: str) -> None:
+        # identity cache (see __setattr__)
+        self._hash: str | None = None
+        self._hash_int: int | None = None
+        # collections shared with the image this one is an overlay of (see overlay)
+        self._shared: frozenset[str] = self._no_collections
+
+        # foundational
+        self.name: str = intern(name)
+        self.version: Version = Version(str(version))
+        self.system: str = intern(system)
+        self.backend: str = intern(backend)
+        self.distro: str = intern(distro)
+        # dependencies: set[str] (see __getattr__)
+
+        # additional
+        # variables: dict[str, str], arguments: set[str] and files: set[str] (see __getattr__)
+        self.template: str = "default"
+        self.prolog: str | None = None
+        self.underlay: int | None = None  # sum of the ids this image will be built on
+
+        # metadata
+        self.path: Path = image_path(path)
+
+    def __setattr__(self, name: str, value) -> None:
+        # attributes feed into the hash so drop the cached identity whenever one is assigned
+        if name != "_hash" and name != "_hash_int":
+            object.__setattr__(self, "_hash", None)
+            object.__setattr__(self, "_hash_int", None)
+        object.__setattr__(self, name, value)
+
+    def __getattr__(self, name: str):
+        # only called for unset slots. Most images never get any dependencies, variables, arguments or files of their
+        # own so the collections are created on first use
+        if name in self._collections:
+            value = dict() if name == "variables" else set()
+            object.__setattr__(self, name, value)
+            return value
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+
+    def _peek(self, name: str) -> set | dict | tuple:
+        """Get an attribute without creating a collection that has not been used yet (an empty tuple instead)."""
+        try:
+            return object.__getattribute__(self, name)
+        except AttributeError:
+            return tuple()
+
+    def overlay(self) -> Self:
+        """Create a copy-on-write overlay of this image. The overlay shares all of its attributes with this image and
+        only copies a collection when a constraint first modifies it. This image must not be modified while it has
+        overlays."""
+        overlay = type(self).__new__(type(self))
+        for attribute in self.__slots__:
+            try:
+                object.__setattr__(overlay, attribute, object.__getattribute__(self, attribute))
+            except AttributeError:
+                pass
+        object.__setattr__(overlay, "_shared", self._collections)
+        return overlay
+
+    def _own(self, attribute: str) -> None:
+        """Copy a collection shared with the base image before modifying it."""
+        if attribute in self._shared:
+            self._shared = self._shared.difference((attribute,))
+            setattr(self, attribute, copy(getattr(self, attribute)))
+
+    def materialize(self) -> None:
+        """Copy all collections still shared with the base image so that this image is independent of it."""
+        for attribute in list(self._shared):
+            self._own(attribute)
+
+    def satisfies(self, spec: str) -> bool:
+        """Test if this node satisfies the given spec."""
+        return compile_spec(spec).matches(self)
+
+    def apply_constraint(self, conditional: str | Spec, _type: str, spec: str) -> bool:
         """Evaluate and apply constraints. Return True if a constraint changes the dependencies."""
-        if self.satisfies(conditional):
+        if (compile_spec(conditional) if isinstance(conditional, str) else conditional).matches(self):
+            # constraints modify the image in place so drop the cached identity
+            self._hash = None
+            self._hash_int = None
             if _type == "dependency":
                 if spec not in self.dependencies:
+                    self._own("dependencies")
                     self.dependencies.add(spec)
                     return True
             elif _type == "variable":
                 parts = spec.split("=")
+                self._own("variables")
                 self.variables[parts[0]] = parts[1]
             elif _type == "argument":
+                self._own("arguments")
                 self.arguments.add(spec)
             elif _type == "template":
                 self.template = spec
             elif _type == "file":
+                self._own("files")
                 self.files.add(spec)
             elif _type == "prolog":
                 self.prolog = spec
@@ -275,7 +393,10 @@ class Image(metaclass=OurMeta):
 
     @property
     def hash(self) -> str:
-        """Return a hash for this node uniquely identifying it."""
+        """Return a hash for this node uniquely identifying it. The hash is computed once and cached until the image
+        is modified."""
+        if self._hash is not None:
+            return self._hash
 
         hash_list: list = list()
         hash_list.append(self.name)
@@ -283,20 +404,18 @@ class Image(metaclass=OurMeta):
         hash_list.append(self.system)
         # hash_list.append(self.backend) # disable backend for now because it should not make a difference in the image
         hash_list.append(self.distro)
-        hash_list.append(",".join(str(x) for x in self.dependencies))
-        hash_list.append(",".join(str(x) for x in self.variables))
-        hash_list.append(",".join(str(x) for x in self.arguments))
-        tf = Path(self.path).joinpath("templates", "{}.vtmp".format(self.template))
-        if tf.is_file():
-            hash_list.append(sha256(tf.read_bytes()).hexdigest())
-        else:
-            hash_list.append(None)
-        hash_list.append(",".join(str(x) for x in self.files))
+        # sorted since the iteration order of sets of strings changes from one process to the next
+        hash_list.append(",".join(sorted(str(x) for x in self._peek("dependencies"))))
+        hash_list.append(",".join(sorted("{}={}".format(k, v) for k, v in dict(self._peek("variables")).items())))
+        hash_list.append(",".join(sorted(str(x) for x in self._peek("arguments"))))
+        hash_list.append(template_digest(Path(self.path).joinpath("templates", "{}.vtmp".format(self.template))))
+        hash_list.append(",".join(sorted(str(x) for x in self._peek("files"))))
         hash_list.append(self.prolog)
         hash_list.append(self.underlay)
 
         hash_str: str = "|".join(str(x) for x in hash_list)
-        return sha256(hash_str.encode()).hexdigest()
+        self._hash = sha256(hash_str.encode()).hexdigest()
+        return self._hash
 
     @property
     def id(self) -> str:
@@ -304,7 +423,9 @@ class Image(metaclass=OurMeta):
         return self.hash[:7]
 
     def __hash__(self) -> int:
-        return int(self.hash, 16)
+        if self._hash_int is None:
+            self._hash_int = int(self.hash, 16)
+        return self._hash_int
 
     def __eq__(self, other) -> bool:
         if not isinstance(other, Image):
@@ -328,6 +449,97 @@ class Image(metaclass=OurMeta):
         )
 
 
+class ImageIndex(metaclass=OurMeta):
+    """Index of images by name with the versions of each name sorted for range lookups."""
+
+    def __init__(self, images: set[Image] | tuple[Image]) -> None:
+        self.images: list[Image] = list(images)
+        # images sorted by version and the matching comparison keys for bisection
+        self.by_name: dict[str, list[Image]] = dict()
+        self.keys: dict[str, list[str]] = dict()
+        # images with versions that could not be parsed compare equal to every version so they are always candidates
+        self.unparsed: dict[str, list[Image]] = dict()
+        # results of find
+        self._found: dict[str, list[Image]] = dict()
+
+        for image in self.images:
+            if image.version.major is None:
+                self.unparsed.setdefault(image.name, list()).append(image)
+            else:
+                self.by_name.setdefault(image.name, list()).append(image)
+        for name in self.by_name:
+            self.by_name[name].sort(key=lambda i: i.version._key)
+            self.keys[name] = [i.version._key for i in self.by_name[name]]
+
+    def _candidates(self, spec: Spec) -> list[Image]:
+        """Get a superset of the images that can satisfy a spec."""
+        # a name/version part without an attribute can only be satisfied by an image with that name
+        name_version = next((nv for nv, attribute, _ in spec.parts if nv is not None and attribute is None), None)
+        if name_version is None:
+            return self.images
+
+        name, op, left, right = name_version
+        if op == "never":
+            return list()
+        images = self.by_name.get(name, list())
+        keys = self.keys.get(name, list())
+        lower, upper = 0, len(images)
+        # versions equal to a bound share at least its major component, so bisecting on the major component of the
+        # bounds keeps every version that can satisfy the spec
+        if op in ("eq", "ge", "range") and left.major is not None:
+            lower = bisect_left(keys, (left.major,))
+        if op in ("eq", "le", "range"):
+            bound = left if op == "eq" else right
+            if bound.major is not None:
+                upper = bisect_left(keys, (bound.major + 1,))
+        return images[lower:upper] + self.unparsed.get(name, list())
+
+    def find(self, spec: str, nodes: dict[int, Image] | None = None) -> list[Image]:
+        """Get all images that satisfy a spec.
+
+        An index can be shared by overlays of its images by passing nodes, which maps the id of every indexed image to
+        its overlay. The matching overlays are returned then.
+        """
+        if spec not in self._found:
+            compiled: Spec = compile_spec(spec)
+            candidates: list[Image] = self._candidates(compiled)
+            if any(attribute == "dependency" for _, attribute, _ in compiled.parts):
+                # dependencies change when constraints are applied so these are always tested on the given images
+                if nodes is not None:
+                    candidates = [nodes[id(i)] for i in candidates]
+                return [i for i in candidates if compiled.matches(i)]
+            # names, versions and attributes never change so the result is kept
+            self._found[spec] = [i for i in candidates if compiled.matches(i)]
+        found: list[Image] = self._found[spec]
+        return found if nodes is None else [nodes[id(i)] for i in found]
+
+
+class ConstraintIndex(metaclass=OurMeta):
+    """Constraints indexed by the image name and the scope they apply to with precompiled conditions.
+
+    Lookups return constraint positions in their original order since later constraints override earlier ones.
+    """
+
+    def __init__(self, constraints: list[tuple[str, str, str, str, str]]) -> None:
+        self.constraints: tuple[tuple[str, str, str, str, str], ...] = tuple(constraints)
+        # condition on the image a constraint applies to ("{name} {when}") and on the images of a build ("{when}")
+        self.conditions: list[Spec] = [compile_spec("{} {}".format(c[0], c[1])) for c in self.constraints]
+        self.when: list[Spec] = [compile_spec(c[1]) for c in self.constraints]
+        # constraints with an empty image name apply to every image
+        self.by_name: dict[str, list[int]] = dict()
+        self.by_scope: dict[str, list[int]] = dict()
+        for i, constraint in enumerate(self.constraints):
+            self.by_name.setdefault(constraint[0], list()).append(i)
+            self.by_scope.setdefault(constraint[4], list()).append(i)
+        self._for_name: dict[str, list[int]] = dict()
+
+    def for_name(self, name: str) -> list[int]:
+        """Get the constraints that can apply to images with the given name."""
+        if name not in self._for_name:
+            self._for_name[name] = sorted(self.by_name.get(name, list()) + self.by_name.get("", list()))
+        return self._for_name[name]
+
+
 class DepOp(Enum):
     """Dependency options."""
 
@@ -348,186 +560,13 @@ class Target(metaclass=OurMeta):
         return "Target: {} -> {}".format(self.op, self.node)
 
 
-class ImageGraph(nx_DiGraph, metaclass=OurMeta):
-    """Image dependency graph."""
-
-    def __init__(self, **kwargs) -> None:
-        super().__init__(**kwargs)
-
-    def add_edge(self, u_of_edge: Image, v_of_edge: Image, **kwargs) -> None:
-        # check that edge endpoints are in graph
-        if self.has_node(u_of_edge) and self.has_node(v_of_edge):
-            super().add_edge(u_of_edge, v_of_edge, **kwargs)
-        else:
-            raise CannotFindDependency("Cannot find dependency {} for {}".format(v_of_edge, u_of_edge))
-
-        # check that graph is still a DAG
-        if not nx_is_directed_acyclic_graph(self):
-            cycle = nx_find_cycle(self)
-            raise EdgeViolatesDAG(u_of_edge, v_of_edge, cycle)
-
-    def get_similar_nodes(self, node: Image) -> set:
-        """Get all nodes with the same name."""
-        similar = set()
-        for n in self.nodes:
-            if n.satisfies(node.name):
-                similar.add(n)
-        return similar
-
-    def get_dependencies(self, node: Image) -> set[Image]:
-        """Get all dependencies for an image."""
-        # had to add this wrapper because nx.neighbors was dropping the attributes of some nodes (cuda, python)
-        deps = set()
-        for node in nx_neighbors(self, node):
-            for n in self.nodes:
-                if n == node:
-                    deps.add(n)
-        # TODO will contact the maintainers of networkx at some point
-        return deps
-
-    def is_above(self, u_node: Image, v_node: Image) -> bool:
-        """Test if one node is above another in the dependency tree."""
-        return nx_has_path(self, u_node, v_node)
-
-    def _is_valid_build_tuple(self, bt: tuple[Image]) -> bool:
-        """Verify that all the dependencies of a build tuple can be met."""
-        valid = True
-
-        # check for similar images
-        for i0 in range(len(bt)):
-            for i2 in bt[i0 + 1 :]:
-                if bt[i0].satisfies(i2.name):
-                    valid = False
-
-        # check that all images exist
-        for node in bt:
-            if not self.has_node(node):
-                valid = False
-
-        # break prematurely if the first two checks fail
-        if not valid:
-            return valid
-
-        # check that deps in build tuple
-        for node in bt:
-            deps = self.get_dependencies(node)
-
-            # group deps
-            grouped = dict()
-            for d in deps:
-                if d.name not in grouped:
-                    grouped[d.name] = set()
-                grouped[d.name].add(d)
-
-            # check that the needed dependency exists
-            for g in grouped:
-                if grouped[g].isdisjoint(bt):
-                    valid = False
-
-        return valid
-
-    def create_build_recipe(self, targets: list[Target]) -> tuple:
-        """Create a build recipe."""
-        # check if all the targets exist
-        for node in targets:
-            if len(self.get_similar_nodes(node.node)) < 1:
-                raise NoAvailableBuild(f"The build target {node.node} does not exist!")
-
-        # init build set and priority list
-        build_set = set()
-        priority_list = list()
-
-        # add similar to build set
-        for target in targets:
-            build_set.update(self.get_similar_nodes(target.node))
-            # make sure to update priority
-            if target.node.name not in priority_list:
-                priority_list.append(target.node.name)
-
-        # add deps to build set
-        while True:
-            build_set_length = len(build_set)
-
-            for node in build_set.copy():
-                dependencies = self.get_dependencies(node)
-                for d in dependencies:
-                    build_set.add(d)
-                    if d.name not in priority_list:
-                        priority_list.append(d.name)
-
-            # loop until all dependencies are added
-            if build_set_length == len(build_set):
-                break
-
-        # apply constraints
-        for target in targets:
-            for node in build_set.copy():
-                if node.satisfies(target.node.name):
-                    if target.op == DepOp.EQ and node.version != target.node.version:
-                        build_set.remove(node)
-                    elif target.op == DepOp.GE and node.version < target.node.version:
-                        build_set.remove(node)
-                    elif target.op == DepOp.LE and node.version > target.node.version:
-                        build_set.remove(node)
-
-        # group deps
-        grouped = dict()
-        for node in build_set:
-            if node.name not in grouped:
-                grouped[node.name] = set()
-            grouped[node.name].add(node)
-        # sort deps so that the highest versions of images further up the dep tree will be chosen
-        prioritized_list_group = list()
-        for group in priority_list:
-            tmp = list(grouped[group])
-            tmp.sort(reverse=True)
-            prioritized_list_group.append(tmp)
-        # get permutations
-        permutations = get_permutations(0, prioritized_list_group)
-
-        # return valid build tuple
-        for p in permutations:
-            # clean up permutation
-            clean_p = set()
-            for n in p:
-                for t in targets:
-                    con_targ = None
-                    for nt in [x for x in p]:
-                        if nt.satisfies(t.node.name):
-                            con_targ = nt
-                            break
-                    if self.is_above(con_targ, n):
-                        clean_p.add(n)
-                        break
-
-            if self._is_valid_build_tuple(tuple(clean_p)):
-                # order build
-                build_list = list()
-                processed = set()
-                unprocessed = clean_p.copy()
-                while len(unprocessed) > 0:
-                    level_holder = list()
-                    for node in unprocessed.copy():
-                        deps = set(self.get_dependencies(node)).intersection(clean_p)
-                        if deps.issubset(processed):
-                            level_holder.append(node)
-                    level_holder.sort()
-                    for node in level_holder:
-                        processed.add(node)
-                        unprocessed.remove(node)
-                        build_list.append(node)
-
-                return tuple(build_list)
-
-        # if we got here no valid build tuple could be found
-        raise NoAvailableBuild("No Available build!")
-
-
 class ImageRepo(metaclass=OurMeta):
     """Image repository."""
 
     def __init__(self) -> None:
         self.images: set[Image] = set()
+        self._image_names: set[str] = set()
+        self._constraint_index: ConstraintIndex | None = None
         # constraint(image, condition, type, spec, scope)
         self.constraints: list[tuple[str, str, str, str, str]] = list()
         if config.get("constraints", warn_on_miss=False) is not None:
@@ -565,152 +604,291 @@ class ImageRepo(metaclass=OurMeta):
 
     def import_from_dir(self, path: str) -> None:
         """Add Images from path."""
-        p = Path(path)
-        if not p.is_dir():
-            raise NotADirectoryError(f"Image path {path} is not a directory!")
+        self.import_from_dirs([path])
+
+    def import_from_dirs(self, paths: list[str]) -> None:
+        """Add Images from each path in paths.
+
+        Image directories are scanned and parsed concurrently but merged in the order of paths, so the first
+        definition of an image name wins. Parsed image definitions are cached on disk per image path and reused for as
+        long as the specs.yaml they came from is unchanged, so warm invocations do not parse any yaml.
+        """
+        with ThreadPoolExecutor() as pool:
+            scans = list(pool.map(self._scan_dir, [Path(path) for path in paths]))
+            loads = [
+                [(d, pool.submit(self._load_image_dir, d, cached.get(d.name))) for d in image_dirs]
+                for _, cached, image_dirs in scans
+            ]
+
+            for (cache_file, cached, _), load in zip(scans, loads):
+                entries = dict()
+                for name, future in load:
+                    # check for duplicate image
+                    if name.name in self._image_names:
+                        logger.info("The image definition in '{}' is being skipped because it has the same name as an already imported image.".format(name))
+                        continue
+
+                    entry = future.result()
+                    entries[name.name] = entry
+                    for spec in entry["versions"]:
+                        self.images.add(
+                            Image(
+                                name.name,
+                                spec,
+                                config.get("velocity:system"),
+                                config.get("velocity:backend"),
+                                config.get("velocity:distro"),
+                                str(name),
+                            )
+                        )
+                        self._image_names.add(name.name)
+                    self.constraints.extend(tuple(c) for c in entry["constraints"])
 
-        for name in [x for x in p.iterdir() if x.is_dir() and x.name[0] != "."]:
-            # check for duplicate image
-            duplicate_image = False
-            for _i in self.images:
-                if _i.name == name.name:
-                    duplicate_image = name
-                    break
-            if duplicate_image:
-                logger.info("The image definition in '{}' is being skipped because it has the same name as an already imported image.".format(duplicate_image))
-                continue
+                if entries != cached:
+                    write_cache(cache_file, entries)
+
+    @staticmethod
+    def _scan_dir(path: Path) -> tuple[Path, dict, list[Path]]:
+        """Read the cached definitions of an image path and list its image directories in name order."""
+        if not path.is_dir():
+            raise NotADirectoryError(f"Image path {path} is not a directory!")
+        cache_file = cache_path(
+            "repos",
+            str(path.resolve()),
+            config.get("velocity:system"),
+            config.get("velocity:backend"),
+            config.get("velocity:distro"),
+        )
+        image_dirs = sorted(x for x in path.iterdir() if x.is_dir() and x.name[0] != ".")
+        return cache_file, read_cache(cache_file) or dict(), image_dirs
 
-            # process metadata
-            with open(name.joinpath("specs.yaml"), "r") as fi:
-                specs_file = yaml_safe_load(fi)
-                # add versions
-                for version in specs_file["versions"]:
-                    if isinstance(version["spec"], list):
-                        specs = version["spec"]
+    @classmethod
+    def _load_image_dir(cls, image_dir: Path, entry: dict | None) -> dict:
+        """Get the definition in image_dir, reusing the cached entry if specs.yaml has not changed."""
+        stamp = file_stamp(image_dir.joinpath("specs.yaml"))
+        if stamp is None or entry is None or entry["stamp"] != stamp:
+            logger.debug("Parsing image definition in '{}'.".format(image_dir))
+            versions, constraints = cls._parse_image_dir(image_dir)
+            entry = {"stamp": stamp, "versions": versions, "constraints": constraints}
+        return entry
+
+    @staticmethod
+    def _parse_image_dir(image_dir: Path) -> tuple[list[str], list[tuple[str, str, str, str, str]]]:
+        """Parse the specs.yaml in image_dir into its available versions and its constraints."""
+        versions = list()
+        constraints = list()
+        # process metadata
+        with open(image_dir.joinpath("specs.yaml"), "r") as fi:
+            specs_file = yaml_load(fi, Loader=YamlSafeLoader)
+            # add versions
+            for version in specs_file["versions"]:
+                if isinstance(version["spec"], list):
+                    specs = version["spec"]
+                else:
+                    specs = [
+                        version["spec"],
+                    ]
+                for spec in specs:
+                    image = Image(
+                        image_dir.name,
+                        spec,
+                        config.get("velocity:system"),
+                        config.get("velocity:backend"),
+                        config.get("velocity:distro"),
+                        str(image_dir),
+                    )
+                    if "when" not in version or image.satisfies(version["when"]):
+                        versions.append(spec)
+            # add constraints
+            # dependencies
+            if "dependencies" in specs_file:
+                for dependency in specs_file["dependencies"]:
+                    if isinstance(dependency["spec"], list):
+                        specs = dependency["spec"]
                     else:
                         specs = [
-                            version["spec"],
+                            dependency["spec"],
                         ]
                     for spec in specs:
-                        image = Image(
-                            name.name,
-                            spec,
-                            config.get("velocity:system"),
-                            config.get("velocity:backend"),
-                            config.get("velocity:distro"),
-                            str(name),
-                        )
-                        if "when" in version:
-                            if image.satisfies(version["when"]):
-                                self.images.add(image)
-                        else:
-                            self.images.add(image)
-                # add constraints
-                # dependencies
-                if "dependencies" in specs_file:
-                    for dependency in specs_file["dependencies"]:
-                        if isinstance(dependency["spec"], list):
-                            specs = dependency["spec"]
-                        else:
-                            specs = [
-                                dependency["spec"],
-                            ]
-                        for spec in specs:
-                            self.constraints.append(
-                                (
-                                    name.name,
-                                    dependency["when"] if "when" in dependency else "",
-                                    "dependency",
-                                    spec,
-                                    dependency["scope"] if "scope" in dependency else "image",
-                                )
-                            )
-                # templates
-                if "templates" in specs_file:
-                    for template in specs_file["templates"]:
-                        if isinstance(template["name"], list):
-                            specs = template["name"]
-                        else:
-                            specs = [
-                                template["name"],
-                            ]
-                        for spec in specs:
-                            self.constraints.append(
-                                (
-                                    name.name,
-                                    template["when"] if "when" in template else "",
-                                    "template",
-                                    spec,
-                                    template["scope"] if "scope" in template else "image",
-                                )
-                            )
-                # arguments
-                if "arguments" in specs_file:
-                    for argument in specs_file["arguments"]:
-                        if isinstance(argument["value"], list):
-                            specs = argument["value"]
-                        else:
-                            specs = [
-                                argument["value"],
-                            ]
-                        for spec in specs:
-                            self.constraints.append(
-                                (
-                                    name.name,
-                                    argument["when"] if "when" in argument else "",
-                                    "argument",
-                                    spec,
-                                    argument["scope"] if "scope" in argument else "image",
-                                )
+                        constraints.append(
+                            (
+                                image_dir.name,
+                                dependency["when"] if "when" in dependency else "",
+                                "dependency",
+                                spec,
+                                dependency["scope"] if "scope" in dependency else "image",
                             )
-                # variables
-                if "variables" in specs_file:
-                    for variable in specs_file["variables"]:
-                        self.constraints.append(
+                        )
+            # templates
+            if "templates" in specs_file:
+                for template in specs_file["templates"]:
+                    if isinstance(template["name"], list):
+                        specs = template["name"]
+                    else:
+                        specs = [
+                            template["name"],
+                        ]
+                    for spec in specs:
+                        constraints.append(
                             (
-                                name.name,
-                                variable["when"] if "when" in variable else "",
-                                "variable",
-                                "{}={}".format(variable["name"], variable["value"]),
-                                variable["scope"] if "scope" in variable else "image",
+                                image_dir.name,
+                                template["when"] if "when" in template else "",
+                                "template",
+                                spec,
+                                template["scope"] if "scope" in template else "image",
                             )
                         )
-                # files
-                if "files" in specs_file:
-                    for file in specs_file["files"]:
-                        if isinstance(file["name"], list):
-                            specs = file["name"]
-                        else:
-                            specs = [
-                                file["name"],
-                            ]
-                        for spec in specs:
-                            self.constraints.append(
-                                (
-                                    name.name,
-                                    file["when"] if "when" in file else "",
-                                    "file",
-                                    spec,
-                                    file["scope"] if "scope" in file else "image",
-                                )
+            # arguments
+            if "arguments" in specs_file:
+                for argument in specs_file["arguments"]:
+                    if isinstance(argument["value"], list):
+                        specs = argument["value"]
+                    else:
+                        specs = [
+                            argument["value"],
+                        ]
+                    for spec in specs:
+                        constraints.append(
+                            (
+                                image_dir.name,
+                                argument["when"] if "when" in argument else "",
+                                "argument",
+                                spec,
+                                argument["scope"] if "scope" in argument else "image",
                             )
-                # prologs
-                if "prologs" in specs_file:
-                    for prolog in specs_file["prologs"]:
-                        self.constraints.append(
+                        )
+            # variables
+            if "variables" in specs_file:
+                for variable in specs_file["variables"]:
+                    constraints.append(
+                        (
+                            image_dir.name,
+                            variable["when"] if "when" in variable else "",
+                            "variable",
+                            "{}={}".format(variable["name"], variable["value"]),
+                            variable["scope"] if "scope" in variable else "image",
+                        )
+                    )
+            # files
+            if "files" in specs_file:
+                for file in specs_file["files"]:
+                    if isinstance(file["name"], list):
+                        specs = file["name"]
+                    else:
+                        specs = [
+                            file["name"],
+                        ]
+                    for spec in specs:
+                        constraints.append(
                             (
-                                name.name,
-                                prolog["when"] if "when" in prolog else "",
-                                "prolog",
-                                prolog["script"],
-                                prolog["scope"] if "scope" in prolog else "image",
+                                image_dir.name,
+                                file["when"] if "when" in file else "",
+                                "file",
+                                spec,
+                                file["scope"] if "scope" in file else "image",
                             )
                         )
+            # prologs
+            if "prologs" in specs_file:
+                for prolog in specs_file["prologs"]:
+                    constraints.append(
+                        (
+                            image_dir.name,
+                            prolog["when"] if "when" in prolog else "",
+                            "prolog",
+                            prolog["script"],
+                            prolog["scope"] if "scope" in prolog else "image",
+                        )
+                    )
+        return versions, constraints
 
-    def create_build_recipe(self, targets: list[str]) -> tuple[tuple, ImageGraph]:
-        """Create an ordered build recipe of images."""
-        images: set[Image] = deepcopy(self.images)
+    @classmethod
+    def _create_graph(
+        cls, images: set[Image] | tuple[Image], index: ImageIndex | None = None, nodes: dict[int, Image] | None = None
+    ) -> "ImageGraph":
+        """Create a dependency graph for a collection of images. An existing index of images that images are overlays
+        of can be reused by passing it with nodes (see ImageIndex.find)."""
+        from ._dag import ImageGraph
 
+        ig = ImageGraph()
+        ig.add_nodes_from(images)
+        if index is None:
+            index = ImageIndex(images)
+        edges: list[tuple[Image, Image]] = list()
+        for image in images:
+            for dep in image.dependencies:
+                for di in index.find(dep, nodes):
+                    edges.append((image, di))
+        # add all edges at once so that the DAG requirement is only checked once
+        ig.add_edges_from(edges)
+        return ig
+
+    def _index_constraints(self) -> ConstraintIndex:
+        """Get the constraint index, rebuilding it if constraints has changed since it was built."""
+        if self._constraint_index is None or self._constraint_index.constraints != tuple(self.constraints):
+            self._constraint_index = ConstraintIndex(self.constraints)
+        return self._constraint_index
+
+    def _propagate_dependencies(self, images: set[Image], bt: tuple[Image]) -> None:
+        """Apply dependency constraints until no more dependencies are added.
+
+        Conditions only change when an image gains a dependency (^name), so after a first pass over every dependency
+        constraint only the constraints that reference a newly added dependency are evaluated again. Build scope
+        constraints are evaluated on the images in bt and image scope constraints on the image that changed.
+        """
+        # the hashes of the images change as dependencies are added so track them by identity
+        by_name: dict[str, list[Image]] = dict()
+        for image in images:
+            by_name.setdefault(image.name, list()).append(image)
+        in_build: set[int] = set(id(b) for b in bt)
+
+        # dependency constraints and the constraints that have to be evaluated again when a dependency is added
+        index = self._index_constraints()
+        watchers: dict[str, list[int]] = dict()
+        for i in range(len(index.constraints)):
+            if index.constraints[i][2] == "dependency":
+                for _, attribute, value in index.when[i].parts:
+                    if attribute == "dependency":
+                        watchers.setdefault(value, list()).append(i)
+
+        worklist: list[tuple[Image, str]] = list()
+        fired: set[int] = set()
+
+        def apply(image: Image, conditional: str | Spec, spec: str) -> None:
+            if image.apply_constraint(conditional, "dependency", spec):
+                worklist.append((image, spec))
+
+        def evaluate(i: int, image: Image) -> None:
+            constraint = index.constraints[i]
+            if constraint[4] == "build":
+                # apply to every image once any image in the build meets the condition
+                if i not in fired and id(image) in in_build and index.when[i].matches(image):
+                    fired.add(i)
+                    for target in by_name.get(constraint[0], list()) if constraint[0] != "" else images:
+                        apply(target, constraint[0], constraint[3])
+            elif constraint[0] == "" or image.name == constraint[0]:
+                apply(image, index.conditions[i], constraint[3])
+
+        # first pass
+        for i, constraint in enumerate(index.constraints):
+            if constraint[2] != "dependency":
+                continue
+            if constraint[4] == "build":
+                for targ in bt:
+                    evaluate(i, targ)
+            else:
+                for image in by_name.get(constraint[0], list()) if constraint[0] != "" else images:
+                    evaluate(i, image)
+
+        # re-evaluate the constraints that depend on added dependencies
+        while len(worklist) > 0:
+            image, added = worklist.pop()
+            for i in watchers.get(added, list()):
+                evaluate(i, image)
+
+    @staticmethod
+    def _parse_targets(targets: list[str]) -> list[Target]:
+        """Parse target specs (e.g. 'gcc@12:') into build targets."""
         build_targets: list[Target] = list()
         for target in targets:
             res = re_fullmatch(
@@ -783,67 +961,210 @@ class ImageRepo(metaclass=OurMeta):
                     build_targets.append(Target(t, DepOp.LE))
             else:
                 raise NoAvailableBuild("No available build!")
+        return build_targets
 
-        # pre-burner graph
-        for constraint in self.constraints:
-            for image in images:
-                if image.apply_constraint("{} {}".format(constraint[0], constraint[1]), constraint[2], constraint[3]):
-                    images_changed = True
-        ig = ImageGraph()
-        for image in images:
-            ig.add_node(image)
-        for image in images:
-            for dep in image.dependencies:
-                for di in images:
-                    if di.satisfies(dep):
-                        ig.add_edge(image, di)
+    def _prepare(self) -> tuple[set[Image], "ImageGraph", ImageIndex]:
+        """Apply the constraints to overlays of the images of the repo and create the pre-burner graph and an index of
+        the images. None of them depend on the build targets so they can be shared by any number of resolutions."""
+        # resolve on overlays so that the images of the repo are never modified
+        images: set[Image] = set(image.overlay() for image in self.images)
 
-        bt: tuple[Image] = ig.create_build_recipe(build_targets)
-
-        # apply constraints for the build scope
+        # pre-burner graph (an image is only affected by its own constraints so they are applied image by image)
+        index = self._index_constraints()
+        for image in images:
+            for i in index.for_name(image.name):
+                constraint = index.constraints[i]
+                image.apply_constraint(index.conditions[i], constraint[2], constraint[3])
+        index = ImageIndex(images)
+        return images, self._create_graph(images, index), index
+
+    def _resolve(
+        self, prepared: tuple[set[Image], "ImageGraph", ImageIndex], build_targets: list[Target]
+    ) -> tuple[tuple, "ImageGraph"]:
+        """Create an ordered build recipe from prepared images (see _prepare) without modifying them."""
+        prepared_images, ig, image_index = prepared
+        index = self._index_constraints()
+        overlays: dict[int, Image] = {id(image): image.overlay() for image in prepared_images}
+        images: set[Image] = set(overlays.values())
+
+        bt: tuple[Image] = tuple(overlays[id(b)] for b in ig.create_build_recipe(build_targets))
+
+        # add dependencies until nothing changes so that the loop below only needs a single pass
+        self._propagate_dependencies(images, bt)
+
+        # apply constraints for the build scope. Dependencies are complete at this point so conditions no longer
+        # change and every image can be handled on its own
         images_changed: bool = True
         while images_changed:
             images_changed = False
-            for constraint in self.constraints:
-                if constraint[4] == "build":
-                    for targ in bt:
-                        if targ.satisfies(constraint[1]):
-                            for image in images:
-                                if image.apply_constraint(constraint[0], constraint[2], constraint[3]):
-                                    images_changed = True
-                # "image" or "universal"
-                else:
-                    for image in images:
-                        if image.apply_constraint(
-                            "{} {}".format(constraint[0], constraint[1]), constraint[2], constraint[3]
-                        ):
+            fired = set(i for i in index.by_scope.get("build", list()) if any(index.when[i].matches(t) for t in bt))
+            for image in images:
+                for i in index.for_name(image.name):
+                    constraint = index.constraints[i]
+                    if constraint[4] == "build":
+                        if i in fired and image.apply_constraint(constraint[0], constraint[2], constraint[3]):
                             images_changed = True
+                    # "image" or "universal"
+                    elif image.apply_constraint(index.conditions[i], constraint[2], constraint[3]):
+                        images_changed = True
 
         # create graph
-        ig = ImageGraph()
-        for image in images:
-            ig.add_node(image)
-        for image in images:
-            for dep in image.dependencies:
-                for di in images:
-                    if di.satisfies(dep):
-                        ig.add_edge(image, di)
+        ig = self._create_graph(images, image_index, overlays)
 
         bt: tuple[Image] = ig.create_build_recipe(build_targets)
 
         # update images so that their hash includes the layers below them
         cumulative_deps: int = 0
         for b in bt:
+            b.materialize()
             b.underlay = cumulative_deps
             cumulative_deps = cumulative_deps + int(b.id, 16)
 
-        bt_ig = ImageGraph()
-        for image in bt:
-            bt_ig.add_node(image)
-        for image in bt:
-            for dep in image.dependencies:
-                for di in bt:
-                    if di.satisfies(dep):
-                        bt_ig.add_edge(image, di)
+        bt_ig = self._create_graph(bt)
 
         return bt, bt_ig
+
+    def create_build_recipe(self, targets: list[str]) -> tuple[tuple, "ImageGraph"]:
+        """Create an ordered build recipe of images and the dependency graph of the recipe. Recipes are cached on disk
+        (see get_build_recipe).
+
+        The recipe lists the generations of graph.topological_generations() one after the other. Images in the same
+        generation do not depend on each other.
+        """
+        cache_file: Path = self._recipe_cache_file(targets)
+        recipe: tuple[Image] | None = self._load_recipe(cache_file)
+        if recipe is not None:
+            return recipe, self._create_graph(recipe)
+        return self._create_build_recipe(targets, cache_file)
+
+    def get_build_recipe(self, targets: list[str]) -> tuple[Image]:
+        """Get an ordered build recipe of images.
+
+        Recipes are cached on disk keyed by the targets, the system, backend and distro and a digest of the repo
+        (see _digest). Unlike create_build_recipe a cached recipe is returned without creating any graph.
+        """
+        cache_file: Path = self._recipe_cache_file(targets)
+        recipe: tuple[Image] | None = self._load_recipe(cache_file)
+        if recipe is None:
+            recipe = self._create_build_recipe(targets, cache_file)[0]
+        return recipe
+
+    def _create_build_recipe(self, targets: list[str], cache_file: Path) -> tuple[tuple, "ImageGraph"]:
+        """Resolve the recipe of targets and cache it in cache_file."""
+        build_targets: list[Target] = self._parse_targets([target.strip() for target in targets])
+        recipe, recipe_ig = self._resolve(self._prepare(), build_targets)
+        self._store_recipe(cache_file, recipe)
+        return recipe, recipe_ig
+
+    def _digest(self) -> str:
+        """Get a digest of everything in the repo that a recipe depends on: the images, the constraints (including
+        the ones from the config) and the templates of the images."""
+        digest = sha256()
+        paths: set[Path] = set()
+        for image in sorted(self.images, key=lambda i: (i.name, str(i.version), str(i.path))):
+            digest.update("{}@{} {}\n".format(image.name, image.version, image.path).encode())
+            paths.add(image.path)
+        for constraint in self.constraints:
+            digest.update("{}\n".format("|".join(constraint)).encode())
+        for path in sorted(paths):
+            templates = path.joinpath("templates")
+            for template in sorted(templates.iterdir()) if templates.is_dir() else ():
+                digest.update("{} {}\n".format(template, file_stamp(template)).encode())
+        return digest.hexdigest()
+
+    def _recipe_cache_file(self, targets: list[str]) -> Path:
+        """Get the path of the cache file for the recipe of targets."""
+        return cache_path(
+            "recipes",
+            "\0".join(target.strip() for target in targets),
+            config.get("velocity:system"),
+            config.get("velocity:backend"),
+            config.get("velocity:distro"),
+            self._digest(),
+        )
+
+    @staticmethod
+    def _load_recipe(cache_file: Path) -> tuple[Image] | None:
+        """Load a cached recipe or return None if there is none."""
+        cached = read_cache(cache_file)
+        if cached is None:
+            return None
+        recipe: list[Image] = list()
+        try:
+            for entry in cached:
+                image = Image(
+                    entry["name"],
+                    entry["version"],
+                    config.get("velocity:system"),
+                    config.get("velocity:backend"),
+                    config.get("velocity:distro"),
+                    entry["path"],
+                )
+                image.dependencies = set(entry["dependencies"])
+                image.variables = dict(entry["variables"])
+                image.arguments = set(entry["arguments"])
+                image.template = entry["template"]
+                image.files = set(entry["files"])
+                image.prolog = entry["prolog"]
+                image.underlay = entry["underlay"]
+                # keep the identity the recipe was created with instead of computing it again
+                image._hash = entry["hash"]
+                recipe.append(image)
+        except (KeyError, TypeError, ValueError):
+            return None
+        logger.debug("Using cached build recipe '{}'.".format(cache_file))
+        return tuple(recipe)
+
+    @staticmethod
+    def _store_recipe(cache_file: Path, recipe: tuple[Image]) -> None:
+        """Cache a recipe."""
+        write_cache(
+            cache_file,
+            [
+                {
+                    "name": image.name,
+                    "version": str(image.version),
+                    "dependencies": list(image.dependencies),
+                    "variables": image.variables,
+                    "arguments": list(image.arguments),
+                    "template": image.template,
+                    "files": list(image.files),
+                    "prolog": image.prolog,
+                    "underlay": image.underlay,
+                    "path": str(image.path),
+                    "hash": image.hash,
+                }
+                for image in recipe
+            ],
+        )
+
+    def create_build_recipes(self, target_sets: list[list[str]]) -> list[tuple[tuple, "ImageGraph"] | Exception]:
+        """Create an ordered build recipe for each set of targets.
+
+        The constraints that do not depend on the targets are applied once for all target sets and identical target
+        sets are only resolved once. A target set that cannot be resolved gets the exception it raised instead of a
+        recipe.
+        """
+        prepared: tuple[set[Image], "ImageGraph", ImageIndex] | None = None
+        resolved: dict[tuple[str, ...], tuple[tuple, "ImageGraph"] | Exception] = dict()
+        for targets in target_sets:
+            key = tuple(targets)
+            if key in resolved:
+                continue
+            try:
+                build_targets: list[Target] = self._parse_targets(targets)
+                if prepared is None:
+                    prepared = self._prepare()
+                resolved[key] = self._resolve(prepared, build_targets)
+            except (NoAvailableBuild, InvalidImageVersionError, CannotFindDependency, EdgeViolatesDAG) as e:
+                resolved[key] = e
+        return [resolved[tuple(targets)] for targets in target_sets]
+
+
+def __getattr__(name: str):
+    """Load ImageGraph (and with it networkx) on first use."""
+    if name == "ImageGraph":
+        from ._dag import ImageGraph
+
+        return ImageGraph
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
@@ -0,0 +1,188 @@
+"""Content addressed store of built layers that can be shared between users and velocity processes.
+
+Layers are keyed by the hash of the image and of every layer below it. They are published atomically and every change to
+the index (which records the size and last use of every layer) is made while holding a lock on the store, so several
+velocity processes can use the store at once. The least recently used layers are evicted to stay below the quota.
+"""
+
+from contextlib import contextmanager
+from hashlib import sha256
+from json import dumps as json_dumps, load as json_load
+from os import O_CREAT, O_RDONLY, chmod, close, getpid, open as os_open, replace
+from pathlib import Path
+from re import fullmatch as re_fullmatch
+from shutil import copyfileobj
+from tempfile import NamedTemporaryFile
+from time import time
+from typing import BinaryIO, Iterator
+
+from loguru import logger
+
+from ._config import config
+from ._graph import Image
+from ._stage import reflink
+from ._tools import OurMeta, trace_function
+
+# bump whenever the layout of the store changes
+STORE_FORMAT: int = 1
+
+# layers are locked through a fixed number of lock files (picked by the first hex digits of their key) so the lock
+# files do not pile up with every layer ever built
+LOCK_SLOT_DIGITS: int = 2
+
+UNITS: dict[str, int] = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def _clone(fi: BinaryIO, dest: Path) -> None:
+    """Reflink the open file fi to dest if the filesystem supports it and copy it otherwise.
+
+    Layers are never hard linked so a layer in a build directory never shares its inode (and mode) with the store.
+    """
+    if not reflink(fi, dest):
+        with open(dest, "wb") as fo:
+            copyfileobj(fi, fo, 1 << 20)
+
+
+@trace_function
+def parse_size(size: str | int) -> int:
+    """Parse a size in bytes with an optional K, M, G or T suffix (e.g. 100G)."""
+    m = re_fullmatch(r"\s*([0-9]+(?:\.[0-9]+)?)\s*([KMGT]?)I?B?\s*", str(size).upper())
+    if m is None:
+        raise ValueError("Invalid size '{}'!".format(size))
+    return int(float(m.group(1)) * UNITS[m.group(2)])
+
+
+@trace_function
+def format_size(size: int) -> str:
+    """Format a size in bytes for humans."""
+    for unit in ("T", "G", "M", "K"):
+        if size >= UNITS[unit]:
+            return "{:.1f}{}".format(size / UNITS[unit], unit)
+    return "{}B".format(size)
+
+
+class LayerStore(metaclass=OurMeta):
+    """Layer store in a directory. The directory has to be writable (e.g. setgid and group writable) by every user
+    that shares it."""
+
+    def __init__(self, path: str | Path, quota: int) -> None:
+        self.path: Path = Path(path)
+        self.quota: int = quota
+        self.path.joinpath("layers").mkdir(mode=0o777, parents=True, exist_ok=True)
+        self.path.joinpath("locks").mkdir(mode=0o777, parents=True, exist_ok=True)
+
+    @classmethod
+    def from_config(cls) -> "LayerStore | None":
+        """Open the configured store or return None if it is disabled (no path or a size of 0)."""
+        path = config.get("velocity:layer_cache:path", warn_on_miss=False)
+        quota = parse_size(config.get("velocity:layer_cache:size"))
+        if path is None or quota == 0:
+            return None
+        return cls(path, quota)
+
+    @staticmethod
+    def key(parent: str | None, image: Image, backend: str) -> str:
+        """Get the key of the layer of image built on top of the layer with key parent."""
+        return sha256("{}|{}|{}".format(parent, image.hash, backend).encode()).hexdigest()
+
+    def layer_path(self, key: str) -> Path:
+        """Get the path a layer is stored at."""
+        return self.path.joinpath("layers", key[:2], key)
+
+    @contextmanager
+    def lock(self, key: str = None) -> Iterator[None]:
+        """Hold an exclusive lock on the index or, with a key, on a layer while it is being built.
+
+        Layers whose keys start with the same LOCK_SLOT_DIGITS hex digits share a lock.
+        """
+        from fcntl import LOCK_EX, flock
+
+        name = "index" if key is None else "layer-{}".format(key[:LOCK_SLOT_DIGITS])
+        # read only so that users who did not create the lock file can still lock it
+        fd = os_open(self.path.joinpath("locks", "{}.lock".format(name)), O_RDONLY | O_CREAT, 0o666)
+        try:
+            flock(fd, LOCK_EX)
+            yield
+        finally:
+            close(fd)
+
+    def _read_index(self) -> dict[str, dict]:
+        """Read the index. A missing or unreadable index is empty."""
+        try:
+            with open(self.path.joinpath("index.json"), "r") as fi:
+                content = json_load(fi)
+        except (OSError, ValueError):
+            return dict()
+        if not isinstance(content, dict) or content.get("format") != STORE_FORMAT:
+            return dict()
+        return content.get("layers", dict())
+
+    def _write_index(self, layers: dict[str, dict]) -> None:
+        """Atomically write the index."""
+        with NamedTemporaryFile("w", dir=self.path, prefix=".", suffix=".tmp", delete=False) as fo:
+            fo.write(json_dumps({"format": STORE_FORMAT, "layers": layers}))
+        chmod(fo.name, 0o664)
+        replace(fo.name, self.path.joinpath("index.json"))
+
+    def fetch(self, key: str, dest: Path) -> bool:
+        """Put a copy of the layer with key at dest. Return False if the store does not have it."""
+        with self.lock():
+            layers = self._read_index()
+            if key not in layers:
+                return False
+            try:
+                fi = open(self.layer_path(key), "rb")
+            except FileNotFoundError:
+                return False
+            layers[key]["used"] = time()
+            self._write_index(layers)
+        # copy outside of the lock, evicting the layer meanwhile only removes the name of the open file
+        tmp = dest.with_name(".{}.tmp".format(dest.name))
+        tmp.unlink(missing_ok=True)
+        with fi:
+            _clone(fi, tmp)
+        replace(tmp, dest)
+        logger.debug("Fetched layer {} ({}) from the layer cache.".format(key, layers[key]["name"]))
+        return True
+
+    def publish(self, key: str, src: Path, name: str) -> None:
+        """Add the layer at src to the store and evict the least recently used layers if it is over its quota."""
+        target = self.layer_path(key)
+        target.parent.mkdir(mode=0o777, exist_ok=True)
+        # copy outside of the lock, only the rename (which makes the layer visible) has to be atomic
+        tmp = target.with_name(".{}.{}.tmp".format(key, getpid()))
+        with open(src, "rb") as fi:
+            _clone(fi, tmp)
+        # read only so a layer that is shared with other users is not changed under them
+        chmod(tmp, 0o444)
+        with self.lock():
+            replace(tmp, target)
+            layers = self._read_index()
+            layers[key] = {"name": name, "size": target.stat().st_size, "used": time()}
+            self._evict(layers, self.quota)
+            self._write_index(layers)
+
+    def _evict(self, layers: dict[str, dict], size: int) -> list[str]:
+        """Remove the least recently used layers from layers and the store until they take at most size bytes."""
+        total = sum(layer["size"] for layer in layers.values())
+        evicted: list[str] = list()
+        for key in sorted(layers, key=lambda k: layers[k]["used"]):
+            if total <= size:
+                break
+            self.layer_path(key).unlink(missing_ok=True)
+            total -= layers.pop(key)["size"]
+            evicted.append(key)
+        return evicted
+
+    def entries(self) -> list[dict]:
+        """Get every layer in the store, the most recently used first."""
+        layers = self._read_index()
+        return sorted(({"key": k, **v} for k, v in layers.items()), key=lambda layer: layer["used"], reverse=True)
+
+    def prune(self, size: int = None) -> list[str]:
+        """Evict the least recently used layers until the store is at most size (the quota by default) bytes."""
+        with self.lock():
+            layers = self._read_index()
+            evicted = self._evict(layers, self.quota if size is None else size)
+            self._write_index(layers)
+        return evicted
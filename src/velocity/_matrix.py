@@ -0,0 +1,77 @@
+"""Resolve a matrix of target sets against one image repository."""
+
+from itertools import product
+from re import findall as re_findall, split as re_split
+
+from ._config import config
+from ._graph import Image, ImageRepo
+from ._tools import trace_function
+
+
+@trace_function
+def expand_target_set(target_set: str) -> list[list[str]]:
+    """Expand a target set with brace alternatives into the cartesian product of its targets.
+
+    e.g. 'gcc@{12,13} cuda@{11.8,12.2}' gives [['gcc@12', 'cuda@11.8'], ['gcc@12', 'cuda@12.2'], ...].
+    """
+    words: list[list[str]] = list()
+    for word in target_set.split():
+        # expand every brace group in the word
+        pieces: list[str] = re_split(r"\{[^{}]*\}", word)
+        alternatives: list[list[str]] = [group.split(",") for group in re_findall(r"\{([^{}]*)\}", word)]
+        expanded: list[str] = list()
+        for choice in product(*alternatives):
+            expanded.append(pieces[0] + "".join(c + p for c, p in zip(choice, pieces[1:])))
+        words.append(expanded)
+    return [list(targets) for targets in product(*words)] if len(words) > 0 else list()
+
+
+@trace_function
+def image_to_dict(image: Image) -> dict:
+    """Get a json serializable description of a resolved image."""
+    return {
+        "name": image.name,
+        "version": str(image.version),
+        "id": image.id,
+        "hash": image.hash,
+        "dependencies": sorted(image.dependencies),
+        "variables": dict(sorted(image.variables.items())),
+        "arguments": sorted(image.arguments),
+        "template": image.template,
+        "files": sorted(image.files),
+        "prolog": image.prolog,
+        "path": str(image.path),
+    }
+
+
+@trace_function
+def resolve_matrix(repo: ImageRepo, target_sets: list[str]) -> dict:
+    """Resolve every target set (expanded with expand_target_set) against repo.
+
+    Returns a json serializable document with one cell per expanded target set. Each cell has the recipe in build order
+    and the ids of its images grouped into generations (see ImageGraph.topological_generations). Cells that cannot be
+    resolved have an error instead.
+    """
+    expanded: list[list[str]] = [targets for target_set in target_sets for targets in expand_target_set(target_set)]
+    cells: list[dict] = list()
+    for targets, result in zip(expanded, repo.create_build_recipes(expanded)):
+        if isinstance(result, Exception):
+            cells.append({"targets": targets, "error": "{}: {}".format(type(result).__name__, result)})
+        else:
+            recipe, graph = result
+            cells.append(
+                {
+                    "targets": targets,
+                    "recipe": [image_to_dict(image) for image in recipe],
+                    # images in the same generation do not depend on each other
+                    "generations": [
+                        [image.id for image in generation] for generation in graph.topological_generations()
+                    ],
+                }
+            )
+    return {
+        "system": config.get("velocity:system"),
+        "backend": config.get("velocity:backend"),
+        "distro": config.get("velocity:distro"),
+        "cells": cells,
+    }
@@ -0,0 +1,157 @@
+"""Stage the files of an image into its build directory. Only files that changed since the last build are staged."""
+
+from concurrent.futures import ThreadPoolExecutor
+from errno import EINVAL, ENOTTY, EOPNOTSUPP
+from hashlib import sha256
+from os import cpu_count, link, stat, stat_result, utime, walk
+from pathlib import Path
+from shutil import copy2, copystat, rmtree
+from typing import BinaryIO
+
+from loguru import logger
+
+from ._tools import trace_function
+
+# linux ioctl to share the extents of a file (btrfs, xfs, ...)
+FICLONE: int = 0x40049409
+
+# devices that do not support reflinks, so they are only tried once per device
+_no_reflink: set[int] = set()
+
+
+def _digest(path: Path) -> str:
+    """Get the sha256 of a file."""
+    h = sha256()
+    with open(path, "rb") as fi:
+        while chunk := fi.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def reflink(fi: BinaryIO, dest: Path, device: int = None) -> bool:
+    """Try to create dest as a copy on write clone of the open file fi. device is that of dest's directory (looked up
+    if not given)."""
+    device = device if device is not None else stat(dest.parent).st_dev
+    if device in _no_reflink:
+        return False
+    try:
+        from fcntl import ioctl
+    except ImportError:
+        _no_reflink.add(device)
+        return False
+    with open(dest, "wb") as fo:
+        try:
+            ioctl(fo.fileno(), FICLONE, fi.fileno())
+            cloned = True
+        except OSError as e:
+            cloned = False
+            # only give up on filesystems that cannot clone at all, not after a clone from another filesystem
+            if e.errno in (EOPNOTSUPP, ENOTTY, EINVAL):
+                _no_reflink.add(device)
+    if not cloned:
+        dest.unlink()
+    return cloned
+
+
+def _stage_file(src: Path, dest: Path) -> tuple[str, int]:
+    """Stage a single file. Returns how it was staged (unchanged, linked or copied) and the bytes staged."""
+    st: stat_result = stat(src)
+    try:
+        dt: stat_result | None = stat(dest)
+    except FileNotFoundError:
+        dt = None
+    if dt is not None:
+        if dt.st_size == st.st_size and (dt.st_mtime_ns == st.st_mtime_ns or _digest(src) == _digest(dest)):
+            if dt.st_mtime_ns != st.st_mtime_ns:
+                utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns))
+            return "unchanged", 0
+        # never write through a hard link to the source
+        dest.unlink()
+
+    device = stat(dest.parent).st_dev
+    with open(src, "rb") as fi:
+        cloned = reflink(fi, dest, device)
+    if cloned:
+        copystat(src, dest)
+        return "linked", st.st_size
+    if device == st.st_dev:
+        try:
+            link(src, dest)
+            return "linked", st.st_size
+        except OSError:
+            pass
+    copy2(src, dest)
+    return "copied", st.st_size
+
+
+def _remove(path: Path) -> None:
+    """Remove a file or directory tree."""
+    if path.is_dir() and not path.is_symlink():
+        rmtree(path)
+    else:
+        path.unlink()
+
+
+def _plan(src: Path, dest: Path) -> tuple[list[tuple[Path, Path]], int]:
+    """Create the directories of src under dest and remove everything from dest that is not in src.
+
+    Returns the files that need to be staged and the number of entries that were removed.
+    """
+    if not src.is_dir():
+        if dest.is_dir() and not dest.is_symlink():
+            rmtree(dest)
+            return [(src, dest)], 1
+        return [(src, dest)], 0
+
+    removed = 0
+    if dest.exists() and not dest.is_dir():
+        dest.unlink()
+        removed += 1
+    files: list[tuple[Path, Path]] = list()
+    # symlinked directories are staged with their contents (like copytree did) unless they point back up the tree
+    for root, dirs, names in walk(src, followlinks=True):
+        resolved = Path(root).resolve()
+        for d in [d for d in dirs if Path(root, d).is_symlink()]:
+            if resolved.is_relative_to(Path(root, d).resolve()):
+                logger.warning("Not staging '{}', it links to a directory it is in.".format(Path(root, d)))
+                dirs.remove(d)
+        relative = Path(root).relative_to(src)
+        target = dest.joinpath(relative)
+        target.mkdir(parents=True, exist_ok=True)
+        files.extend((Path(root, n), target.joinpath(n)) for n in names)
+        # drop what is no longer in the source (or changed between file and directory)
+        expected = {n: False for n in names}
+        expected.update((d, True) for d in dirs)
+        for entry in target.iterdir():
+            if entry.name not in expected or expected[entry.name] != (entry.is_dir() and not entry.is_symlink()):
+                _remove(entry)
+                removed += 1
+    return files, removed
+
+
+@trace_function
+def stage_files(entries: list[tuple[Path, Path]], workers: int = None) -> dict[str, int]:
+    """Mirror every source (a file or a directory) at its destination.
+
+    Files with the same size and modification time (or the same content) as their destination are left alone. Others
+    are reflinked or hard linked if the destination is on the same filesystem and copied otherwise, in parallel with up
+    to workers threads. Returns how many files were copied, linked, unchanged and removed and the bytes staged.
+    """
+    counts: dict[str, int] = {"copied": 0, "linked": 0, "unchanged": 0, "removed": 0, "bytes": 0}
+    files: list[tuple[Path, Path]] = list()
+    for src, dest in entries:
+        planned, removed = _plan(Path(src), Path(dest))
+        files.extend(planned)
+        counts["removed"] += removed
+
+    # a few chunks per thread so many small files do not pay for a future each but a few large files are still spread
+    workers = workers if workers is not None else min(32, (cpu_count() or 1) + 4)
+    step = max(1, len(files) // (workers * 4))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for staged in pool.map(
+            lambda chunk: [_stage_file(*f) for f in chunk], (files[i : i + step] for i in range(0, len(files), step))
+        ):
+            for how, size in staged:
+                counts[how] += 1
+                counts["bytes"] += size
+    return counts
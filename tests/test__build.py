@@ -0,0 +1,255 @@
+from unittest import TestCase
+from gzip import open as gzip_open
+from os import environ, pathsep
+from pathlib import Path
+from re import sub
+from subprocess import run
+from sys import executable
+from tempfile import TemporaryDirectory
+from tests.test__graph import write_image
+
+SRC = Path(__file__).parent.parent.joinpath("src").absolute()
+
+
+class TestRun(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.log = Path(self.tmp.name, "log")
+        self.env = dict(environ)
+        self.env.update({"PYTHONPATH": str(SRC), "HOME": self.tmp.name, "VELOCITY_LOG_COMPRESSION": "none"})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _run(self, cmd: str, verbose: bool = False, setup: str = "", report: str = "process_time()"):
+        """Run cmd with velocity's run in a new interpreter and print report afterwards."""
+        code = "from time import process_time\nfrom velocity._build import BuildLog, run\n{}\nrun({!r}, {!r}, {})\nprint({})"
+        return run(
+            [executable, "-c", code.format(setup, cmd, str(self.log), verbose, report)],
+            env=self.env,
+            capture_output=True,
+            text=True,
+        )
+
+    def test_log(self):
+        result = self._run("echo one; echo two >&2; printf 'three\\r\\nfour'; printf 'five' >&2", verbose=True)
+        self.assertEqual(0, result.returncode, result.stderr)
+        lines = self.log.read_text().splitlines()
+        self.assertEqual(["STDOUT: one", "STDOUT: three", "STDOUT: four"], [ln for ln in lines if "STDOUT" in ln])
+        self.assertEqual(["STDERR: two", "STDERR: five"], [ln for ln in lines if "STDERR" in ln])
+        # verbose prints stdout only
+        output = sub(r"\x1b\[[0-9;]*m", "", result.stdout)
+        self.assertIn("one", output)
+        self.assertIn("four", output)
+        self.assertNotIn("two", output)
+
+    def test_wait_is_idle(self):
+        result = self._run("sleep 1")
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertLess(float(result.stdout.splitlines()[-1]), 0.5)
+
+    def test_exit_code(self):
+        result = self._run("echo out; echo failed >&2; exit 3")
+        self.assertEqual(3, result.returncode)
+        output = sub(r"\x1b\[[0-9;]*m", "", result.stdout)
+        self.assertIn("failed", output)
+        self.assertNotIn("out", output)
+
+    def test_stderr_tail(self):
+        self.env["VELOCITY_STDERR_LINES"] = "5"
+        result = self._run("seq 1 1000 >&2; exit 1")
+        self.assertEqual(1, result.returncode)
+        output = [ln.strip() for ln in sub(r"\x1b\[[0-9;]*m", "", result.stdout).splitlines()]
+        # only the tail is printed, the log has everything
+        self.assertEqual(["996", "997", "998", "999", "1000"], output[-5:])
+        self.assertNotIn("995", output)
+        self.assertIn("... 995 earlier lines of stderr are in {}".format(self.log), result.stdout)
+        self.assertEqual(1000, len(self.log.read_text().splitlines()))
+
+    def test_memory_is_flat(self):
+        # the first run loads everything run needs so only the output is traced
+        setup = "from tracemalloc import get_traced_memory, start\nrun('true', {!r})\nstart()".format(str(self.log))
+        peaks = list()
+        for lines in (100000, 400000):
+            result = self._run("seq 1 {} >&2".format(lines), setup=setup, report="get_traced_memory()[1]")
+            self.assertEqual(0, result.returncode, result.stderr)
+            peaks.append(int(result.stdout.split()[-1]))
+        self.assertLess(peaks[1], peaks[0] * 1.5)
+
+    def test_log_compression(self):
+        self.env["VELOCITY_LOG_COMPRESSION"] = "gzip"
+        result = self._run("seq 1 100000; echo failed >&2; exit 3")
+        self.assertEqual(3, result.returncode)
+        self.assertFalse(self.log.exists())
+        # everything is in the log even though the command failed
+        with gzip_open(Path("{}.gz".format(self.log)), "rt") as fi:
+            lines = fi.read().splitlines()
+        self.assertEqual(100001, len(lines))
+        self.assertEqual(["STDOUT: 1", "STDOUT: 100000", "STDERR: failed"], [lines[0], lines[-2], lines[-1]])
+
+    def test_log_is_buffered(self):
+        # the command reads its own log, the first line is only there once it was due
+        cmd = "echo one; cat {0}; sleep 1; cat {0}".format(self.log)
+        result = self._run(cmd, setup="BuildLog.flush_interval = 0.5")
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertEqual(["STDOUT: one", "STDOUT: STDOUT: one"], self.log.read_text().splitlines())
+
+        result = self._run(cmd)
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertEqual(["STDOUT: one"], self.log.read_text().splitlines())
+
+
+class TestImageBuilder(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        root = Path(self.tmp.name)
+        images = root.joinpath("images")
+        write_image(images, "ubuntu", {"versions": [{"spec": ["24.04"]}]})
+        images.joinpath("ubuntu", "templates", "default.vtmp").write_text("@from\n    docker.io/ubuntu:24.04\n")
+        write_image(images, "gcc", {"versions": [{"spec": ["12.3.0"]}], "dependencies": [{"spec": "ubuntu"}]})
+        write_image(images, "cuda", {"versions": [{"spec": ["12.2"]}], "dependencies": [{"spec": "gcc"}]})
+        for name in ("python", "pytorch"):
+            write_image(images, name, {"versions": [{"spec": ["1.0"]}], "dependencies": [{"spec": "cuda"}]})
+        write_image(images, "cmake", {"versions": [{"spec": ["3.30"]}], "dependencies": [{"spec": "ubuntu"}]})
+
+        # the builder only checks that the backend exists, a dry run never calls it
+        bin_dir = root.joinpath("bin")
+        bin_dir.mkdir()
+        bin_dir.joinpath("apptainer").write_text("#!/bin/sh\nexit 1\n")
+        bin_dir.joinpath("apptainer").chmod(0o755)
+
+        self.env = dict(environ)
+        self.env.update(
+            {
+                "PYTHONPATH": str(SRC),
+                "HOME": str(root),
+                "PATH": str(bin_dir) + pathsep + environ.get("PATH", ""),
+                "VELOCITY_CONFIG_DIR": str(root.joinpath("config")),
+                "VELOCITY_IMAGE_PATH": str(images),
+                "VELOCITY_BUILD_DIR": str(root.joinpath("build")),
+                "VELOCITY_CACHE_DIR": str(root.joinpath("cache")),
+                "VELOCITY_BACKEND": "apptainer",
+                "VELOCITY_SYSTEM": "frontier",
+                "VELOCITY_DISTRO": "ubuntu",
+            }
+        )
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _build(self, *targets: str, dry_run: bool = True) -> list[str]:
+        result = run(
+            [executable, "-m", "velocity", "build", *(["--dry-run"] if dry_run else []), *targets],
+            env=self.env,
+            cwd=self.tmp.name,
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(0, result.returncode, result.stderr)
+        return sub(r"\x1b\[[0-9;]*m", "", result.stdout).splitlines()
+
+    def test_shared_prefix(self):
+        lines = self._build("cuda", "{python,pytorch}")
+        builds = [ln.split("BUILD ")[1].split()[0] for ln in lines if ": BUILD " in ln]
+        self.assertEqual(["ubuntu@24.04", "gcc@12.3.0", "cuda@12.2", "python@1.0", "pytorch@1.0"], builds)
+        built = [ln.split("BUILT: ")[1] for ln in lines if "BUILT: " in ln]
+        self.assertEqual(2, len(built))
+        self.assertTrue(built[0].endswith("python-1.0_cuda-12.2_gcc-12.3.0_ubuntu-24.04_frontier-ubuntu.sif"))
+        self.assertTrue(built[1].endswith("pytorch-1.0_cuda-12.2_gcc-12.3.0_ubuntu-24.04_frontier-ubuntu.sif"))
+
+        # every branch starts from the last image it shares
+        for name in ("python", "pytorch"):
+            (script,) = Path(self.tmp.name, "build").glob("{}-1.0-*/script".format(name))
+            self.assertIn("cuda-12.2-", script.read_text())
+
+    def test_variables_match_single_builds(self):
+        # cuda renders the python version so python and pytorch cannot share it, gcc does not and is shared
+        images = Path(self.tmp.name, "images")
+        images.joinpath("cuda", "templates", "default.vtmp").write_text(
+            "@from\n    {{ __base__ }}\n@run\n    echo python {{ __python__version__ }}\n"
+        )
+        lines = self._build("cuda", "{python,pytorch}")
+        builds = [ln.split("BUILD ")[1].split()[0] for ln in lines if ": BUILD " in ln]
+        self.assertEqual(["ubuntu@24.04", "gcc@12.3.0", "cuda@12.2", "python@1.0", "cuda@12.2", "pytorch@1.0"], builds)
+        scripts = sorted(p.read_text() for p in Path(self.tmp.name, "build").glob("cuda-12.2-*/script"))
+        self.assertEqual(2, len(scripts))
+        # only the python recipe has a python version
+        self.assertEqual([False, True], sorted("echo python 1.0" in script for script in scripts))
+
+        # the shared gcc layer gets every version of its recipe like a single recipe build does
+        (variables,) = Path(self.tmp.name, "build").glob("gcc-12.3.0-*/variables")
+        self.assertIn("export __cuda__version__=12.2", variables.read_text())
+        self.assertIn("export __python__version__=1.0", variables.read_text())
+
+    def test_unquoted_braces(self):
+        # what the shell makes of an unquoted {python,python@1.0}
+        lines = self._build("cuda", "python", "python@1.0")
+        self.assertEqual(1, len([ln for ln in lines if "'python' is targeted more than once" in ln]))
+        self.assertEqual(1, len([ln for ln in lines if "BUILT: " in ln]))
+        self.assertFalse(any("targeted more than once" in ln for ln in self._build("cuda", "{python,pytorch}")))
+
+    def test_same_image_on_different_prefixes(self):
+        # python is on top of gcc in one recipe and cmake in the other so it gets two layers
+        write_image(
+            Path(self.tmp.name, "images"),
+            "python",
+            {"versions": [{"spec": ["20.0"]}], "dependencies": [{"spec": "ubuntu"}]},
+        )
+        lines = self._build("{gcc,cmake}", "python")
+        builds = [ln.split("BUILD ")[1].split()[0] for ln in lines if ": BUILD " in ln]
+        self.assertEqual(["ubuntu@24.04", "gcc@12.3.0", "python@20.0", "cmake@3.30", "python@20.0"], builds)
+        self.assertEqual(2, len(list(Path(self.tmp.name, "build").glob("python-20.0-*"))))
+
+    def test_layer_cache(self):
+        # a fake apptainer that logs its builds and writes the script to the image
+        root = Path(self.tmp.name)
+        root.joinpath("bin", "apptainer").write_text(
+            '#!/bin/sh\necho "$@" >> "$HOME/builds"\nwhile [ $# -gt 2 ]; do shift; done\ncp "$2" "$1"\n'
+        )
+        # the cache is off unless it has a path
+        build_dir = self.env["VELOCITY_BUILD_DIR"]
+        self.env["VELOCITY_BUILD_DIR"] = str(root.joinpath("plain"))
+        self._build("cmake", dry_run=False)
+        self.env["VELOCITY_BUILD_DIR"] = build_dir
+        self.assertFalse(root.joinpath("cache", "layers").exists())
+        result = run(
+            [executable, "-m", "velocity", "cache"], env=self.env, cwd=self.tmp.name, capture_output=True, text=True
+        )
+        self.assertIn("The layer cache is disabled", result.stdout)
+        root.joinpath("builds").unlink()
+
+        self.env["VELOCITY_LAYER_CACHE"] = str(root.joinpath("layers"))
+        # building again in the same directory reuses the layers and replaces the final image
+        for _ in range(2):
+            self._build("cuda", dry_run=False)
+            self.assertEqual(3, len(root.joinpath("builds").read_text().splitlines()))
+            final = root.joinpath("cuda-12.2_gcc-12.3.0_ubuntu-24.04_frontier-ubuntu.sif")
+            self.assertEqual(0o200, final.stat().st_mode & 0o200)
+            self.assertEqual(0o200, next(root.joinpath("build").glob("cuda-12.2-*/*.sif")).stat().st_mode & 0o200)
+
+        # another build directory (e.g. another user) gets the layers from the cache
+        self.env["VELOCITY_BUILD_DIR"] = str(root.joinpath("other"))
+        self._build("{python,pytorch}", dry_run=False)
+        builds = root.joinpath("builds").read_text().splitlines()
+        self.assertEqual(5, len(builds))
+        self.assertTrue(all("python-1.0-" in b or "pytorch-1.0-" in b for b in builds[3:]))
+        (cuda,) = root.joinpath("other").glob("cuda-12.2-*/*.sif")
+        # it is the layer the first build made
+        self.assertIn(str(root.joinpath("build", "gcc-12.3.0-")), cuda.read_text())
+
+        result = run(
+            [executable, "-m", "velocity", "cache"], env=self.env, cwd=self.tmp.name, capture_output=True, text=True
+        )
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertIn("in 5 layers", result.stdout)
+        self.assertIn("pytorch@1.0", result.stdout)
+
+        result = run(
+            [executable, "-m", "velocity", "cache", "prune", "--size", "0"],
+            env=self.env,
+            cwd=self.tmp.name,
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertEqual(5, result.stdout.count("EVICTED"))
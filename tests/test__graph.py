@@ -1,8 +1,27 @@
 from unittest import TestCase
+from unittest.mock import patch
+from io import StringIO
+from itertools import product
+from networkx import has_path
+from os import utime
+from pathlib import Path
+from random import Random
 from re import compile
+from tempfile import TemporaryDirectory
+from tracemalloc import start as tm_start, stop as tm_stop, get_traced_memory
+from src.velocity._config import config
+from src.velocity._exceptions import CannotFindDependency, EdgeViolatesDAG, NoAvailableBuild
+from yaml import safe_dump, load as yaml_load
 from src.velocity._graph import (
     Version,
-    Image
+    Image,
+    ImageGraph,
+    ImageIndex,
+    ConstraintIndex,
+    ImageRepo,
+    Target,
+    DepOp,
+    compile_spec
 )
 
 
@@ -147,6 +166,23 @@ class TestVersion(TestCase):
         self.assertTrue(one <= two)
         self.assertFalse(one < two)
 
+    def test_preferred(self):
+        self.assertTrue(Version("12.3.0").preferred(Version("12.3")))
+        self.assertTrue(Version("12.3.0").preferred(Version("12.3.0-rc1")))
+        self.assertTrue(Version("12.3.0-rc2").preferred(Version("12.3.0-rc1")))
+        self.assertFalse(Version("12.3").preferred(Version("12.3.0-rc1")))
+        self.assertFalse(Version("12.3.0").preferred(Version("12.3.0")))
+
+        # suffixes compare up to the first nine characters for equality
+        self.assertTrue(Version("1.0.0-abcdefghij") == Version("1.0.0-abcdefghik"))
+        self.assertFalse(Version("1.0.0-abcdefghik") > Version("1.0.0-abcdefghij"))
+        self.assertTrue(Version("1.0.0-abcdefghik").preferred(Version("1.0.0-abcdefghij")))
+
+        # versions that cannot be parsed equal every version
+        self.assertTrue(Version("x") == Version("12.3"))
+        with self.assertRaises(AttributeError):
+            Version("1").other = 1
+
 
 class TestImage(TestCase):
     def test_satisfies_spec(self):
@@ -189,8 +225,502 @@ class TestImage(TestCase):
         self.assertFalse(image.satisfies("dictro=opensuse"))
         self.assertFalse(image.satisfies("ubuntu"))
 
+        # dependencies
+        image.dependencies.add("ubuntu")
+        self.assertTrue(image.satisfies("^ubuntu"))
+        self.assertTrue(image.satisfies("gcc@12: ^ubuntu system=frontier"))
+        self.assertFalse(image.satisfies("^opensuse"))
+        self.assertFalse(image.satisfies("test ^ubuntu"))
+
+        # empty
+        self.assertTrue(image.satisfies(""))
+        self.assertTrue(image.satisfies("  "))
+
+    def test_compile_spec(self):
+        spec = compile_spec("gcc@12: system=frontier")
+        self.assertIs(spec, compile_spec("gcc@12: system=frontier"))
+        self.assertEqual("gcc@12: system=frontier", str(spec))
+        self.assertTrue(spec.matches(Image("gcc", "12.3.0", "frontier", "apptainer", "ubuntu", "")))
+        self.assertFalse(spec.matches(Image("gcc", "11.3.0", "frontier", "apptainer", "ubuntu", "")))
+        self.assertFalse(spec.matches(Image("gcc", "12.3.0", "summit", "apptainer", "ubuntu", "")))
+
     #def test_add_spec(self):
     #    self.fail()
 
-    #def test_hash(self):
-    #    self.fail()
+    def test_hash(self):
+        with TemporaryDirectory() as tmp:
+            Path(tmp).joinpath("templates").mkdir()
+            template = Path(tmp).joinpath("templates", "default.vtmp")
+            template.write_text("@from\n    ubuntu\n")
+            image = Image("gcc", "12.3.0", "frontier", "apptainer", "ubuntu", tmp)
+            first = image.hash
+            self.assertEqual(first, Image("gcc", "12.3.0", "frontier", "apptainer", "ubuntu", tmp).hash)
+            self.assertEqual(first[:7], image.id)
+
+            # the identity is cached so touching the template does not change it
+            template.write_text("@from\n    opensuse\n")
+            utime(template, ns=(0, 0))
+            self.assertEqual(first, image.hash)
+
+            # modifying the image recomputes it
+            self.assertFalse(image.apply_constraint("gcc", "argument", "--fakeroot"))
+            second = image.hash
+            self.assertNotEqual(first, second)
+            self.assertNotEqual(first, Image("gcc", "12.3.0", "frontier", "apptainer", "ubuntu", tmp).hash)
+            image.underlay = 5
+            self.assertNotEqual(second, image.hash)
+
+            # constraints that do not apply leave it alone
+            third = image.hash
+            self.assertFalse(image.apply_constraint("python", "argument", "--other"))
+            self.assertEqual(third, image.hash)
+
+    def test_memory(self):
+        with TemporaryDirectory() as tmp:
+            # build the strings the way an import does so that none of them are shared to begin with
+            fields = [
+                ("".join(("gc", "c")), "{}.0.0".format(i), "".join(("front", "ier")), "apptainer", "ubuntu", tmp)
+                for i in range(1000)
+            ]
+            tm_start()
+            try:
+                base = get_traced_memory()[0]
+                images = [Image(*f) for f in fields]
+                per_image = (get_traced_memory()[0] - base) / len(images)
+                base = get_traced_memory()[0]
+                overlays = [image.overlay() for image in images]
+                per_overlay = (get_traced_memory()[0] - base) / len(overlays)
+            finally:
+                tm_stop()
+            self.assertLess(per_image, 800)
+            self.assertLess(per_overlay, 300)
+            self.assertIs(images[0].name, images[1].name)
+            self.assertIs(images[0].system, images[1].system)
+            self.assertIs(images[0].path, images[1].path)
+            with self.assertRaises(AttributeError):
+                images[0].other = None
+
+            # collections are created on first use and overlays copy them before writing
+            hash = images[0].hash
+            self.assertEqual(hash, overlays[0].hash)
+            overlays[0].dependencies.add("python")
+            self.assertEqual(set(), images[0].dependencies)
+            self.assertEqual({"python"}, overlays[0].dependencies)
+
+
+class TestImageIndex(TestCase):
+    def test_find(self):
+        rng = Random(5)
+        versions = ["1", "12", "12.3", "12.3.0", "12.3.0-rc1", "12.3.1", "12.10.2", "12.2", "13", "13.1.0", "2.0", "x"]
+        images = [Image(n, v, "frontier", "apptainer", "ubuntu", "") for n in ("gcc", "llvm") for v in versions]
+        index = ImageIndex(images)
+        bounds = ["1", "12", "12.3", "12.3.0", "12.3.1", "12.9", "13.0", "2", "0"]
+        specs = ["gcc", "gcc:", "llvm system=frontier", "system=frontier", "^ubuntu", "cuda", "cuda@12"]
+        for _ in range(300):
+            left, right = rng.choice(bounds), rng.choice(bounds)
+            name = rng.choice(("gcc", "llvm"))
+            specs.append(rng.choice(["{}@{}", "{}@{}:", "{}@:{}", "{}@{}:{}"]).format(name, left, right))
+        for spec in specs:
+            expected = set(i for i in images if i.satisfies(spec))
+            self.assertEqual(expected, set(index.find(spec)), spec)
+
+
+class TestConstraintIndex(TestCase):
+    def test_index(self):
+        constraints = [
+            ("gcc", "", "dependency", "ubuntu", "image"),
+            ("", "^ubuntu", "argument", "--fakeroot", "global"),
+            ("cuda", "^gcc", "variable", "A=1", "build"),
+            ("gcc", "gcc@13:", "variable", "LANGS=c", "image"),
+        ]
+        index = ConstraintIndex(constraints)
+        # constraints for an image name keep their order and include the global ones
+        self.assertEqual([0, 1, 3], index.for_name("gcc"))
+        self.assertEqual([1, 2], index.for_name("cuda"))
+        self.assertEqual([1], index.for_name("ubuntu"))
+        self.assertEqual({"image": [0, 3], "global": [1], "build": [2]}, index.by_scope)
+
+        gcc12 = Image("gcc", "12.3.0", "", "", "", "")
+        gcc13 = Image("gcc", "13.2.0", "", "", "", "")
+        self.assertFalse(index.conditions[3].matches(gcc12))
+        self.assertTrue(index.conditions[3].matches(gcc13))
+        self.assertFalse(index.conditions[1].matches(gcc13))
+        gcc13.dependencies.add("ubuntu")
+        self.assertTrue(index.conditions[1].matches(gcc13))
+        self.assertIs(compile_spec("^gcc"), index.when[2])
+
+
+def brute_force_recipe(ig: ImageGraph, targets: list[Target]) -> set:
+    """Reference implementation that checks every permutation of candidate versions."""
+    priority_list = list()
+    for t in targets:
+        if t.node.name not in priority_list:
+            priority_list.append(t.node.name)
+    build_set = set()
+    for t in targets:
+        build_set.update(ig.get_similar_nodes(t.node))
+    while True:
+        length = len(build_set)
+        for node in build_set.copy():
+            for d in ig.get_dependencies(node):
+                build_set.add(d)
+                if d.name not in priority_list:
+                    priority_list.append(d.name)
+        if length == len(build_set):
+            break
+    for t in targets:
+        for node in build_set.copy():
+            if node.name == t.node.name:
+                if t.op == DepOp.EQ and node.version != t.node.version:
+                    build_set.remove(node)
+                elif t.op == DepOp.GE and node.version < t.node.version:
+                    build_set.remove(node)
+                elif t.op == DepOp.LE and node.version > t.node.version:
+                    build_set.remove(node)
+    groups = list()
+    for name in priority_list:
+        tmp = [n for n in build_set if n.name == name]
+        tmp.sort(reverse=True)
+        groups.append(tmp)
+    for p in product(*groups):
+        clean_p = set()
+        for n in p:
+            for t in targets:
+                con_targ = [x for x in p if x.name == t.node.name][0]
+                if ig.is_above(con_targ, n):
+                    clean_p.add(n)
+                    break
+        if ig._is_valid_build_tuple(tuple(clean_p)):
+            return clean_p
+    return None
+
+
+class TestImageGraph(TestCase):
+    @staticmethod
+    def _image(name: str, version: str) -> Image:
+        return Image(name, version, "frontier", "apptainer", "ubuntu", "")
+
+    def test_indexes(self):
+        gcc12 = self._image("gcc", "12.3.0")
+        gcc13 = self._image("gcc", "13.2.0")
+        ubuntu = self._image("ubuntu", "22.04")
+        ig = ImageGraph()
+        ig.add_nodes_from([gcc12, gcc13])
+        ig.add_node(ubuntu)
+        ig.add_edge(gcc12, ubuntu)
+        # an equal copy of a node resolves to the node in the graph
+        copy = self._image("ubuntu", "22.04")
+        ig.add_edge(gcc13, copy)
+
+        self.assertEqual({gcc12, gcc13}, ig.get_similar_nodes(self._image("gcc", "")))
+        self.assertEqual(set(), ig.get_similar_nodes(self._image("cuda", "")))
+        self.assertIs(ubuntu, list(ig.get_dependencies(gcc13))[0])
+        self.assertEqual({"ubuntu": {ubuntu}}, ig.get_dependency_groups(gcc12))
+        self.assertEqual(set(), ig.get_dependencies(ubuntu))
+
+    def test_dag(self):
+        rng = Random(7)
+        images = [self._image("n{}".format(i), "1.0") for i in range(30)]
+        ig = ImageGraph()
+        for image in rng.sample(images, len(images)):
+            ig.add_node(image)
+        # edges only point from lower to higher index so all of them can be added in any order
+        edges = [(images[i], images[j]) for i in range(30) for j in range(i + 1, 30) if rng.random() < 0.2]
+        for u, v in rng.sample(edges, len(edges)):
+            ig.add_edge(u, v)
+        for u, v in ig.edges:
+            self.assertLess(ig._order[u], ig._order[v])
+
+        # closing a cycle reports it starting with the offending edge
+        u, v = edges[-1]
+        with patch("src.velocity._exceptions.stderr", StringIO()), self.assertRaises(EdgeViolatesDAG):
+            ig.add_edge(v, u)
+        self.assertEqual((v, u), ig._update_order(v, u)[0])
+        cycle = ig._update_order(v, u)
+        for (a, b), (c, d) in zip(cycle, cycle[1:] + cycle[:1]):
+            self.assertEqual(b, c)
+            self.assertTrue(ig.has_edge(a, b))
+
+    def test_add_edges_from(self):
+        images = [self._image("n{}".format(i), "1.0") for i in range(4)]
+        ig = ImageGraph()
+        ig.add_nodes_from(images)
+        ig.add_edges_from([(images[0], images[1]), (images[1], images[2]), (images[0], images[3])])
+        for u, v in ig.edges:
+            self.assertLess(ig._order[u], ig._order[v])
+        self.assertEqual({images[1], images[3]}, ig.get_dependencies(images[0]))
+
+        with patch("src.velocity._exceptions.stderr", StringIO()), self.assertRaises(EdgeViolatesDAG):
+            ig.add_edges_from([(images[3], images[2]), (images[2], images[0])])
+        with self.assertRaises(CannotFindDependency):
+            ig.add_edges_from([(images[0], self._image("missing", "1.0"))])
+
+    def test_is_above(self):
+        rng = Random(3)
+        images = [self._image("n{}".format(i), "1.0") for i in range(25)]
+        ig = ImageGraph()
+        ig.add_nodes_from(images)
+        ig.add_edges_from([(images[i], images[j]) for i in range(25) for j in range(i + 1, 25) if rng.random() < 0.1])
+        for u, v in product(images, repeat=2):
+            self.assertEqual(has_path(ig, u, v), ig.is_above(u, v))
+
+        # the closure follows changes to the graph
+        self.assertFalse(ig.is_above(images[-1], images[0]))
+        ig.add_edge(images[-2], images[-1])
+        ig.add_edge(images[0], images[-2])
+        self.assertTrue(ig.is_above(images[0], images[-1]))
+        self.assertFalse(ig.is_above(images[-1], images[0]))
+
+    def test_topological_generations(self):
+        ubuntu = self._image("ubuntu", "22.04")
+        gcc = self._image("gcc", "12.3.0")
+        cmake = self._image("cmake", "3.27")
+        python = self._image("python", "3.11")
+        mpich = self._image("mpich", "3.4.3")
+        ig = ImageGraph()
+        ig.add_nodes_from([ubuntu, gcc, cmake, python, mpich])
+        ig.add_edges_from([(gcc, ubuntu), (cmake, ubuntu), (python, ubuntu), (mpich, gcc), (mpich, cmake)])
+        # lowest version first and images with the same version by name
+        self.assertEqual([[ubuntu], [python, cmake, gcc], [mpich]], ig.topological_generations())
+        # dependencies outside of the nodes are ignored
+        self.assertEqual([[cmake, gcc], [mpich]], ig.topological_generations({gcc, cmake, mpich}))
+
+        recipe = ig.create_build_recipe([Target(self._image("mpich", ""), DepOp.UN)])
+        self.assertEqual((ubuntu, cmake, gcc, mpich), recipe)
+
+    def test_create_build_recipe(self):
+        gcc12 = self._image("gcc", "12.3.0")
+        gcc13 = self._image("gcc", "13.2.0")
+        cuda11 = self._image("cuda", "11.8")
+        cuda12 = self._image("cuda", "12.2")
+        ubuntu = self._image("ubuntu", "22.04")
+        ig = ImageGraph()
+        for n in (gcc12, gcc13, cuda11, cuda12, ubuntu):
+            ig.add_node(n)
+        for n in (gcc12, gcc13, cuda11, cuda12):
+            ig.add_edge(n, ubuntu)
+        # cuda 12.2 does not work with gcc 13 so the highest versions cannot be combined
+        ig.add_edge(cuda11, gcc12)
+        ig.add_edge(cuda11, gcc13)
+        ig.add_edge(cuda12, gcc12)
+
+        recipe = ig.create_build_recipe([Target(self._image("cuda", ""), DepOp.UN)])
+        self.assertEqual([ubuntu, gcc12, cuda12], list(recipe))
+
+        # earlier targets get their preferred version first
+        recipe = ig.create_build_recipe([Target(self._image("gcc", ""), DepOp.UN), Target(cuda12, DepOp.UN)])
+        self.assertEqual([ubuntu, gcc13, cuda11], list(recipe))
+
+        recipe = ig.create_build_recipe([Target(gcc13, DepOp.EQ), Target(self._image("cuda", ""), DepOp.UN)])
+        self.assertEqual([ubuntu, gcc13, cuda11], list(recipe))
+
+        with self.assertRaises(NoAvailableBuild):
+            ig.create_build_recipe([Target(gcc13, DepOp.EQ), Target(cuda12, DepOp.EQ)])
+
+    def test_create_build_recipe_matches_brute_force(self):
+        rng = Random(3)
+        for _ in range(40):
+            names = ["n{}".format(i) for i in range(5)]
+            versions = {n: [self._image(n, "{}.0".format(v)) for v in range(rng.randint(1, 3))] for n in names}
+            ig = ImageGraph()
+            for n in names:
+                for image in versions[n]:
+                    ig.add_node(image)
+            for i, n in enumerate(names):
+                for child in names[i + 1 :]:
+                    if rng.random() < 0.4:
+                        for image in versions[n]:
+                            deps = rng.sample(versions[child], rng.randint(1, len(versions[child])))
+                            for d in deps:
+                                ig.add_edge(image, d)
+            targets = [Target(self._image(n, ""), DepOp.UN) for n in rng.sample(names, rng.randint(1, 2))]
+
+            expected = brute_force_recipe(ig, targets)
+            if expected is None:
+                with self.assertRaises(NoAvailableBuild):
+                    ig.create_build_recipe(targets)
+            else:
+                self.assertEqual(expected, set(ig.create_build_recipe(targets)))
+
+
+def write_image(root: Path, name: str, specs: dict) -> None:
+    """Write an image definition to a repository directory."""
+    root.joinpath(name, "templates").mkdir(parents=True, exist_ok=True)
+    root.joinpath(name, "specs.yaml").write_text(safe_dump(specs))
+    root.joinpath(name, "templates", "default.vtmp").write_text("@from\n    {{ __base__ }}\n")
+
+
+class TestImageRepo(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        root = Path(self.tmp.name)
+        write_image(root, "ubuntu", {"versions": [{"spec": ["22.04", "24.04"]}]})
+        write_image(
+            root,
+            "gcc",
+            {
+                "versions": [{"spec": ["12.3.0", "13.2.0"]}],
+                "dependencies": [{"spec": "ubuntu"}],
+                "variables": [{"name": "LANGS", "value": "c,c++", "when": "gcc@13:"}],
+            },
+        )
+        write_image(
+            root,
+            "cuda",
+            {
+                "versions": [{"spec": ["11.8", "12.2"]}],
+                "dependencies": [{"spec": "gcc@:12", "when": "cuda@12"}, {"spec": "gcc", "when": "cuda@11"}],
+                "arguments": [{"value": "--fakeroot", "when": "^ubuntu", "scope": "build"}],
+            },
+        )
+        self.cache = TemporaryDirectory()
+        self.cache_dir = config.get("velocity:cache_dir")
+        config.set("velocity:cache_dir", self.cache.name)
+        self.repo = ImageRepo()
+        self.repo.import_from_dir(self.tmp.name)
+
+    def tearDown(self):
+        config.set("velocity:cache_dir", self.cache_dir)
+        self.cache.cleanup()
+        self.tmp.cleanup()
+
+    @staticmethod
+    def _names(recipe) -> list[str]:
+        return ["{}@{}".format(r.name, r.version) for r in recipe]
+
+    def test_create_build_recipe(self):
+        recipe, graph = self.repo.create_build_recipe(["gcc"])
+        self.assertEqual(["ubuntu@24.04", "gcc@13.2.0"], self._names(recipe))
+        self.assertEqual({"LANGS": "c,c++"}, recipe[1].variables)
+        self.assertEqual(set(recipe), set(graph.nodes))
+
+        recipe, _ = self.repo.create_build_recipe(["cuda"])
+        self.assertEqual(["ubuntu@24.04", "gcc@12.3.0", "cuda@12.2"], self._names(recipe))
+        self.assertEqual({"--fakeroot"}, recipe[2].arguments)
+
+        recipe, graph = self.repo.create_build_recipe(["gcc@13", "cuda"])
+        self.assertEqual(["ubuntu@24.04", "gcc@13.2.0", "cuda@11.8"], self._names(recipe))
+        self.assertEqual(list(recipe), [r for generation in graph.topological_generations() for r in generation])
+
+    def test_repo_is_not_modified(self):
+        before = {(i.name, str(i.version)): (i.hash, set(i.dependencies), dict(i.variables)) for i in self.repo.images}
+        first, _ = self.repo.create_build_recipe(["cuda"])
+        second, _ = self.repo.create_build_recipe(["cuda"])
+        after = {(i.name, str(i.version)): (i.hash, set(i.dependencies), dict(i.variables)) for i in self.repo.images}
+        self.assertEqual(before, after)
+        self.assertEqual([r.id for r in first], [r.id for r in second])
+        self.assertTrue(all(len(r.dependencies) == 0 for r in self.repo.images))
+
+    def test_import_cache(self):
+        def snapshot(repo):
+            return {i.hash for i in repo.images}, sorted(repo.constraints)
+
+        # a warm import must not parse any yaml
+        with patch("src.velocity._graph.yaml_load", side_effect=AssertionError("specs.yaml was parsed")):
+            warm = ImageRepo()
+            warm.import_from_dir(self.tmp.name)
+        self.assertEqual(snapshot(self.repo), snapshot(warm))
+        self.assertTrue(all(isinstance(c, tuple) for c in warm.constraints))
+
+        # changing a definition invalidates only that definition
+        write_image(Path(self.tmp.name), "ubuntu", {"versions": [{"spec": ["20.04", "22.04", "24.04"]}]})
+        with patch("src.velocity._graph.yaml_load", wraps=yaml_load) as parse:
+            changed = ImageRepo()
+            changed.import_from_dir(self.tmp.name)
+        self.assertEqual(1, parse.call_count)
+        self.assertEqual(
+            ["20.04", "22.04", "24.04"], sorted(str(i.version) for i in changed.images if i.name == "ubuntu")
+        )
+
+        # an unreadable cache is ignored
+        for cache_file in Path(self.cache.name).rglob("*.json"):
+            cache_file.write_text("{")
+        broken = ImageRepo()
+        broken.import_from_dir(self.tmp.name)
+        self.assertEqual(snapshot(changed), snapshot(broken))
+
+    def test_recipe_cache(self):
+        def snapshot(recipe):
+            return [(r.id, r.name, str(r.version), r.variables, r.arguments, r.template, str(r.path)) for r in recipe]
+
+        cold, cold_graph = self.repo.create_build_recipe(["cuda"])
+
+        # a warm lookup must not resolve anything or create a graph
+        warm_repo = ImageRepo()
+        warm_repo.import_from_dir(self.tmp.name)
+        with (
+            patch.object(ImageRepo, "_resolve", side_effect=AssertionError("recipe was resolved")),
+            patch.object(ImageRepo, "_create_graph", side_effect=AssertionError("graph was created")),
+        ):
+            warm = warm_repo.get_build_recipe([" cuda "])
+        self.assertEqual(snapshot(cold), snapshot(warm))
+        with patch.object(ImageRepo, "_resolve", side_effect=AssertionError("recipe was resolved")):
+            warm, warm_graph = warm_repo.create_build_recipe(["cuda"])
+        self.assertEqual(set(cold_graph.edges), set(warm_graph.edges))
+
+        # other targets, repo contents or templates are not served from the cache
+        with patch.object(ImageRepo, "_resolve", wraps=warm_repo._resolve) as resolve:
+            self.assertEqual(["ubuntu@24.04", "gcc@13.2.0"], self._names(warm_repo.get_build_recipe(["gcc"])))
+            warm_repo.constraints.append(("cuda", "", "argument", "--sandbox", "image"))
+            self.assertEqual({"--fakeroot", "--sandbox"}, warm_repo.get_build_recipe(["cuda"])[2].arguments)
+            Path(self.tmp.name, "cuda", "templates", "default.vtmp").write_text("@from\n    {{ __base__ }}\n")
+            self.assertNotEqual(cold[2].id, self.repo.get_build_recipe(["cuda"])[2].id)
+        self.assertEqual(3, resolve.call_count)
+
+    def test_constraint_index_is_rebuilt(self):
+        index = self.repo._index_constraints()
+        self.assertIs(index, self.repo._index_constraints())
+        self.repo.constraints.append(("ubuntu", "", "argument", "--sandbox", "image"))
+        index = self.repo._index_constraints()
+        self.assertEqual(tuple(self.repo.constraints), index.constraints)
+        recipe, _ = self.repo.create_build_recipe(["ubuntu"])
+        self.assertEqual({"--sandbox"}, recipe[0].arguments)
+
+    def test_import_from_dirs(self):
+        with TemporaryDirectory() as first, TemporaryDirectory() as second:
+            write_image(Path(first), "gcc", {"versions": [{"spec": "14.1.0"}]})
+            write_image(Path(second), "gcc", {"versions": [{"spec": "9.5.0"}]})
+            write_image(Path(second), "ubuntu", {"versions": [{"spec": "20.04"}]})
+            # a definition that is skipped as a duplicate is never an error
+            write_image(Path(second), "cuda", {})
+
+            repo = ImageRepo()
+            repo.import_from_dirs([first, self.tmp.name, second])
+            self.assertEqual(
+                {"cuda@11.8", "cuda@12.2", "gcc@14.1.0", "ubuntu@22.04", "ubuntu@24.04"},
+                {"{}@{}".format(i.name, i.version) for i in repo.images},
+            )
+            self.assertEqual(Path(first).joinpath("gcc"), next(i.path for i in repo.images if i.name == "gcc"))
+            # only the constraints of imported definitions are kept
+            self.assertEqual({"cuda"}, {c[0] for c in repo.constraints})
+
+            with self.assertRaises(NotADirectoryError):
+                ImageRepo().import_from_dirs([first, str(Path(first).joinpath("missing"))])
+
+    def test_constraint_propagation(self):
+        with TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            for name in ("gcc", "mpich", "ucx"):
+                write_image(root, name, {"versions": [{"spec": "1.0"}]})
+            # each dependency is only added once the one before it has been added
+            write_image(
+                root,
+                "app",
+                {
+                    "versions": [{"spec": "1.0"}],
+                    "dependencies": [
+                        {"spec": "ucx", "when": "^mpich"},
+                        {"spec": "mpich", "when": "^gcc"},
+                        {"spec": "gcc"},
+                    ],
+                    # later constraints override earlier ones no matter when their conditions are met
+                    "templates": [{"name": "special", "when": "^ucx"}, {"name": "plain"}],
+                    "variables": [{"name": "MPI", "value": "none"}, {"name": "MPI", "value": "ucx", "when": "^ucx"}],
+                },
+            )
+            repo = ImageRepo()
+            repo.import_from_dir(tmp)
+            recipe, _ = repo.create_build_recipe(["app"])
+        self.assertEqual({"gcc", "mpich", "ucx"}, recipe[-1].dependencies)
+        self.assertEqual("plain", recipe[-1].template)
+        self.assertEqual({"MPI": "ucx"}, recipe[-1].variables)
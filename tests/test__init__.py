@@ -0,0 +1,43 @@
+from unittest import TestCase
+from os import environ
+from pathlib import Path
+from subprocess import run
+from sys import executable
+from tempfile import TemporaryDirectory
+
+SRC = Path(__file__).parent.parent.joinpath("src").absolute()
+
+
+class TestStartup(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.config_dir = Path(self.tmp.name).joinpath("config")
+        self.env = dict(environ)
+        self.env.update({"PYTHONPATH": str(SRC), "HOME": self.tmp.name, "VELOCITY_CONFIG_DIR": str(self.config_dir)})
+        self.env.pop("VELOCITY_IMAGE_PATH", None)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _modules(self, *args: str) -> set[str]:
+        result = run([executable, "-X", "importtime", *args], env=self.env, capture_output=True, text=True)
+        return {line.split("|")[-1].strip() for line in result.stderr.splitlines() if line.startswith("import time:")}
+
+    def test_import_is_lazy(self):
+        modules = self._modules("-c", "import velocity, velocity._graph")
+        self.assertIn("velocity._graph", modules)
+        for heavy in ("networkx", "velocity._dag", "velocity._build", "velocity._backends"):
+            self.assertNotIn(heavy, modules)
+        # importing velocity does not read the config or create any directories
+        self.assertEqual([], list(Path(self.tmp.name).iterdir()))
+
+    def test_help_is_lazy(self):
+        modules = self._modules("-m", "velocity", "--help")
+        for heavy in ("networkx", "velocity._graph", "velocity._build", "colorama"):
+            self.assertNotIn(heavy, modules)
+        self.assertIn("velocity._config", modules)
+
+    def test_graph_loads_on_demand(self):
+        modules = self._modules("-c", "from velocity._graph import ImageGraph")
+        self.assertIn("networkx", modules)
+        self.assertIn("velocity._dag", modules)
@@ -0,0 +1,175 @@
+from unittest import TestCase
+from unittest.mock import patch
+from fcntl import LOCK_EX, LOCK_NB, LOCK_UN, flock
+from hashlib import sha256
+from os import environ, stat
+from pathlib import Path
+from subprocess import run
+from sys import executable
+from tempfile import TemporaryDirectory
+from src.velocity import _layers
+from src.velocity._layers import LayerStore, format_size, parse_size
+from tests.test__graph import write_image
+
+SRC = Path(__file__).parent.parent.joinpath("src").absolute()
+
+
+class TestSizes(TestCase):
+    def test_parse_size(self):
+        self.assertEqual(0, parse_size("0"))
+        self.assertEqual(1000, parse_size(1000))
+        self.assertEqual(1536, parse_size("1.5K"))
+        self.assertEqual(100 << 30, parse_size("100G"))
+        self.assertEqual(2 << 20, parse_size("2 MiB"))
+        with self.assertRaises(ValueError):
+            parse_size("lots")
+
+    def test_format_size(self):
+        self.assertEqual("512B", format_size(512))
+        self.assertEqual("1.5K", format_size(1536))
+        self.assertEqual("100.0G", format_size(100 << 30))
+
+
+class TestLayerStore(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.store = LayerStore(self.root.joinpath("store"), 250)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _layer(self, name: str, size: int = 100) -> Path:
+        path = self.root.joinpath("{}.sif".format(name))
+        path.write_bytes(name.encode().ljust(size, b"\0"))
+        return path
+
+    def test_publish_fetch(self):
+        self.store.publish("a" * 64, self._layer("a"), "a@1.0")
+        dest = self.root.joinpath("build", "a.sif")
+        dest.parent.mkdir()
+        self.assertTrue(self.store.fetch("a" * 64, dest))
+        self.assertEqual(self.root.joinpath("a.sif").read_bytes(), dest.read_bytes())
+        self.assertFalse(self.store.fetch("b" * 64, self.root.joinpath("build", "b.sif")))
+        self.assertFalse(self.root.joinpath("build", "b.sif").exists())
+        # the store does not share inodes with builds so their modes stay as they are
+        self.assertNotEqual(stat(self.root.joinpath("a.sif")).st_ino, stat(self.store.layer_path("a" * 64)).st_ino)
+        self.assertNotEqual(stat(dest).st_ino, stat(self.store.layer_path("a" * 64)).st_ino)
+        self.assertTrue(stat(self.root.joinpath("a.sif")).st_mode & 0o200)
+        self.assertTrue(stat(dest).st_mode & 0o200)
+        # no temporary files are left behind
+        self.assertEqual(["a.sif"], [p.name for p in dest.parent.iterdir()])
+        self.assertEqual([], list(self.store.path.glob("**/.*.tmp")))
+
+        # the index is shared with other processes through the directory
+        self.assertEqual(0o444, stat(self.store.layer_path("a" * 64)).st_mode & 0o777)
+        (layer,) = LayerStore(self.store.path, 250).entries()
+        self.assertEqual(("a" * 64, "a@1.0", 100), (layer["key"], layer["name"], layer["size"]))
+
+    def test_fetch_copies_outside_of_the_lock(self):
+        self.store.publish("a" * 64, self._layer("a"), "a@1.0")
+        clone = _layers._clone
+
+        def evict_then_clone(fi, dest):
+            # other processes can use the store while the layer is copied (this fails if the lock is held)
+            with open(self.store.path.joinpath("locks", "index.lock"), "rb") as lock:
+                flock(lock.fileno(), LOCK_EX | LOCK_NB)
+                flock(lock.fileno(), LOCK_UN)
+            self.assertEqual(["a" * 64], LayerStore(self.store.path, 250).prune(0))
+            clone(fi, dest)
+
+        with patch.object(_layers, "_clone", side_effect=evict_then_clone):
+            self.assertTrue(self.store.fetch("a" * 64, self.root.joinpath("a-copy.sif")))
+        # the open layer was copied even though it was evicted meanwhile
+        self.assertEqual(self.root.joinpath("a.sif").read_bytes(), self.root.joinpath("a-copy.sif").read_bytes())
+        self.assertEqual([], self.store.entries())
+
+    def test_lock_files_are_bounded(self):
+        for i in range(1000):
+            with self.store.lock(sha256(str(i).encode()).hexdigest()):
+                pass
+        with self.store.lock():
+            pass
+        self.assertLessEqual(len(list(self.store.path.joinpath("locks").iterdir())), 16**2 + 1)
+        # layers that share a slot share a lock
+        with self.store.lock("ab" + "0" * 62):
+            with open(self.store.path.joinpath("locks", "layer-ab.lock"), "rb") as lock:
+                with self.assertRaises(BlockingIOError):
+                    flock(lock.fileno(), LOCK_EX | LOCK_NB)
+
+    def test_lru_eviction(self):
+        self.store.publish("a" * 64, self._layer("a"), "a@1.0")
+        self.store.publish("b" * 64, self._layer("b"), "b@1.0")
+        # using a makes b the least recently used layer
+        self.assertTrue(self.store.fetch("a" * 64, self.root.joinpath("a-copy.sif")))
+        self.store.publish("c" * 64, self._layer("c"), "c@1.0")
+        self.assertEqual(["a@1.0", "c@1.0"], sorted(layer["name"] for layer in self.store.entries()))
+        self.assertFalse(self.store.layer_path("b" * 64).exists())
+        # a fetched layer outlives its eviction
+        self.store.prune(0)
+        self.assertEqual([], self.store.entries())
+        self.assertEqual(b"a", self.root.joinpath("a-copy.sif").read_bytes().rstrip(b"\0"))
+
+    def test_prune(self):
+        for name in ("a", "b"):
+            self.store.publish(name * 64, self._layer(name), "{}@1.0".format(name))
+        self.assertEqual([], self.store.prune())
+        self.assertEqual(["a" * 64], self.store.prune(100))
+        self.assertEqual(["b@1.0"], [layer["name"] for layer in self.store.entries()])
+
+    def test_republish(self):
+        # a layer published again (e.g. by a concurrent build) replaces the old one atomically
+        self.store.publish("a" * 64, self._layer("a"), "a@1.0")
+        old = stat(self.store.layer_path("a" * 64)).st_ino
+        self.root.joinpath("a.sif").unlink()
+        self.store.publish("a" * 64, self._layer("a", 120), "a@1.0")
+        self.assertNotEqual(old, stat(self.store.layer_path("a" * 64)).st_ino)
+        self.assertEqual([120], [layer["size"] for layer in self.store.entries()])
+
+
+class TestLayerKeys(TestCase):
+    def test_stable_across_processes(self):
+        # sets of strings iterate in a different order in every process (see PYTHONHASHSEED)
+        with TemporaryDirectory() as tmp:
+            images = Path(tmp, "images")
+            for name in ("ubuntu", "cmake", "python"):
+                write_image(images, name, {"versions": [{"spec": ["1.0"]}]})
+            write_image(
+                images,
+                "gcc",
+                {
+                    "versions": [{"spec": ["12.3.0"]}],
+                    "dependencies": [{"spec": name} for name in ("ubuntu", "cmake", "python")],
+                    "arguments": [{"value": ["--fakeroot", "--notest", "--fix-perms"]}],
+                    "variables": [{"name": n, "value": v} for n, v in (("A", "1"), ("B", "2"), ("C", "3"))],
+                    "files": [{"name": ["a", "b", "c"]}],
+                },
+            )
+            code = (
+                "from velocity._graph import ImageRepo\n"
+                "from velocity._layers import LayerStore\n"
+                "repo = ImageRepo()\n"
+                "repo.import_from_dir({!r})\n"
+                "key = None\n"
+                "for image in repo.get_build_recipe(['gcc']):\n"
+                "    key = LayerStore.key(key, image, 'apptainer')\n"
+                "print(key)\n"
+            ).format(str(images))
+            keys = set()
+            for seed in ("1", "2", "3", "4", "5", "6"):
+                env = dict(environ)
+                env.update(
+                    {
+                        "PYTHONPATH": str(SRC),
+                        "PYTHONHASHSEED": seed,
+                        "HOME": tmp,
+                        "VELOCITY_CONFIG_DIR": str(Path(tmp, "config")),
+                        # a cache per process so every process resolves the recipe itself
+                        "VELOCITY_CACHE_DIR": str(Path(tmp, "cache", seed)),
+                        "VELOCITY_SYSTEM": "frontier",
+                    }
+                )
+                result = run([executable, "-c", code], env=env, capture_output=True, text=True)
+                self.assertEqual(0, result.returncode, result.stderr)
+                keys.add(result.stdout.split()[-1])
+            self.assertEqual(1, len(keys))
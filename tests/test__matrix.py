@@ -0,0 +1,103 @@
+from unittest import TestCase
+from unittest.mock import patch
+from io import StringIO
+from json import dumps
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from src.velocity._config import config
+from src.velocity._exceptions import NoAvailableBuild
+from src.velocity._graph import ImageRepo
+from src.velocity._matrix import expand_target_set, resolve_matrix
+from tests.test__graph import write_image
+
+
+class TestExpandTargetSet(TestCase):
+    def test_expand(self):
+        self.assertEqual([["gcc"]], expand_target_set("gcc"))
+        self.assertEqual([["gcc@12", "cuda"], ["gcc@13", "cuda"]], expand_target_set("gcc@{12,13} cuda"))
+        self.assertEqual(
+            [["gcc@12", "cuda@11.8"], ["gcc@12", "cuda@12.2"], ["gcc@13", "cuda@11.8"], ["gcc@13", "cuda@12.2"]],
+            expand_target_set(" gcc@{12,13}  cuda@{11.8,12.2} "),
+        )
+        # several groups in one word and whole names as alternatives
+        self.assertEqual(
+            [["gcc@12.3:"], ["gcc@12.4:"], ["gcc@13.3:"], ["gcc@13.4:"]], expand_target_set("gcc@{12,13}.{3,4}:")
+        )
+        self.assertEqual([["gcc"], ["llvm"]], expand_target_set("{gcc,llvm}"))
+        self.assertEqual([], expand_target_set("  "))
+
+
+class TestResolveMatrix(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        root = Path(self.tmp.name)
+        write_image(root, "ubuntu", {"versions": [{"spec": ["22.04", "24.04"]}]})
+        write_image(
+            root,
+            "gcc",
+            {
+                "versions": [{"spec": ["12.3.0", "13.2.0"]}],
+                "dependencies": [{"spec": "ubuntu"}],
+                "variables": [{"name": "LANGS", "value": "c,c++", "when": "gcc@13:"}],
+            },
+        )
+        write_image(
+            root,
+            "cuda",
+            {
+                "versions": [{"spec": ["11.8", "12.2"]}],
+                "dependencies": [{"spec": "gcc@:12", "when": "cuda@12"}, {"spec": "gcc", "when": "cuda@11"}],
+                "arguments": [{"value": "--fakeroot", "when": "^ubuntu", "scope": "build"}],
+            },
+        )
+        self.cache = TemporaryDirectory()
+        self.cache_dir = config.get("velocity:cache_dir")
+        config.set("velocity:cache_dir", self.cache.name)
+        self.repo = ImageRepo()
+        self.repo.import_from_dir(self.tmp.name)
+
+    def tearDown(self):
+        config.set("velocity:cache_dir", self.cache_dir)
+        self.cache.cleanup()
+        self.tmp.cleanup()
+
+    def test_create_build_recipes(self):
+        target_sets = [["gcc@12", "cuda"], ["cuda"], ["gcc@13", "cuda@12.2"], ["gcc"], ["cuda"], ["nothing@:x"]]
+        with patch.object(ImageRepo, "_prepare", wraps=self.repo._prepare) as prepare:
+            results = self.repo.create_build_recipes(target_sets)
+        # the target independent work is only done once
+        self.assertEqual(1, prepare.call_count)
+        self.assertIs(results[1], results[4])
+        self.assertIsInstance(results[2], NoAvailableBuild)
+        self.assertIsInstance(results[5], NoAvailableBuild)
+        for targets, result in zip(target_sets, results):
+            if isinstance(result, Exception):
+                continue
+            recipe, graph = self.repo.create_build_recipe(targets)
+            self.assertEqual([r.hash for r in recipe], [r.hash for r in result[0]])
+            self.assertEqual(set(recipe), set(graph.nodes))
+
+    def test_resolve_matrix(self):
+        with patch("src.velocity._exceptions.stderr", StringIO()):
+            document = resolve_matrix(self.repo, ["gcc@{12,13} cuda@{11.8,12.2}", "ubuntu"])
+        dumps(document)
+        self.assertEqual(config.get("velocity:system"), document["system"])
+        cells = document["cells"]
+        self.assertEqual(
+            [
+                ["gcc@12", "cuda@11.8"],
+                ["gcc@12", "cuda@12.2"],
+                ["gcc@13", "cuda@11.8"],
+                ["gcc@13", "cuda@12.2"],
+                ["ubuntu"],
+            ],
+            [c["targets"] for c in cells],
+        )
+        self.assertEqual(["ubuntu", "gcc", "cuda"], [r["name"] for r in cells[0]["recipe"]])
+        self.assertEqual(["24.04", "13.2.0", "11.8"], [r["version"] for r in cells[2]["recipe"]])
+        self.assertEqual({"LANGS": "c,c++"}, cells[2]["recipe"][1]["variables"])
+        self.assertEqual(["--fakeroot"], cells[2]["recipe"][2]["arguments"])
+        self.assertEqual([[r["id"]] for r in cells[2]["recipe"]], cells[2]["generations"])
+        self.assertTrue(cells[3]["error"].startswith("NoAvailableBuild"))
+        self.assertNotIn("recipe", cells[3])
+        self.assertEqual(1, len(cells[4]["recipe"]))
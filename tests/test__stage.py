@@ -0,0 +1,115 @@
+from unittest import TestCase
+from unittest.mock import patch
+from errno import EOPNOTSUPP, EXDEV
+from os import stat, utime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from src.velocity import _stage
+from src.velocity._stage import reflink, stage_files
+
+
+class TestStageFiles(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        root = Path(self.tmp.name)
+        self.src = root.joinpath("files")
+        self.src.joinpath("tree", "sub").mkdir(parents=True)
+        self.src.joinpath("tree", "a.txt").write_text("a")
+        self.src.joinpath("tree", "sub", "b.txt").write_text("b" * 1000)
+        self.src.joinpath("single.txt").write_text("single")
+        self.dest = root.joinpath("build")
+        self.dest.mkdir()
+        self.entries = [(self.src.joinpath(e), self.dest.joinpath(e)) for e in ("tree", "single.txt")]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_incremental(self):
+        staged = stage_files(self.entries)
+        self.assertEqual(3, staged["copied"] + staged["linked"])
+        self.assertEqual(1007, staged["bytes"])
+        self.assertEqual("b" * 1000, self.dest.joinpath("tree", "sub", "b.txt").read_text())
+        self.assertEqual("single", self.dest.joinpath("single.txt").read_text())
+
+        # nothing changed so nothing is staged (copytree used to fail here)
+        staged = stage_files(self.entries)
+        self.assertEqual({"copied": 0, "linked": 0, "unchanged": 3, "removed": 0, "bytes": 0}, staged)
+
+        # a new modification time alone does not stage the file again
+        utime(self.src.joinpath("tree", "a.txt"), ns=(0, 0))
+        self.assertEqual(3, stage_files(self.entries)["unchanged"])
+        self.assertEqual(0, stat(self.dest.joinpath("tree", "a.txt")).st_mtime_ns)
+
+        # replaced and removed files
+        self.src.joinpath("tree", "a.txt").unlink()
+        self.src.joinpath("tree", "a.txt").write_text("new")
+        self.src.joinpath("tree", "sub", "b.txt").unlink()
+        staged = stage_files(self.entries)
+        self.assertEqual(1, staged["copied"] + staged["linked"])
+        self.assertEqual(1, staged["removed"])
+        self.assertEqual("new", self.dest.joinpath("tree", "a.txt").read_text())
+        self.assertFalse(self.dest.joinpath("tree", "sub", "b.txt").exists())
+
+    def test_copy(self):
+        with (
+            patch("src.velocity._stage.reflink", return_value=False),
+            patch("src.velocity._stage.link", side_effect=OSError),
+        ):
+            staged = stage_files(self.entries, workers=2)
+        self.assertEqual(3, staged["copied"])
+        self.assertNotEqual(stat(self.src.joinpath("single.txt")).st_ino, stat(self.dest.joinpath("single.txt")).st_ino)
+        self.assertEqual(
+            stat(self.src.joinpath("single.txt")).st_mtime_ns, stat(self.dest.joinpath("single.txt")).st_mtime_ns
+        )
+
+        # a changed file is replaced instead of written through
+        self.src.joinpath("single.txt").write_text("changed")
+        staged = stage_files(self.entries)
+        self.assertEqual(1, staged["linked"] + staged["copied"])
+        self.assertEqual("changed", self.dest.joinpath("single.txt").read_text())
+
+    def test_link_is_not_written_through(self):
+        with patch("src.velocity._stage.reflink", return_value=False):
+            self.assertEqual(3, stage_files(self.entries)["linked"])
+        self.assertEqual(stat(self.src.joinpath("single.txt")).st_ino, stat(self.dest.joinpath("single.txt")).st_ino)
+
+        # staging something else at a linked path does not touch the source
+        with patch("src.velocity._stage.reflink", return_value=False):
+            stage_files([(self.src.joinpath("tree", "a.txt"), self.dest.joinpath("single.txt"))])
+        self.assertEqual("single", self.src.joinpath("single.txt").read_text())
+        self.assertEqual("a", self.dest.joinpath("single.txt").read_text())
+
+    def test_type_changes(self):
+        stage_files(self.entries)
+        # a file that becomes a directory and the other way around
+        stage_files([(self.src.joinpath("tree"), self.dest.joinpath("single.txt"))])
+        self.assertTrue(self.dest.joinpath("single.txt", "sub", "b.txt").is_file())
+        staged = stage_files([(self.src.joinpath("single.txt"), self.dest.joinpath("tree"))])
+        self.assertEqual(1, staged["removed"])
+        self.assertEqual("single", self.dest.joinpath("tree").read_text())
+
+    def test_symlinked_directories(self):
+        # a linked directory is staged with its contents, a link back up the tree is skipped
+        self.src.joinpath("real").mkdir()
+        self.src.joinpath("real", "f").write_text("f")
+        self.src.joinpath("tree", "linked").symlink_to(Path("..", "real"))
+        self.src.joinpath("tree", "sub", "loop").symlink_to(Path(".."))
+        staged = stage_files(self.entries)
+        self.assertEqual(4, staged["copied"] + staged["linked"])
+        self.assertEqual("f", self.dest.joinpath("tree", "linked", "f").read_text())
+        self.assertFalse(self.dest.joinpath("tree", "linked").is_symlink())
+        self.assertFalse(self.dest.joinpath("tree", "sub", "loop").exists())
+        self.assertEqual(4, stage_files(self.entries)["unchanged"])
+
+    def test_reflink_errors(self):
+        device = stat(self.dest).st_dev
+        dest = self.dest.joinpath("clone")
+        with open(self.src.joinpath("single.txt"), "rb") as fi, patch.object(_stage, "_no_reflink", set()) as failed:
+            # a clone from another filesystem fails but does not rule out clones on this one
+            with patch("fcntl.ioctl", side_effect=OSError(EXDEV, "cross device")):
+                self.assertFalse(reflink(fi, dest))
+            self.assertEqual(set(), failed)
+            self.assertFalse(dest.exists())
+            with patch("fcntl.ioctl", side_effect=OSError(EOPNOTSUPP, "not supported")):
+                self.assertFalse(reflink(fi, dest))
+            self.assertEqual({device}, failed)